@@ -14,6 +14,7 @@ import pathlib as pl
 
 from client import Client
 import client
+from network import bandwidth
 from security import keyderivation
 from security.keyderivation import BadKeyException, BadPasswordSelected
 from security.secretsharing import FFInt
@@ -123,19 +124,19 @@ class CLI:
 
                 if command == 'df' or command == "del" or command == 'delete_file':
                     try:
-                        idx = int(commands[1])
+                        idxs = [int(idx) for idx in commands[1:] if idx != ""]
                     except ValueError:
-                        print("Could not interpret second entry as a number.")
+                        print("Could not interpret the entries after the command as numbers.")
                         continue
-                    except IndexError:
-                        print("To use this command (gf) provide a number as part of the command.")
+                    if len(idxs) == 0:
+                        print("To use this command (df) provide one or more numbers as part of the command.")
                         continue
                     try:
-                        file_rel_path = self.name_list[idx - 1]  # One-indexing -> zero-indexing
+                        file_rel_paths = [self.name_list[idx - 1] for idx in idxs]  # One-indexing -> zero-indexing
                     except IndexError:
                         print("The inputted number is invalid.")
                         continue
-                    success = self.interact_with_server('df', file_rel_path)
+                    success = self.delete_files(file_rel_paths)
                     if not success:
                         continue
 
@@ -181,10 +182,54 @@ class CLI:
                 self.replace_password()
             elif command == 'backup_password':
                 self.backup_password()
+            elif command == 'bw' or command == 'bandwidth':
+                self.set_bandwidth([arg for arg in commands[1:] if arg != ""])
             print()
             print(self.divider)
             print(self.get_help())
 
+    def set_bandwidth(self, args: list):
+        """
+        Show or change the bandwidth limits. Rates are in KiB/s, 0 for no limit:
+            bw                                      show the limits
+            bw <up> <down>                          limit always
+            bw schedule HH:MM-HH:MM <up> <down>     limit differently between the given times
+            bw schedule clear                       remove the schedule
+
+        Args:
+            args: what followed the command
+        """
+        limiter = self.client.servercoms.limiter
+        try:
+            if args == ['schedule', 'clear']:
+                limiter.set_schedule(None)
+            elif len(args) == 2:
+                self.client.set_bandwidth_limits(self.parse_rate(args[0]), self.parse_rate(args[1]))
+            elif len(args) == 4 and args[0] == 'schedule':
+                limiter.set_schedule(limiter.schedule + [bandwidth.parse_schedule_entry(
+                    args[1], self.parse_rate(args[2]), self.parse_rate(args[3]))])
+            elif len(args) != 0:
+                print("Could not interpret the command. Use: bw [<up> <down>] or bw schedule HH:MM-HH:MM <up> <down>")
+                return
+        except ValueError:
+            print("Could not interpret the rates (KiB/s) or times (HH:MM).")
+            return
+        print("Upload limit:   " + self.format_rate(limiter.upload_rate))
+        print("Download limit: " + self.format_rate(limiter.download_rate))
+        for start, end, upload_rate, download_rate in limiter.schedule:
+            print(start.strftime('%H:%M') + "-" + end.strftime('%H:%M') + ": up " + self.format_rate(upload_rate)
+                  + ", down " + self.format_rate(download_rate))
+
+    def parse_rate(self, rate: str) -> float:
+        """KiB/s as typed to bytes per second, None for no limit. Raises ValueError if not a number"""
+        kib_per_s = float(rate)
+        if kib_per_s < 0:
+            raise ValueError
+        return kib_per_s * 1024 if kib_per_s else None
+
+    def format_rate(self, rate: float) -> str:
+        return "none" if not rate else str(round(rate / 1024)) + " KiB/s"
+
     def replace_password(self):
         """Method for replacing the users password"""
         self.clear_screen()
@@ -225,16 +270,29 @@ class CLI:
             return True
 
         if command == 'df' or command == "del":
-            if exists_locally:
-                answer = input("Delete local file? (y,n)")
-                answer = answer.lower()
-                if answer == "y" or answer == "yes":
+            return self.delete_files([file_rel_path])
+
+    def delete_files(self, file_rel_paths: list):
+        """Delete the listed files on the server in one go, and locally if the user wants to
+
+        Args:
+            file_rel_paths: the files in question to delete
+        """
+        remote_file_names = set(globals.SERVER_FILE_DICT)
+        local_files = [file_rel_path for file_rel_path in file_rel_paths if pl.Path.exists(file_rel_path)]
+        remote_files = [file_rel_path for file_rel_path in file_rel_paths if file_rel_path in remote_file_names]
+        if local_files:
+            answer = input("Delete " + str(len(local_files)) + " local file(s)? (y,n)")
+            answer = answer.lower()
+            if answer == "y" or answer == "yes":
+                for file_rel_path in local_files:
                     pl.Path.unlink(file_rel_path)
-            if exists_remotely:
-                print("Deleting file on server...")
+        if remote_files:
+            print("Deleting files on server...")
+            for file_rel_path in remote_files:
                 print(file_rel_path.as_posix())
-                self.client.delete_remote_file(file_rel_path)
-            return True
+            self.client.delete_remote_files(remote_files)
+        return True
 
     def replace_pw_using_shares(self):
         """Replace username and password from shares"""
@@ -465,11 +523,12 @@ Available commands:
     Add shared folder   (asf, add_shared_folder)
     Backup password us- (backup_password)
         ing shares.
+    Bandwidth limits    (bw, bandwidth [<up> <down>])
     Exit                (e, exit)
                         """
         additional = """
     Get_file            (gf #, get #, get_file #)    
-    Delete_file         (df #, del #, delete_file #)
+    Delete_file         (df # [# ...], del #, delete_file #)
         
         """
         if self.get_or_delete_avaliable:
@@ -1,32 +1,218 @@
+import asyncio
 import json
+import os
 import pathlib as pl
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from json import JSONDecodeError
+from threading import Event, Lock
 
+import requests
 import urllib3
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-import requests
-
+from network.bandwidth import BandwidthLimiter, ThrottledReader
+from network.listing import BadListingError, decode_listing, LISTING_CONTENT_TYPE
+from network.transport import get_transport, Transport
+from network.upload_journal import get_upload_journal
 from resources import globals
-from hashlib import sha3_512
+from security.filecryptography import ChunkedFile, EncryptedFile
+from hashlib import sha256, sha3_512
+
+
+def read_file_chunks(file_path: pl.Path, chunk_size: int = globals.UPLOAD_CHUNK_SIZE):
+    """
+    Generator reading a file in fixed-size chunks, such that only one chunk is in memory at a time
+
+    Args:
+        file_path: the path of the file to read
+        chunk_size: the amount of bytes in each chunk (the last one may be smaller)
+    """
+    with open(file_path, 'rb') as file:
+        chunk = file.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = file.read(chunk_size)
+
+
+def write_file_chunks(chunks, file_path: pl.Path):
+    """
+    Write chunks to a file as they come, such that only one chunk is in memory at a time
+
+    Args:
+        chunks: an iterable of bytes
+        file_path: the path of the file to write
+    """
+    with open(file_path, 'wb') as file:
+        for chunk in chunks:
+            file.write(chunk)
+
+
+class CiphertextFile:
+    """An encrypted file on disk, read the way EncryptedFile is"""
+
+    alignment = 1  # Any range can be read
+    seekable = True  # Ranges are read without reading everything before them
+
+    def __init__(self, file_path: pl.Path):
+        """
+        Args:
+            file_path: the path of the encrypted file
+        """
+        self.file_path = file_path
+        self.size = file_path.stat().st_size
+
+    def chunks(self):
+        """Generator giving the file a chunk at a time"""
+        return read_file_chunks(self.file_path)
+
+    def read(self, offset: int, length: int) -> bytes:
+        """Read length bytes from offset"""
+        with open(self.file_path, 'rb') as file:
+            file.seek(offset)
+            return file.read(length)
+
+    def read_all(self) -> bytes:
+        """The whole file, in memory"""
+        return self.file_path.read_bytes()
+
+
+class CiphertextBytes:
+    """Ciphertext held in memory, e.g. from FileCryptography.encrypt_many, read the way EncryptedFile is"""
+
+    alignment = 1  # Any range can be read
+    seekable = True  # Ranges are read without reading everything before them
+
+    def __init__(self, ciphertext: bytes):
+        """
+        Args:
+            ciphertext: the encrypted file
+        """
+        self.ciphertext = ciphertext
+        self.size = len(ciphertext)
+
+    def chunks(self):
+        """Generator giving the ciphertext in one chunk"""
+        yield self.ciphertext
+
+    def read(self, offset: int, length: int) -> bytes:
+        """Read length bytes from offset"""
+        return self.ciphertext[offset:offset + length]
+
+    def read_all(self) -> bytes:
+        """The whole ciphertext"""
+        return self.ciphertext
+
+
+def parse_content_range(content_range: str) -> (int, int):
+    """
+    Parse a Content-Range header of the form 'bytes <first>-<last>/<size>'
+
+    Returns:
+        int: the last byte in the range
+        int: the size of the whole file
+    """
+    unit, _, byte_range = content_range.partition(' ')
+    first_last, _, size = byte_range.partition('/')
+    if unit != 'bytes' or int(first_last.partition('-')[0]) != 0:
+        raise ValueError("Unexpected Content-Range: " + content_range)
+    return int(first_last.partition('-')[2]), int(size)
+
+
+class DownloadProgress:
+    """
+    The segments of a download written to its (preallocated) tmp file, noted in a file next to it such that an
+    interrupted download can go on
+    """
+
+    def __init__(self, tmp_file_location: pl.PurePath, size: int, additional_data: dict, persist: bool = True):
+        """
+        Pick up the progress of an earlier attempt at the same download, or preallocate the file if there is none
+
+        Args:
+            tmp_file_location: where the file is placed
+            size: the size of the whole file
+            additional_data: the additional data of the file, telling versions of the file apart
+            persist: whether to note the progress on disk; not worth it for a download of one segment
+        """
+        self.persist = persist
+        self.tmp_file_location = pl.Path(tmp_file_location)
+        self.progress_path = self.tmp_file_location.with_name(self.tmp_file_location.name + '.segments')
+        self.lock = Lock()
+        self.state = {'size': size, 'additional_data': additional_data, 'done': []}
+        try:
+            with open(self.progress_path, "rt") as file:
+                state = json.loads(file.read())
+            if state['size'] == size and state['additional_data'] == additional_data \
+                    and self.tmp_file_location.stat().st_size == size:
+                self.state = state
+        except (FileNotFoundError, JSONDecodeError, KeyError):
+            pass
+        self.done = set(self.state['done'])
+        if not self.done:
+            with open(self.tmp_file_location, "wb") as file:
+                file.truncate(size)
+
+    def mark_done(self, start: int):
+        """Note that the segment starting at start is written"""
+        with self.lock:
+            self.done.add(start)
+            if not self.persist:
+                return
+            self.state['done'] = sorted(self.done)
+            tmp_path = self.progress_path.with_name(self.progress_path.name + '.tmp')
+            with open(tmp_path, "wt") as file:
+                file.write(json.dumps(self.state))
+            os.replace(tmp_path, self.progress_path)
+
+    def remove(self):
+        """Forget the progress, as the download is complete"""
+        if self.progress_path.exists():
+            self.progress_path.unlink()
+
+
+UNKNOWN_USER_STATUS_CODES = (401, 403)  # The server does not know the userID
+_registered_users = None  # Hashes of the ServComs (server, userID) known to be registered, see globals.REGISTERED_USERS
+_registered_users_path = None  # The file _registered_users was loaded from
+_registered_users_lock = Lock()
+
+
+def get_registered_users() -> set:
+    """Get the set of ServComs hashes known to be registered, loading it from disk the first time (and again if
+    globals.REGISTERED_USERS is moved, e.g. by the tests)"""
+    global _registered_users, _registered_users_path
+    if _registered_users is None or _registered_users_path != pl.Path(globals.REGISTERED_USERS):
+        _registered_users_path = pl.Path(globals.REGISTERED_USERS)
+        try:
+            with open(globals.REGISTERED_USERS, "rt") as file:
+                _registered_users = set(json.loads(file.read()))
+        except (FileNotFoundError, JSONDecodeError):
+            _registered_users = set()
+    return _registered_users
 
 
 class ServComs():
     """Communicates with the file-host server"""
     # ToDO: Do we even have a connection?
 
-    def __init__(self, serverIP: str, userID: str):
+    def __init__(self, serverIP: str, userID: str, pool_size: int = None):
         """
         Args:
             serverIP: the location of the server we try to connect to
             userID: the ID to forward to the server whenever making a request
+            pool_size: the amount of kept-alive connections towards the server, if this is the first ServComs for it
         """
         self.serverLocation = serverIP
         self.userID = userID
         self.cert = "wyrnasmyqnapcloudcom.crt"
         self.verify = False  #self.cert
-        self.register_user()
+        # Shared by every ServComs for this server, such that connections (and their TLS sessions) are reused
+        self.transport: Transport = get_transport(serverIP, pool_size)
+        self.limiter: BandwidthLimiter = self.transport.limiter  # Shared for the same reason, see set_bandwidth_limits
+        self.list_cursor = None  # Where the server file list was at our last look, see get_file_list_changes
+        # Registering is done at the first request, and only if we have not registered before (see ensure_registered)
 
     def __hash__(self):
         hasher: sha3_512 = sha3_512()
@@ -40,44 +226,599 @@ class ServComs():
             return False
         return self.__hash__() == other.__hash__()
 
-    def send_file(self, file_path: pl.Path, additional_data: dict) -> None:
-        """Send provided filename to the server
+    def request(self, method: str, path: str, **kwargs):
+        """
+        Make a request as this user; registering first if not known to be registered, and again if the server turns
+        out not to know the user
+
+        Args:
+            method: the HTTP method, e.g. 'GET' or 'POST'
+            path: the path on the server, starting with '/'
+            **kwargs: passed on to Transport.request
+
+        Returns:
+            requests.Response: the response of the server
+        """
+        self.ensure_registered()
+        response = self.transport.request(method, path, **kwargs)
+        if response.status_code in UNKNOWN_USER_STATUS_CODES:
+            response.close()
+            self.set_registered(False)
+            self.ensure_registered()
+            response = self.transport.request(method, path, **kwargs)
+        return response
+
+    def send_file(self, file_path: pl.Path, additional_data: dict, source_path: pl.Path = None) -> None:
+        """Send provided filename to the server. Big files are sent in resumable parts or streamed, small files keep
+        their single multipart POST
 
         Args:
             file_path: the path of the file to send
             additional_data: the additional data (nonce, time +) for the file
+            source_path: the path of the file encrypted into file_path, journaled such that an interrupted upload of
+                it can be resumed (see find_resumable_upload)
         """
-        # ToDo: send as stream for big files (otherwise memory error). Tested up to 300mb works
-        with open(file_path, 'rb') as file:
-            response = requests.post('https://' + self.serverLocation + '/upload_file/' + self.userID,
-                                     files={'file_content': file,
-                                            'additional_data': bytes(json.dumps(additional_data), 'utf-8')},
-                                     verify=self.verify)
+        self.send_ciphertext(CiphertextFile(file_path), additional_data, source_path)
+
+    def send_encrypted_file(self, enc_file: EncryptedFile) -> None:
+        """Send a file encrypted while it is sent, such that no ciphertext touches the disk. See send_file.
+        With globals.CHUNKED_UPLOADS, files of globals.CHUNKED_UPLOAD_THRESHOLD or bigger are sent as chunks, if the
+        server keeps chunks, such that only what changed since an earlier version is sent (see send_chunked_file).
+        The server is asked before the file is split, as splitting is far slower than encrypting
+
+        Args:
+            enc_file: the file to send, see FileCryptography.open_encrypted
+        """
+        if globals.CHUNKED_UPLOADS and enc_file.version >= 2 \
+                and enc_file.plain_size >= globals.CHUNKED_UPLOAD_THRESHOLD and self.has_chunk_store():
+            try:
+                self.send_chunked_file(enc_file.chunked())
+                return
+            except ChunksNotSupportedError:
+                pass  # Send it whole instead
+        self.send_ciphertext(enc_file, enc_file.additional_data, enc_file.file_path)
+
+    def send_chunked_file(self, chunked_file: ChunkedFile) -> None:
+        """
+        Send a file as chunks: the file is split into chunks, the server is asked which of them it lacks, those are
+        read again, encrypted and sent, globals.MULTIPART_PARALLEL_PARTS at a time, and the manifest listing the
+        chunks is sent last, as the file. Sending again after an interruption only sends the chunks still missing
+
+        Args:
+            chunked_file: the file to send, see EncryptedFile.chunked
+        """
+        missing = self.get_missing_chunks(chunked_file.chunk_ids())
+        self.map_over_connections(lambda chunk_id: self.send_chunk(chunk_id, chunked_file.read_chunk(chunk_id)),
+                                  missing, globals.MULTIPART_PARALLEL_PARTS)
+        manifest, additional_data = chunked_file.manifest()
+        self.send_ciphertext(CiphertextBytes(manifest), additional_data)
+
+    def has_chunk_store(self) -> bool:
+        """Whether the server keeps chunks, asked the first time (with no chunks, see get_missing_chunks)"""
+        if 'chunk_store' not in self.transport.capabilities:
+            try:
+                self.get_missing_chunks([])
+            except ChunksNotSupportedError:
+                pass
+        return self.transport.capabilities['chunk_store']
+
+    def get_missing_chunks(self, chunk_ids: list) -> list:
+        """
+        Ask the server which chunks it lacks, globals.CHUNK_QUERY_BATCH_SIZE ids at a time; with no chunk ids it is
+        still asked once, to learn whether it keeps chunks at all
+
+        Args:
+            chunk_ids: the ids of the chunks
+
+        Returns:
+            list: the ids of the chunks the server does not have, in the order of chunk_ids
+        """
+        missing = set()
+        for start in range(0, max(len(chunk_ids), 1), globals.CHUNK_QUERY_BATCH_SIZE):
+            response = self.request('POST', '/chunks_missing/' + self.userID,
+                                    operation='upload',
+                                    json={'chunks': chunk_ids[start:start + globals.CHUNK_QUERY_BATCH_SIZE]},
+                                    verify=self.verify)
+            if response.status_code in (404, 405):  # Endpoint unknown to this server
+                self.transport.capabilities['chunk_store'] = False
+                raise ChunksNotSupportedError
             response.raise_for_status()
+            self.transport.capabilities['chunk_store'] = True
+            missing.update(response.json()['missing'])
+        return [chunk_id for chunk_id in chunk_ids if chunk_id in missing]
+
+    def send_chunk(self, chunk_id: str, content: bytes):
+        """Send one encrypted chunk, at the upload rate if it is limited"""
+        def body_factory() -> dict:
+            if self.limiter.is_limited():
+                return {'data': ThrottledReader(content, self.limiter)}
+            return {'data': content}
+
+        response = self.request('POST', '/upload_chunk/' + chunk_id + '/' + self.userID,
+                                operation='upload',
+                                body_factory=body_factory,
+                                headers={'Content-Type': 'application/octet-stream'},
+                                verify=self.verify)
+        response.raise_for_status()
+
+    def get_chunk(self, chunk_id: str) -> bytes:
+        """
+        Get one encrypted chunk
+
+        Args:
+            chunk_id: the id of the chunk
+
+        Returns:
+            bytes: the encrypted chunk
+        """
+        response = self.request('GET', '/get_chunk/' + chunk_id + '/' + self.userID,
+                                operation='download',
+                                headers={'Accept': 'application/octet-stream'},
+                                stream=True,
+                                verify=self.verify)
+        with response:
+            if response.status_code == 404:
+                raise FileNotFoundError("Chunk " + chunk_id + " not on server")
+            response.raise_for_status()
+            return b''.join(self.limiter.throttle_download(response.iter_content(self.download_chunk_size())))
+
+    def get_chunks(self, chunk_ids: list):
+        """
+        Generator getting chunks in order, globals.DOWNLOAD_PARALLEL_SEGMENTS at a time, fetching at most two per
+        connection ahead of the one handed on
+
+        Args:
+            chunk_ids: the ids of the chunks
+
+        Yields:
+            bytes: the encrypted chunks, in the order of chunk_ids
+        """
+        workers = max(min(globals.DOWNLOAD_PARALLEL_SEGMENTS, self.transport.pool_size), 1)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for chunk_id in chunk_ids:
+                    pending.append(executor.submit(self.get_chunk, chunk_id))
+                    if len(pending) >= 2 * workers:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:  # Stopped early, e.g. by a damaged chunk
+                for future in pending:
+                    future.cancel()
+
+    def send_ciphertext(self, ciphertext, additional_data: dict, source_path: pl.Path = None) -> None:
+        """
+        Send ciphertext in the best way the server supports for its size, see send_file. Ciphertext that is not
+        seekable (e.g. of a compressed file) is streamed rather than sent in resumable parts
+
+        Args:
+            ciphertext: the CiphertextFile, CiphertextBytes or EncryptedFile to send
+            additional_data: the additional data (nonce, time +) for the file
+            source_path: the path of the (unencrypted) file, see send_file
+        """
+        if ciphertext.size >= globals.MULTIPART_UPLOAD_THRESHOLD and ciphertext.seekable \
+                and self.transport.capabilities.get('multipart_upload', True):
+            try:
+                self.send_file_parts(ciphertext, additional_data, source_path)
+                return
+            except MultipartNotSupportedError:
+                pass  # Stream it instead
+        if ciphertext.size >= globals.STREAM_UPLOAD_THRESHOLD \
+                and self.transport.capabilities.get('stream_upload', True):
+            try:
+                self.send_file_stream(ciphertext.chunks, additional_data)
+                return
+            except StreamingNotSupportedError:
+                print("Warning; server does not support streamed uploads, sending file in one piece.")
+        self.send_file_multipart(ciphertext, additional_data)
 
-    def get_file(self, enc_file_name: str):
+    def send_file_parts(self, ciphertext, additional_data: dict, source_path: pl.Path = None) -> None:
         """
-        Retrive enc_file_name from server and place it in tmp (ready for decryption)
+        Send the file in parts of about globals.MULTIPART_PART_SIZE, globals.MULTIPART_PARALLEL_PARTS at a time.
+        Acknowledged parts are journaled; if the same upload was cut off before, only the parts the server does not
+        have yet are read and sent. On failure the journal is kept, such that calling again resumes the upload.
+
+        Args:
+            ciphertext: the CiphertextFile, CiphertextBytes or EncryptedFile to send
+            additional_data: the additional data (nonce, time +) for the file
+            source_path: the path of the (unencrypted) file, see send_file
+        """
+        journal = get_upload_journal()
+        key = self.upload_key(additional_data)
+        size = ciphertext.size
+        entry = journal.get(key)
+        # The keyed hash of what is encrypted, such that the upload is only resumed for the same content
+        source_hash = ciphertext.content_hash() if isinstance(ciphertext, EncryptedFile) else None
+        if entry is None or entry['size'] != size or entry['additional_data'] != additional_data \
+                or entry['part_size'] % ciphertext.alignment:
+            entry = self.start_upload(key, size, additional_data, source_path, ciphertext.alignment, source_hash)
+        server_parts = self.get_upload_status(entry['upload_id'])
+        if server_parts is None:  # The server has forgotten the upload
+            entry = self.start_upload(key, size, additional_data, source_path, ciphertext.alignment, source_hash)
+            server_parts = {}
+        part_size = entry['part_size']
+        indices = range((size + part_size - 1) // part_size) if size else range(1)
+        # The same additional data (nonces) and size give the same ciphertext, so journaled parts need not be read
+        done = {int(index) for index, part_hash in entry['parts'].items()
+                if server_parts.get(index, None) == part_hash}
+        failed = Event()
+
+        def send_part(index: int):
+            if failed.is_set() or index in done:
+                return  # Already on the server, or another part failed and this one is left for the resume
+            try:
+                content = ciphertext.read(index * part_size, part_size)
+                part_hash = sha256(content).hexdigest()
+                self.send_part(entry['upload_id'], index, content, part_hash)
+                journal.mark_part(key, index, part_hash)
+            except Exception:
+                failed.set()
+                raise
+
+        workers = max(min(globals.MULTIPART_PARALLEL_PARTS, self.transport.pool_size, len(indices)), 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(send_part, index) for index in indices]
+        for future in futures:
+            future.result()  # Raises the error of a failed part
+        response = self.request('POST', '/multipart_complete/' + entry['upload_id'] + '/' + self.userID,
+                                operation='upload', json={'parts': len(indices)}, verify=self.verify)
+        response.raise_for_status()
+        journal.remove(key)
+
+    def upload_key(self, additional_data: dict) -> str:
+        """The key of the upload of a file in the upload journal; the server, user and encrypted name"""
+        return self.__hash__() + ':' + additional_data['n']
+
+    def start_upload(self, key: str, size: int, additional_data: dict, source_path: pl.Path = None,
+                     alignment: int = 1, source_hash: str = None) -> dict:
+        """
+        Start a multipart upload on the server and journal it
+
+        Args:
+            alignment: parts must be a multiple of this, such that every part starts at a segment of the ciphertext
+            source_hash: the keyed hash of the content of the source file, see find_resumable_upload
+
+        Returns:
+            dict: the journal entry of the upload
+        """
+        part_size = max(globals.MULTIPART_PART_SIZE // alignment, 1) * alignment
+        response = self.request('POST', '/multipart_start/' + self.userID,
+                                operation='upload',
+                                json={'size': size, 'part_size': part_size, 'additional_data': additional_data},
+                                verify=self.verify)
+        if response.status_code in (404, 405):  # Endpoint unknown to this server
+            self.transport.capabilities['multipart_upload'] = False
+            raise MultipartNotSupportedError
+        response.raise_for_status()
+        self.transport.capabilities['multipart_upload'] = True
+        entry = {'upload_id': response.json()['upload_id'], 'size': size, 'part_size': part_size,
+                 'additional_data': additional_data, 'parts': {}}
+        if source_path is not None:
+            source_stat = source_path.stat()
+            entry['source'] = {'path': str(source_path), 'size': source_stat.st_size,
+                               'mtime_ns': source_stat.st_mtime_ns, 'hash': source_hash}
+        get_upload_journal().put(key, entry)
+        return entry
+
+    def get_upload_status(self, upload_id: str):
+        """
+        Ask the server which parts of an upload it has
+
+        Returns:
+            dict: index (as str) -> hex sha256 of the parts the server has, None if the server does not know the upload
+        """
+        response = self.request('GET', '/multipart_status/' + upload_id + '/' + self.userID,
+                                operation='upload', verify=self.verify)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()['parts']
+
+    def send_part(self, upload_id: str, index: int, content: bytes, part_hash: str):
+        """Send one part of a multipart upload, at the upload rate if it is limited"""
+        def body_factory() -> dict:
+            if self.limiter.is_limited():
+                return {'data': ThrottledReader(content, self.limiter)}
+            return {'data': content}
+
+        response = self.request('POST', '/multipart_part/' + upload_id + '/' + str(index) + '/' + self.userID,
+                                operation='upload',
+                                body_factory=body_factory,
+                                headers={'Content-Type': 'application/octet-stream', 'X-Part-Sha256': part_hash},
+                                verify=self.verify)
+        response.raise_for_status()
+
+    def find_resumable_upload(self, source_path: pl.Path, content_hash=None) -> dict:
+        """
+        Find an unfinished upload of the given file, which is unchanged since. Journaled uploads of changed files are
+        forgotten. Its size and modification time are not enough to tell: a file rewritten within the same tick of
+        the clock would be encrypted under the nonces of other content, so the keyed hash of the content must match.
+
+        Args:
+            source_path: the path of the (unencrypted) file
+            content_hash: gives the keyed hash of the content of a file, as the source_hash the upload was journaled
+                with (see ContentIndex.content_hash); without it no upload is resumed
+
+        Returns:
+            dict: the additional data the file was encrypted with, such that encrypting it again with the same nonces
+                gives the same ciphertext, and the upload can go on. None if there is no such upload
+        """
+        journal = get_upload_journal()
+        key, entry = journal.find_by_source(self.__hash__() + ':', source_path)
+        if entry is None:
+            return None
+        try:
+            source_stat = source_path.stat()
+        except FileNotFoundError:
+            source_stat = None
+        if source_stat is None or entry['source']['size'] != source_stat.st_size \
+                or entry['source']['mtime_ns'] != source_stat.st_mtime_ns or content_hash is None \
+                or entry['source'].get('hash', None) is None or content_hash(source_path) != entry['source']['hash']:
+            journal.remove(key)
+            return None
+        return entry['additional_data']
+
+    def send_file_multipart(self, ciphertext, additional_data: dict) -> None:
+        """Send provided filename to the server as one multipart body. Tested up to 300mb works
+
+        Args:
+            ciphertext: the CiphertextFile, CiphertextBytes or EncryptedFile to send
+            additional_data: the additional data (nonce, time +) for the file
+        """
+        def body_factory() -> dict:
+            files = {'file_content': ciphertext.read_all(),
+                     'additional_data': bytes(json.dumps(additional_data), 'utf-8')}
+            if not self.limiter.is_limited():
+                return {'files': files}
+            # The same body requests would make, but read out at the upload rate
+            body, content_type = urllib3.encode_multipart_formdata({name: (name, data) for name, data in files.items()})
+            return {'data': ThrottledReader(body, self.limiter), 'headers': {'Content-Type': content_type}}
+
+        response = self.request('POST', '/upload_file/' + self.userID,
+                                operation='upload',
+                                body_factory=body_factory,
+                                verify=self.verify)
+        response.raise_for_status()
+
+    def send_file_stream(self, chunks_factory, additional_data: dict) -> None:
+        """
+        Stream the (encrypted) file content to the server using chunked transfer encoding, such that the memory used
+        is bounded by the chunk size no matter the size of the file
+
+        Args:
+            chunks_factory: a callable giving an iterable of bytes making up the content of the file, in order.
+                Called again for every retry
+            additional_data: the additional data (nonce, time +) for the file
+        """
+        response = self.request('POST', '/upload_file_stream/' + self.userID,
+                                operation='upload',
+                                body_factory=lambda: {'data': self.limiter.throttle_upload(chunks_factory())},
+                                headers={'Content-Type': 'application/octet-stream',
+                                         'X-Additional-Data': json.dumps(additional_data)},
+                                verify=self.verify)
+        if response.status_code in (404, 405):  # Endpoint unknown to this server
+            self.transport.capabilities['stream_upload'] = False
+            raise StreamingNotSupportedError
+        response.raise_for_status()
+        self.transport.capabilities['stream_upload'] = True
+
+    def get_file(self, enc_file_name: str, consume=None):
+        """
+        Retrive enc_file_name from server and place it in tmp (ready for decryption), or hand it to consume as it
+        arrives, such that it can be decrypted straight into place without going by the disk first.
+        The raw binary format is asked for and streamed; servers only knowing the JSON format answer in that.
+        The first globals.DOWNLOAD_SEGMENT_SIZE bytes are asked for; if the file is bigger, the rest is fetched in
+        parallel ranges into tmp (see receive_segmented_file), and from there handed to consume.
 
         Args:
             enc_file_name: the (encrypted) name wanted from the server
+            consume: called with the additional data and an iterable of the chunks of the file while the download is
+                under way; its result is returned. None to place the file in tmp
+
+        Returns:
+            the result of consume, or the path of the file in tmp and its additional data if consume is None
         """
-        response = requests.get('https://' + self.serverLocation + '/get_file/' + enc_file_name + '/' + self.userID, verify=self.verify)
-        if response.status_code != 404:
+        response = self.request('GET', '/get_file/' + enc_file_name + '/' + self.userID,
+                                operation='download',
+                                headers={'Accept': 'application/octet-stream, application/json;q=0.5',
+                                         'Range': 'bytes=0-' + str(globals.DOWNLOAD_SEGMENT_SIZE - 1)},
+                                stream=True,
+                                verify=self.verify)
+        tmp_file_location = pl.PurePath.joinpath(globals.TEMPORARY_FOLDER, enc_file_name)
+        keep_in_tmp = consume is None
+        if keep_in_tmp:
+            def consume(additional_data: dict, chunks):
+                write_file_chunks(chunks, tmp_file_location)
+                return tmp_file_location, additional_data
+        with response:
+            if response.status_code != 404:
+                response.raise_for_status()
+            else:
+                raise FileNotFoundError
+            if not response.headers.get('Content-Type', '').startswith('application/octet-stream'):
+                self.transport.capabilities['binary_download'] = False
+                return self.receive_json_file(response, consume)
+            self.transport.capabilities['binary_download'] = True
+            self.transport.capabilities['ranged_download'] = response.status_code == 206
+            if response.status_code != 206 or self.is_whole_file(response):
+                return self.receive_binary_file(response, consume)
+            additional_data = self.receive_segmented_file(response, enc_file_name, tmp_file_location)
+        if keep_in_tmp:
+            return tmp_file_location, additional_data
+        try:
+            return consume(additional_data, read_file_chunks(tmp_file_location))
+        finally:
+            pl.Path(tmp_file_location).unlink()
+
+    def get_file_range(self, enc_file_name: str, offset: int, length: int) -> (bytes, dict):
+        """
+        Get part of a file as stored on the server, e.g. one file of a pack. Servers not answering with the range
+        send the whole file, which is cut down to the range
+
+        Args:
+            enc_file_name: the (encrypted) name of the file on the server
+            offset: the first byte wanted
+            length: the amount of bytes wanted
+
+        Returns:
+            bytes: the range of the file, shorter if the file ends before it
+            dict: the additional data of the file
+        """
+        response = self.request('GET', '/get_file/' + enc_file_name + '/' + self.userID,
+                                operation='download',
+                                headers={'Accept': 'application/octet-stream, application/json;q=0.5',
+                                         'Range': 'bytes=' + str(offset) + '-' + str(offset + length - 1)},
+                                stream=True,
+                                verify=self.verify)
+        with response:
+            if response.status_code == 404:
+                raise FileNotFoundError
+            if response.status_code == 416:  # The file ends before the range
+                return b'', json.loads(response.headers.get('X-Additional-Data', '{}'))
             response.raise_for_status()
+            if not response.headers.get('Content-Type', '').startswith('application/octet-stream'):
+                return self.receive_json_file(
+                    response, lambda additional_data, chunks: (b''.join(chunks)[offset:offset + length],
+                                                               additional_data))
+            content, additional_data = self.receive_binary_file(
+                response, lambda additional_data, chunks: (b''.join(chunks), additional_data))
+        if response.status_code != 206:
+            content = content[offset:offset + length]
+        return content, additional_data
+
+    def is_whole_file(self, response) -> bool:
+        """Whether a 206 response holds the whole file, such that it needs no further ranges"""
+        try:
+            last, size = parse_content_range(response.headers['Content-Range'])
+        except (KeyError, ValueError):
+            raise FileNotFoundError  # No range, no file.
+        return last + 1 >= size
+
+    def receive_binary_file(self, response, consume):
+        """
+        Hand a raw binary file response to consume chunk by chunk, as it is read
+
+        Args:
+            response: the streamed response with the file as body and its additional data in a header
+            consume: called with the additional data and an iterable of the chunks of the file, see get_file
+
+        Returns:
+            the result of consume
+        """
+        try:
+            additional_data = json.loads(response.headers['X-Additional-Data'])
+        except (KeyError, JSONDecodeError):
+            raise FileNotFoundError  # No additional data, no file.
+        return consume(additional_data,
+                       self.limiter.throttle_download(response.iter_content(self.download_chunk_size())))
+
+    def receive_segmented_file(self, response, enc_file_name: str, tmp_file_location: pl.PurePath) -> dict:
+        """
+        Write a file to disk in segments of globals.DOWNLOAD_SEGMENT_SIZE, the first from the given response and the
+        rest fetched as ranges, globals.DOWNLOAD_PARALLEL_SEGMENTS at a time, into a preallocated file. Finished
+        segments are noted next to the file, such that getting the file again after an interruption only fetches the
+        missing segments.
+
+        Args:
+            response: the streamed 206 response with the first range of the file and its additional data in a header
+            enc_file_name: the (encrypted) name of the file
+            tmp_file_location: where to place the received file
+
+        Returns:
+            dict: the additional data of the file
+        """
+        try:
+            additional_data = json.loads(response.headers['X-Additional-Data'])
+            first_end, size = parse_content_range(response.headers['Content-Range'])
+        except (KeyError, ValueError):
+            raise FileNotFoundError  # No additional data or no range, no file.
+        segment_size = first_end + 1
+        segments = [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+        progress = DownloadProgress(tmp_file_location, size, additional_data, persist=len(segments) > 1)
+        if progress.done:
+            response.close()  # The first segment is already here
         else:
-            raise FileNotFoundError
+            self.fetch_segment(enc_file_name, tmp_file_location, segments[0], progress, response)
+        missing = [segment for segment in segments[1:] if segment[0] not in progress.done]
+        self.map_over_connections(lambda segment: self.fetch_segment(enc_file_name, tmp_file_location, segment,
+                                                                     progress),
+                                  missing, globals.DOWNLOAD_PARALLEL_SEGMENTS)
+        progress.remove()
+        return additional_data
+
+    def fetch_segment(self, enc_file_name: str, tmp_file_location: pl.PurePath, segment: tuple,
+                      progress: 'DownloadProgress', response=None):
+        """
+        Fetch a range of a file and write it at its offset. If the connection breaks off, the rest of the range is
+        asked for again
+
+        Args:
+            enc_file_name: the (encrypted) name of the file
+            tmp_file_location: where the file is placed, preallocated
+            segment: the first and last byte of the range
+            progress: where to note the finished segment
+            response: an already opened response for the range, if any
+        """
+        start_time = time.monotonic()
+        position, end = segment
+        for attempt in range(globals.RETRY_MAX_ATTEMPTS):
+            if response is None:
+                response = self.request('GET', '/get_file/' + enc_file_name + '/' + self.userID,
+                                        operation='download',
+                                        headers={'Accept': 'application/octet-stream',
+                                                 'Range': 'bytes=' + str(position) + '-' + str(end)},
+                                        stream=True,
+                                        verify=self.verify)
+            with response:
+                if response.status_code != 206:
+                    response.raise_for_status()
+                    raise RangedDownloadError("Server did not answer with the range asked for")
+                try:
+                    with open(tmp_file_location, "r+b") as saveFile:
+                        saveFile.seek(position)
+                        chunks = response.iter_content(self.download_chunk_size())
+                        for chunk in self.limiter.throttle_download(chunks):
+                            saveFile.write(chunk[:end + 1 - position])
+                            position += len(chunk)
+                except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout):
+                    if attempt + 1 == globals.RETRY_MAX_ATTEMPTS:
+                        raise
+            response = None
+            if position > end:
+                break
+            time.sleep(self.transport.retry_policy.backoff(attempt))
+        if position <= end:
+            raise RangedDownloadError("Range " + str(segment) + " cut off too often")
+        self.transport.record_segment('download', end + 1 - segment[0], time.monotonic() - start_time)
+        progress.mark_done(segment[0])
+
+    def receive_json_file(self, response, consume):
+        """
+        Hand a (legacy) JSON file response, with the file hexed, to consume
+
+        Args:
+            response: the response with a JSON body of the file and its additional data
+            consume: called with the additional data and an iterable of the chunks of the file, see get_file
+
+        Returns:
+            the result of consume
+        """
         try:
             # should be dict of {file->file, additional_data->additional_data}
-            response_dict = json.loads(response.content)
+            response_dict = json.loads(b''.join(
+                self.limiter.throttle_download(response.iter_content(self.download_chunk_size()))))
         except JSONDecodeError:
             raise FileNotFoundError  # Bad JSON?
         if 'file' not in response_dict.keys() or 'additional_data' not in response_dict.keys():
             raise FileNotFoundError  # If the server provides garbage we throw it in the trash.
-        tmp_file_location = pl.PurePath.joinpath(globals.TEMPORARY_FOLDER, enc_file_name)
-        with open(tmp_file_location, "wb") as saveFile:  # Assume it's the file we requested.
-            saveFile.write(bytes.fromhex(response_dict['file']))
-        return tmp_file_location, response_dict['additional_data']
+        return consume(response_dict['additional_data'], [bytes.fromhex(response_dict['file'])])
+
+    def download_chunk_size(self) -> int:
+        """The bytes to read from a download at a time; small when limited, such that the server is slowed down
+        by the connection filling up instead of getting through whole chunks between pauses"""
+        return globals.BANDWIDTH_CHUNK_SIZE if self.limiter.is_limited() else globals.DOWNLOAD_CHUNK_SIZE
 
     def get_file_list(self) -> list:
         """Get a list of what files the server has
@@ -85,15 +826,54 @@ class ServComs():
         Returns:
             list: a list of lists where each sublist contains the encrypted name, the nonce and timestamp of each file
         """
-        response = requests.get('https://' + self.serverLocation + '/list_files/' + self.userID, verify=self.verify)
-        try:
-            response_dict = json.loads(response.content)
-        except JSONDecodeError:
-            raise FileNotFoundError  # TODO: Replace this error?
+        return self.request_file_list('/list_files/' + self.userID)['file_list']
+
+    def get_file_list_changes(self) -> (list, list, bool):
+        """
+        Get what has changed on the server since the last call, using the cursor the server gave back last time.
+        Servers not supporting cursors, and the first call, give the full list.
+
+        Returns:
+            list: the new or changed files, as sublists of the encrypted name, the nonce and timestamp of each file
+            list: the encrypted names of the files archived since the last call
+            bool: True if the first list is the full list of files, such that anything not in it is gone
+        """
+        path = '/list_files/' + self.userID
+        if self.list_cursor is not None:
+            path += '?since=' + str(self.list_cursor)
+        response_dict = self.request_file_list(path)
+        is_full_list = self.list_cursor is None or 'cursor' not in response_dict or response_dict.get('full', False)
+        self.list_cursor = response_dict.get('cursor', None)
+        return response_dict['file_list'], response_dict.get('archived', []), is_full_list
+
+    def request_file_list(self, path: str) -> dict:
+        """
+        Request a listing from the server, in the binary format if the server has it and otherwise in JSON.
+        Either may come compressed, as the transport accepts gzip and deflate (and zstd when installed).
+
+        Args:
+            path: the path (and query) of the listing
+
+        Returns:
+            dict: the listing, at least containing 'file_list'
+        """
+        accept = LISTING_CONTENT_TYPE + ', application/json;q=0.5' if globals.BINARY_LISTING else 'application/json'
+        response = self.request('GET', path, operation='list_files', headers={'Accept': accept}, verify=self.verify)
+        content = self.transport.read_content(response, 'list_files')  # Counts the (compressed) bytes on the wire
+        if response.headers.get('Content-Type', '').startswith(LISTING_CONTENT_TYPE):
+            try:
+                response_dict = decode_listing(content)
+            except BadListingError:
+                raise FileNotFoundError  # TODO: Replace this error?
+            self.transport.capabilities['binary_listing'] = True
+        else:
+            try:
+                response_dict = json.loads(content)
+            except JSONDecodeError:
+                raise FileNotFoundError  # TODO: Replace this error?
         if 'file_list' not in response_dict.keys():
             raise FileNotFoundError  # TODO: Replace this error?
-        enc_file_list_with_nonces_and_timestamp = response_dict['file_list']
-        return enc_file_list_with_nonces_and_timestamp
+        return response_dict
 
     def rename_file(self, enc_file_name_previous: pl.Path, new_file_path: pl.Path, new_additional_data: dict) -> None:
         """
@@ -113,8 +893,9 @@ class ServComs():
         Args:
             enc_file_name: The (encrypted) name of the file to be deleted on the server
         """
-        response = requests.post(
-            'https://' + self.serverLocation + '/archive_file/' + str(enc_file_name) + '/' + self.userID,
+        response = self.request(
+            'POST', '/archive_file/' + str(enc_file_name) + '/' + self.userID,
+            operation='archive',
             verify=self.verify
         )
         if response.status_code != 404:
@@ -122,9 +903,212 @@ class ServComs():
         else:
             print("Warning; file not on server attempted to be archived: " + enc_file_name)
 
+    def register_deletion_of_files(self, enc_file_names: list) -> list:
+        """
+        Signals to server that all the files known by the given encrypted aliases should not be considered 'live'
+        anymore. The names are sent in batches of globals.ARCHIVE_BATCH_SIZE, which are sent at the same time over the
+        pooled connections. Servers without the bulk endpoint get one request per file.
+
+        Args:
+            enc_file_names: The (encrypted) names of the files to be deleted on the server
+
+        Returns:
+            list: the names the server did not have
+        """
+        enc_file_names = [str(enc_file_name) for enc_file_name in enc_file_names]
+        batches = [enc_file_names[i:i + globals.ARCHIVE_BATCH_SIZE]
+                   for i in range(0, len(enc_file_names), globals.ARCHIVE_BATCH_SIZE)]
+        if self.transport.capabilities.get('bulk_archive', True):
+            try:
+                missing = []
+                for missing_in_batch in self.map_over_connections(self.archive_batch, batches):
+                    missing += missing_in_batch
+                return missing
+            except BulkArchiveNotSupportedError:
+                pass  # Fall back to archiving the files one by one
+        found = self.map_over_connections(self.archive_single, enc_file_names)
+        return [enc_file_name for enc_file_name, was_found in zip(enc_file_names, found) if not was_found]
+
+    def map_over_connections(self, method, arguments: list, max_parallel: int = None) -> list:
+        """
+        Call method on every argument, running as many requests at the same time as there are pooled connections
+
+        Args:
+            method: the method making a request
+            arguments: the arguments to call method with, one call for each
+            max_parallel: the most calls at the same time, if fewer than the pooled connections
+
+        Returns:
+            list: the results in the order of the arguments
+        """
+        workers = min(len(arguments), self.transport.pool_size, max_parallel or self.transport.pool_size)
+        if workers <= 1:
+            return [method(argument) for argument in arguments]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(method, arguments))
+
+    def archive_batch(self, enc_file_names: list) -> list:
+        """
+        Archive a batch of files in one request
+
+        Args:
+            enc_file_names: The (encrypted) names of the files to be deleted on the server
+
+        Returns:
+            list: the names the server did not have
+        """
+        response = self.request('POST', '/archive_files/' + self.userID,
+                                operation='archive',
+                                json={'files': enc_file_names},
+                                verify=self.verify)
+        if response.status_code in (404, 405):  # Endpoint unknown to this server
+            self.transport.capabilities['bulk_archive'] = False
+            raise BulkArchiveNotSupportedError
+        response.raise_for_status()
+        self.transport.capabilities['bulk_archive'] = True
+        missing = json.loads(response.content).get('missing', [])
+        for enc_file_name in missing:
+            print("Warning; file not on server attempted to be archived: " + enc_file_name)
+        return missing
+
+    def archive_single(self, enc_file_name: str) -> bool:
+        """
+        Archive a single file, see register_deletion_of_file
+
+        Returns:
+            bool: whether the server had the file
+        """
+        response = self.request('POST', '/archive_file/' + enc_file_name + '/' + self.userID,
+                                operation='archive', verify=self.verify)
+        if response.status_code == 404:
+            print("Warning; file not on server attempted to be archived: " + enc_file_name)
+            return False
+        response.raise_for_status()
+        return True
+
+    def set_bandwidth_limits(self, upload_rate: float = None, download_rate: float = None, schedule: list = None):
+        """
+        Limit the bandwidth used towards the server, by every ServComs for it. Takes effect for transfers under way.
+
+        Args:
+            upload_rate: the bytes per second that may be sent, None for no limit
+            download_rate: the bytes per second that may be received, None for no limit
+            schedule: other rates for certain times of the day, see BandwidthLimiter. None keeps the current schedule
+        """
+        self.limiter.set_rates(upload_rate, download_rate)
+        if schedule is not None:
+            self.limiter.set_schedule(schedule)
+
+    def get_connection_stats(self) -> dict:
+        """
+        Connection reuse counters of the transport shared with every ServComs for this server
+
+        Returns:
+            dict: see Transport.get_stats
+        """
+        return self.transport.get_stats()
+
     def register_user(self):
         """Register a new user on the server"""
-        response = requests.post('https://' + self.serverLocation + '/register/' + self.userID, verify=False)
+        response = self.transport.post('/register/' + self.userID, operation='register', verify=False)
 
         if response.status_code != 400: # User already registered
             response.raise_for_status()
+        self.set_registered(True)
+
+    def ensure_registered(self):
+        """Register the user, unless this user is known to be registered on this server (also from earlier runs)"""
+        with _registered_users_lock:
+            if self.__hash__() in get_registered_users():
+                return
+        self.register_user()
+
+    def set_registered(self, registered: bool):
+        """
+        Remember whether the user is registered on the server, on disk such that later runs need not register
+
+        Args:
+            registered: True if the user is registered
+        """
+        with _registered_users_lock:
+            registered_users = get_registered_users()
+            if registered == (self.__hash__() in registered_users):
+                return
+            if registered:
+                registered_users.add(self.__hash__())
+            else:
+                registered_users.discard(self.__hash__())
+            with open(globals.REGISTERED_USERS, "wt") as file:
+                file.write(json.dumps(sorted(registered_users)))
+
+
+class AsyncServComs:
+    """Coroutine version of ServComs. Requests run on the thread pool of the connection pool shared with ServComs"""
+
+    def __init__(self, servercoms: ServComs):
+        """
+        Args:
+            servercoms: the ServComs (server and userID) to make the requests for
+        """
+        self.servercoms = servercoms
+        self.executor = servercoms.transport.get_executor()
+
+    async def run(self, method, *args):
+        """Run a blocking ServComs method on the transport's thread pool and wait for the result"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+
+    async def send_file(self, file_path: pl.Path, additional_data: dict, source_path: pl.Path = None) -> None:
+        """See ServComs.send_file"""
+        await self.run(self.servercoms.send_file, file_path, additional_data, source_path)
+
+    async def send_encrypted_file(self, enc_file: EncryptedFile) -> None:
+        """See ServComs.send_encrypted_file"""
+        await self.run(self.servercoms.send_encrypted_file, enc_file)
+
+    async def send_ciphertext(self, ciphertext, additional_data: dict, source_path: pl.Path = None) -> None:
+        """See ServComs.send_ciphertext"""
+        await self.run(self.servercoms.send_ciphertext, ciphertext, additional_data, source_path)
+
+    async def get_file(self, enc_file_name: str, consume=None):
+        """See ServComs.get_file; consume is called in the worker thread"""
+        return await self.run(self.servercoms.get_file, enc_file_name, consume)
+
+    async def get_file_list(self) -> list:
+        """See ServComs.get_file_list"""
+        return await self.run(self.servercoms.get_file_list)
+
+    async def get_file_list_changes(self) -> (list, list, bool):
+        """See ServComs.get_file_list_changes"""
+        return await self.run(self.servercoms.get_file_list_changes)
+
+    async def register_deletion_of_file(self, enc_file_name: pl.Path):
+        """See ServComs.register_deletion_of_file"""
+        await self.run(self.servercoms.register_deletion_of_file, enc_file_name)
+
+    async def register_deletion_of_files(self, enc_file_names: list) -> list:
+        """See ServComs.register_deletion_of_files"""
+        return await self.run(self.servercoms.register_deletion_of_files, enc_file_names)
+
+    async def register_user(self):
+        """See ServComs.register_user"""
+        await self.run(self.servercoms.register_user)
+
+
+class StreamingNotSupportedError(Exception):
+    pass
+
+
+class BulkArchiveNotSupportedError(Exception):
+    pass
+
+
+class MultipartNotSupportedError(Exception):
+    pass
+
+
+class RangedDownloadError(Exception):
+    pass
+
+
+class ChunksNotSupportedError(Exception):
+    pass
@@ -1,17 +1,24 @@
+import asyncio
 import json
+import os
 import pathlib as pl
+import time
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha3_512
+from threading import RLock
 from time import sleep
 
+import requests
 from cryptography.exceptions import InvalidTag
 from watchdog.observers import Observer
 
-from ServerComs import ServComs
+from ServerComs import AsyncServComs, CiphertextBytes, ServComs
 from file_event_handler import MyHandler
+from metadata_db import get_metadata_db
 from resources import globals
 from resources.globals import FileInfo
-from security import keyderivation, secretsharing
-from security.filecryptography import FileCryptography
+from security import keyderivation, packing, secretsharing
+from security.filecryptography import FileChangedError, FileCryptography
 
 
 def hash_key_to_userID(key: bytes) -> str:
@@ -33,15 +40,25 @@ class Client:
     """class for combining different modules into client solution"""
 
     def __init__(self, username: str, password: str, server_location: str = globals.SERVER_LOCATION,
-                 file_folder: pl.Path = globals.FILE_FOLDER) -> None:
+                 file_folder: pl.Path = globals.FILE_FOLDER,
+                 connection_pool_size: int = globals.CONNECTION_POOL_SIZE,
+                 max_concurrent_transfers: int = globals.MAX_CONCURRENT_TRANSFERS,
+                 upload_rate: float = globals.UPLOAD_RATE_LIMIT, download_rate: float = globals.DOWNLOAD_RATE_LIMIT,
+                 bandwidth_schedule: list = None) -> None:
         """
         Args:
             username: the username to initialise this clients key
             password:  the password for initialising this clients key
             server_location: the location of the server to host the encrypted files
             file_folder: the main/first folder to watch for file changes
+            connection_pool_size: the amount of kept-alive connections to the server, shared by all folders
+            max_concurrent_transfers: the default amount of files the async methods transfer at the same time
+            upload_rate: the bytes per second that may be sent to the server, None for no limit
+            download_rate: the bytes per second that may be received from the server, None for no limit
+            bandwidth_schedule: other rates for certain times of the day, see network.bandwidth.BandwidthLimiter
         """
         self.server_location = server_location
+        self.max_concurrent_transfers = max_concurrent_transfers
         self.file_folder = file_folder
         self.kd = keyderivation.KeyDerivation(username)
         if self.kd.has_password():
@@ -50,9 +67,17 @@ class Client:
         else:
             raise AssertionError  # Handled by CLI now.
         self.userID = hash_key_to_userID(key)
-        self.servercoms = ServComs(server_location, self.userID)
+        self.servercoms = ServComs(server_location, self.userID, pool_size=connection_pool_size)
+        self.servercoms.set_bandwidth_limits(upload_rate, download_rate, bandwidth_schedule)
         self.folder_to_file_crypt_servercoms_dict = {"default": (self.file_crypt, self.servercoms)}
         self.folder_to_file_crypt_servercoms_dict.update(self.load_shared_keys())
+        self.server_file_dicts = {}  # folder -> {encrypted name: FileInfo}, kept up to date by update_server_file_list
+        self.server_packs = {}  # folder -> {encrypted name: Pack}, the packs of small files of the folder
+        self.repacked_packs = {}  # encrypted name of a pack repacked -> encrypted name of the pack replacing it
+        self.pack_lock = RLock()  # Held while the server file lists or packs are read or changed; never across requests
+        self.repack_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cio-repack')
+        self.metadata_db = get_metadata_db()
+        self.load_metadata()
         self.update_server_file_list()
         self.observers_list = []
         self.start_observing()
@@ -84,25 +109,91 @@ class Client:
 
         """
         file_crypt, servercoms = self.get_file_crypt_servercoms(file_path)
-        # Encrypt and send the encrypted file
-        try:
-            file_data_nonce = globals.generate_random_nonce()  # Unique
-            enc_file_path, additional_data = file_crypt.encrypt_file(
-                file_path, file_name_nonce, file_data_nonce
-            )
-            servercoms.send_file(enc_file_path, additional_data)
-        except PermissionError:
-            print("Unable to send file immediately...")
-            sleep(1)
-            self.send_file(file_path)
+        if self.is_content_unchanged(file_crypt, file_path):
+            print("File \"" + file_path.stem + "\" unchanged, not sent.")
             return
-        pl.Path.unlink(enc_file_path)  # Delete the encrypted file
+        file_name_nonce, file_data_nonce = self.get_upload_nonces(servercoms, file_path, file_name_nonce)
+        # Encrypt the file while sending it, such that no ciphertext is written to disk
+        for attempt in range(globals.SEND_FILE_ATTEMPTS):
+            try:
+                enc_file = file_crypt.open_encrypted(file_path, file_name_nonce, file_data_nonce)
+                break
+            except PermissionError:  # File in use by another program
+                if attempt + 1 == globals.SEND_FILE_ATTEMPTS:
+                    print("Unable to send file \"" + file_path.stem + "\", it is in use.")
+                    return
+                print("Unable to send file immediately...")
+                sleep(servercoms.transport.retry_policy.backoff(attempt))
+        for attempt in range(globals.SEND_FILE_ATTEMPTS):
+            try:
+                servercoms.send_encrypted_file(enc_file)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                print("Server unavailable, file \"" + file_path.stem + "\" not sent.")
+                return
+            except FileChangedError:
+                if attempt + 1 == globals.SEND_FILE_ATTEMPTS:
+                    print("File \"" + file_path.stem + "\" changed while being sent, not sent.")
+                    return
+                print("File \"" + file_path.stem + "\" changed while being sent, sending it again...")
+            # The new content is never encrypted under the nonce of the old
+            file_data_nonce = globals.generate_random_nonce()
+            try:
+                enc_file = file_crypt.open_encrypted(file_path, file_name_nonce, file_data_nonce)
+            except OSError:
+                print("Unable to send file \"" + file_path.stem + "\", it is gone or in use.")
+                return
         relative_path = file_path.relative_to(globals.WORK_DIR)
-        relative_enc_path = enc_file_path.relative_to(globals.TEMPORARY_FOLDER)
         print("File \"" + file_path.stem + "\" send successfully!")
         # Update our local version of the server files
-        fio = globals.FileInfo(relative_path, file_name_nonce, relative_enc_path.as_posix(), file_path.stat().st_mtime)
-        globals.SERVER_FILE_DICT[fio.path] = fio
+        fio = globals.FileInfo(relative_path, file_name_nonce, enc_file.additional_data['n'], file_path.stat().st_mtime)
+        self.remove_packed_version(fio)
+        self.add_server_file(fio)
+        file_crypt.content_index.record(relative_path, file_path, fio.enc_path, enc_file.additional_data['t'])
+        file_crypt.content_index.save()
+
+    def is_content_unchanged(self, file_crypt: FileCryptography, file_path: pl.Path) -> bool:
+        """
+        Whether a local file holds the same content as its version on the server, such that it need not be sent.
+        See ContentIndex.is_unchanged
+
+        Args:
+            file_crypt: the FileCryptography of the folder of the file
+            file_path: the path of the file
+
+        Returns:
+            bool: True if the file is on the server as it is
+        """
+        relative_path = file_path.relative_to(globals.WORK_DIR)
+        fio: FileInfo = globals.SERVER_FILE_DICT.get(relative_path, None)
+        if not fio:
+            return False
+        return file_crypt.content_index.is_unchanged(relative_path, file_path, fio.enc_path, fio.time_stamp)
+
+    def save_content_indexes(self):
+        """Write the content index of every folder to disk, e.g. at the end of a sync"""
+        for file_crypt, _ in self.folder_to_file_crypt_servercoms_dict.values():
+            file_crypt.content_index.save(force=True)
+
+    def get_upload_nonces(self, servercoms: ServComs, file_path: pl.Path, file_name_nonce: bytes) -> (bytes, bytes):
+        """
+        The nonces to encrypt a file under before sending it. If an earlier upload of the unchanged file was cut off,
+        its nonces are used again; encrypting gives the same ciphertext, so the upload resumes where it stopped.
+
+        Args:
+            servercoms: the servercoms the file is sent with
+            file_path: the path of the file to send
+            file_name_nonce: the nonce for the file name, if not resuming
+
+        Returns:
+            bytes: the nonce to encrypt the file name under
+            bytes: the nonce to encrypt the file data under
+        """
+        file_crypt = self.get_file_crypt_servercoms(file_path)[0]
+        additional_data = servercoms.find_resumable_upload(file_path, file_crypt.content_index.content_hash)
+        if additional_data is not None:
+            return bytes.fromhex(additional_data['nonce1']), bytes.fromhex(additional_data['nonce2'])
+        return file_name_nonce, globals.generate_random_nonce()  # Data nonce unique
 
     def get_file(self, file_name: str):
         """Encrypt the file name, and request this encrypted file from server.
@@ -116,19 +207,65 @@ class Client:
         if not fio:
             print("File not found on server")
             return
+        self.close_observers()
         try:
-            tmp_enc_file_path, additional_data = servercoms.get_file(fio.enc_path)
-            if not additional_data["n"] == fio.enc_path:
-                print("Server send wrong file back!")
-                return
+            dec_file_path = self.fetch_file(servercoms, fio, self.decrypt_download(file_crypt, fio, servercoms))
         except FileNotFoundError:
             print("File not found on server.")
             return
-        self.close_observers()
-        file_crypt.decrypt_file(tmp_enc_file_path, additional_data=additional_data)
-        pl.Path.unlink(tmp_enc_file_path)
+        finally:
+            self.start_observing()
+        if dec_file_path is None:
+            print("Server send wrong file back!")
+            return
+        file_crypt.content_index.save()
         print("File \"" + str(file_name) + "\" received successfully!")
-        self.start_observing()
+
+    def fetch_file(self, servercoms: ServComs, fio: FileInfo, consume):
+        """
+        Get a file from the server and hand it to consume, as ServComs.get_file. A file in a pack is read from its
+        range of the pack
+
+        Args:
+            servercoms: the ServComs of the folder of the file
+            fio: the FileInfo of the file
+            consume: called with the additional data and an iterable of the chunks of the file
+
+        Returns:
+            the result of consume
+        """
+        if fio.pack is None:
+            return servercoms.get_file(fio.enc_path, consume)
+        offset, length, additional_data = fio.member
+        ciphertext, _ = servercoms.get_file_range(fio.pack, offset, length)
+        return consume(additional_data, [ciphertext])
+
+    def decrypt_download(self, file_crypt: FileCryptography, fio: FileInfo, servercoms: ServComs):
+        """
+        Make the consumer given to ServComs.get_file, decrypting the file into its place as it is downloaded. Files
+        sent as chunks are put together from their chunks, fetched with servercoms. The content of the file is
+        recorded in the content index of the folder
+
+        Args:
+            file_crypt: the FileCryptography of the folder of the file
+            fio: the FileInfo of the file asked for
+            servercoms: the ServComs of the folder of the file
+
+        Returns:
+            function: taking the additional data and the ciphertext chunks, returning the path of the decrypted file
+                or None if the server sent another file than the one asked for
+        """
+        def decrypt(additional_data: dict, enc_chunks):
+            if not additional_data["n"] == fio.enc_path:
+                return None
+            if additional_data.get('m', 0):
+                dec_file_path = file_crypt.decrypt_chunked_into_place(fio.enc_path, enc_chunks, additional_data,
+                                                                      servercoms.get_chunks)
+            else:
+                dec_file_path = file_crypt.decrypt_into_place(fio.enc_path, enc_chunks, additional_data)
+            file_crypt.content_index.record(fio.path, dec_file_path, fio.enc_path, additional_data['t'])
+            return dec_file_path
+        return decrypt
 
     def delete_remote_file(self, file_rel_path: pl.Path):
         """
@@ -143,10 +280,45 @@ class Client:
             print("File/dir not on server")
             return
         globals.SERVER_FILE_DICT.pop(file_rel_path)
-        _, coms = self.get_file_crypt_servercoms(file_rel_path)
-        coms.register_deletion_of_file(fio.enc_path)
+        file_crypt, coms = self.get_file_crypt_servercoms(file_rel_path)
+        file_crypt.content_index.forget(file_rel_path)
+        if fio.pack is not None:
+            self.delete_packed_files([fio])
+        else:
+            coms.register_deletion_of_file(fio.enc_path)
+            self.remove_server_files(self.get_folder(file_rel_path), [fio.enc_path])
         print("File deleted: " + str(fio.path))
 
+    def delete_remote_files(self, file_rel_paths: list):
+        """
+        Delete many files on the server, archiving them with one (or a few) requests per folder
+
+        Args:
+            file_rel_paths: the relative paths of the files to be deleted on server
+
+        """
+        enc_names_by_folder = {}  # folder -> (servercoms, [enc names])
+        packed_fios = []  # Files in packs, noted as deleted in the list of deleted files of their pack instead
+        for file_rel_path in file_rel_paths:
+            fio: FileInfo = globals.SERVER_FILE_DICT.pop(file_rel_path, None)
+            if not fio:
+                print("File/dir not on server: " + str(file_rel_path))
+                continue
+            folder = self.get_folder(file_rel_path)
+            file_crypt, coms = self.folder_to_file_crypt_servercoms_dict[folder]
+            file_crypt.content_index.forget(file_rel_path)
+            if fio.pack is not None:
+                packed_fios.append(fio)
+            else:
+                enc_names_by_folder.setdefault(folder, (coms, []))[1].append(fio.enc_path)
+        for folder, (coms, enc_names) in enc_names_by_folder.items():
+            missing = coms.register_deletion_of_files(enc_names)
+            self.remove_server_files(folder, enc_names)
+            print("Files deleted: " + str(len(enc_names) - len(missing)))
+        if packed_fios:
+            self.delete_packed_files(packed_fios)
+            print("Files deleted from packs: " + str(len(packed_fios)))
+
     def get_file_crypt_servercoms(self, file_path: pl.Path) -> (FileCryptography, ServComs):
         """
         Look up what servercoms and filecrypt to use for the provided file path
@@ -159,25 +331,416 @@ class Client:
             ServComs: a servercoms instance with the correct userID for this file
 
         """
+        file_crypt, servercoms = self.folder_to_file_crypt_servercoms_dict[self.get_folder(file_path)]
+        return (file_crypt, servercoms)
+
+    def get_folder_key(self, folder: str) -> str:
+        """The key of a folder in the metadata database: the server and userID it is listed under"""
+        servercoms = self.folder_to_file_crypt_servercoms_dict[folder][1]
+        return servercoms.serverLocation + '/' + servercoms.userID
+
+    def load_metadata(self):
+        """Take up the server file lists kept from the last run (see MetadataDB), such that listing the server only
+        gets what changed since and no pack index is read again. Servers giving no cursors still list every file,
+        but the names are decrypted once (see FileCryptography.name_cache)"""
+        if self.metadata_db is None:
+            return
+        for folder, (filecrypt, servcoms) in self.folder_to_file_crypt_servercoms_dict.items():
+            kept = self.metadata_db.load_folder(self.get_folder_key(folder), filecrypt.metadata_aesgcm)
+            if kept is None:
+                continue
+            cursor, entries, pack_rows = kept
+            try:
+                files = {fio.enc_path: fio for fio in filecrypt.decrypt_server_file_list(entries).values()}
+            except (InvalidTag, ValueError, PermissionError):
+                continue  # Listed again from the server instead
+            packs = {}
+            for enc_name, (index, deleted, deleted_enc_name) in pack_rows.items():
+                if enc_name not in files:
+                    continue
+                pack = packing.Pack(files[enc_name], index)
+                pack.deleted, pack.deleted_fio = deleted, files.get(deleted_enc_name, None)
+                packs[enc_name] = pack
+            servcoms.list_cursor = cursor
+            with self.pack_lock:
+                self.server_file_dicts[folder] = files
+                self.server_packs[folder] = packs
+
+    def add_server_file(self, fio: FileInfo):
+        """Add a file just sent to the server file lists, and to the metadata database"""
+        globals.SERVER_FILE_DICT[fio.path] = fio
+        folder = self.get_folder(fio.path)
+        with self.pack_lock:
+            self.server_file_dicts.setdefault(folder, {})[fio.enc_path] = fio
+        if self.metadata_db is not None:
+            self.metadata_db.put_files(self.get_folder_key(folder), [fio])
+
+    def remove_server_files(self, folder: str, enc_names: list):
+        """Remove files just archived from the server file list of their folder, and from the metadata database"""
+        with self.pack_lock:
+            folder_dict = self.server_file_dicts.get(folder, {})
+            for enc_name in enc_names:
+                folder_dict.pop(enc_name, None)
+        if self.metadata_db is not None:
+            self.metadata_db.remove_files(self.get_folder_key(folder), enc_names)
+
+    def get_folder(self, file_path: pl.Path) -> str:
+        """The folder of the provided file path, as in folder_to_file_crypt_servercoms_dict"""
         if file_path.is_absolute():
             rel_path = file_path.relative_to(globals.WORK_DIR)
         else:
             rel_path = file_path
-        folder_name = pl.Path(rel_path.parts[0]) / rel_path.parts[1]
-        file_crypt, servercoms = self.folder_to_file_crypt_servercoms_dict.get(
-            folder_name.as_posix(),
-            self.folder_to_file_crypt_servercoms_dict.get("default")
-        )
-        return (file_crypt, servercoms)
+        folder_name = (pl.Path(rel_path.parts[0]) / rel_path.parts[1]).as_posix()
+        return folder_name if folder_name in self.folder_to_file_crypt_servercoms_dict else "default"
 
     def update_server_file_list(self):
-        """Get the filelist from server, decrypt and set globals server file list"""
+        """Get what changed in the filelist on the server, decrypt it and update globals server file list"""
+        for folder, (filecrypt, servcoms) in list(self.folder_to_file_crypt_servercoms_dict.items()):
+            self.merge_server_file_list_changes(folder, filecrypt, *servcoms.get_file_list_changes())
+            self.load_packs(folder, filecrypt, servcoms)
+        self.combine_server_file_lists()
+
+    def merge_server_file_list_changes(self, folder: str, filecrypt: FileCryptography, changed_files: list,
+                                       archived_files: list, is_full_list: bool):
+        """
+        Merge the changes of the filelist of one folder into what we know of it
+
+        Args:
+            folder: the folder the changes are for, as in folder_to_file_crypt_servercoms_dict
+            filecrypt: the filecrypt to decrypt the file names of the folder
+            changed_files: the new or changed files, see ServComs.get_file_list_changes
+            archived_files: the encrypted names of the files archived
+            is_full_list: True if changed_files is all files of the folder
+        """
+        fios = list(filecrypt.decrypt_server_file_list(changed_files).values())
+        with self.pack_lock:
+            folder_dict = {} if is_full_list else self.server_file_dicts.get(folder, {})
+            for enc_file_name in archived_files:
+                folder_dict.pop(enc_file_name, None)
+            for fio in fios:
+                folder_dict[fio.enc_path] = fio
+            self.server_file_dicts[folder] = folder_dict
+        if self.metadata_db is not None:
+            self.metadata_db.apply_changes(self.get_folder_key(folder), fios, archived_files, is_full_list,
+                                           self.folder_to_file_crypt_servercoms_dict[folder][1].list_cursor)
+
+    def combine_server_file_lists(self):
+        """Set globals server file list from the filelists of all folders"""
         combined_dict = {}
-        for filecrypt, servcoms in self.folder_to_file_crypt_servercoms_dict.values():
-            server_file_list = servcoms.get_file_list()
-            combined_dict.update(filecrypt.decrypt_server_file_list(server_file_list))
+        for folder in list(self.folder_to_file_crypt_servercoms_dict):
+            with self.pack_lock:  # The repacking thread changes them
+                fios = list(self.server_file_dicts.get(folder, {}).values())
+                member_infos = [pack.member_infos() for pack in self.server_packs.get(folder, {}).values()]
+            for fio in fios:
+                if not packing.is_pack_path(fio.path):
+                    combined_dict[fio.path] = fio
+            for pack_member_infos in member_infos:
+                for fio in pack_member_infos:
+                    current = combined_dict.get(fio.path, None)
+                    if current is None or fio.time_stamp > current.time_stamp:
+                        combined_dict[fio.path] = fio
         globals.SERVER_FILE_DICT = combined_dict
 
+    def load_packs(self, folder: str, filecrypt: FileCryptography, servcoms: ServComs):
+        """
+        Read the index of every pack of a folder not read before, and the lists of deleted files of the packs that
+        changed, as given by the filelist of the folder. Packs that can not be read are left out.
+        The packs are read without holding the pack lock; packs this client sent, repacked or noted deletions in
+        meanwhile are kept as they are
+
+        Args:
+            folder: the folder, as in folder_to_file_crypt_servercoms_dict
+            filecrypt: the filecrypt of the folder
+            servcoms: the servercoms of the folder
+        """
+        with self.pack_lock:
+            known_packs = dict(self.server_packs.get(folder, {}))
+            known_deleted_fios = {enc_name: pack.deleted_fio for enc_name, pack in known_packs.items()}
+            fios = list(self.server_file_dicts.get(folder, {}).values())
+        packs = {}  # relative path -> Pack
+        new_packs = []  # Packs read now
+        deleted_lists = {}  # relative path of the pack -> FileInfo of its list of deleted files
+        for fio in fios:
+            if not packing.is_pack_path(fio.path):
+                continue
+            if fio.path.name.endswith(packing.DELETED_SUFFIX):
+                deleted_lists[fio.path.with_name(fio.path.name[:-len(packing.DELETED_SUFFIX)])] = fio
+                continue
+            pack = known_packs.get(fio.enc_path, None)
+            if pack is None:
+                try:
+                    index, additional_data = packing.read_pack_index(
+                        filecrypt, lambda offset, length: servcoms.get_file_range(fio.enc_path, offset, length))
+                    if additional_data['n'] != fio.enc_path:
+                        raise InvalidTag
+                except (FileNotFoundError, InvalidTag, KeyError, ValueError):
+                    print("Unable to read pack \"" + fio.path.name + "\", its files are left out.")
+                    continue
+                pack = packing.Pack(fio, index)
+                new_packs.append(pack)
+            packs[fio.path] = pack
+        deleted_changes = {}  # encrypted name of a pack -> its deleted files and the FileInfo of their list
+        for pack_path, pack in packs.items():
+            deleted_fio = deleted_lists.get(pack_path, None)
+            known_deleted_fio = known_deleted_fios.get(pack.fio.enc_path, None)
+            if deleted_fio is None:
+                if known_deleted_fio is not None:
+                    deleted_changes[pack.fio.enc_path] = set(), None
+            elif known_deleted_fio is None or known_deleted_fio.enc_path != deleted_fio.enc_path \
+                    or known_deleted_fio.time_stamp != deleted_fio.time_stamp:
+                try:
+                    deleted_changes[pack.fio.enc_path] = self.fetch_deleted_list(filecrypt, servcoms, deleted_fio), \
+                        deleted_fio
+                except (FileNotFoundError, InvalidTag, KeyError, ValueError):
+                    print("Unable to read the deleted files of pack \"" + pack_path.name + "\".")
+        with self.pack_lock:
+            current_packs = self.server_packs.get(folder, {})
+            server_packs = {}
+            for pack in packs.values():
+                enc_name = pack.fio.enc_path
+                if enc_name in known_packs and enc_name not in current_packs:
+                    continue  # Repacked meanwhile
+                server_packs[enc_name] = current_packs.get(enc_name, pack)
+            for enc_name, pack in current_packs.items():
+                if enc_name not in known_packs:
+                    server_packs.setdefault(enc_name, pack)  # Sent meanwhile
+            changed_packs = [pack for pack in new_packs if server_packs.get(pack.fio.enc_path, None) is pack]
+            for enc_name, (deleted, deleted_fio) in deleted_changes.items():
+                pack = server_packs.get(enc_name, None)
+                if pack is None or pack.deleted_fio is not known_deleted_fios.get(enc_name, None):
+                    continue  # Its list of deleted files was sent meanwhile
+                pack.deleted, pack.deleted_fio = deleted, deleted_fio
+                if pack not in changed_packs:
+                    changed_packs.append(pack)
+            self.server_packs[folder] = server_packs
+            if self.metadata_db is not None:
+                self.metadata_db.remove_packs(self.get_folder_key(folder), [enc_name for enc_name in known_packs
+                                                                            if enc_name not in server_packs])
+                self.metadata_db.put_packs(self.get_folder_key(folder), filecrypt.metadata_aesgcm, changed_packs)
+
+    def fetch_deleted_list(self, file_crypt: FileCryptography, servercoms: ServComs, fio: FileInfo) -> set:
+        """The relative paths (posix) in the list of deleted files of a pack, see send_deleted_list"""
+        def read(additional_data: dict, enc_chunks):
+            if additional_data['n'] != fio.enc_path:
+                raise InvalidTag
+            return set(json.loads(b''.join(file_crypt.decrypt_stream(enc_chunks, additional_data))))
+        return servercoms.get_file(fio.enc_path, read)
+
+    def new_pack_path(self, folder: str) -> pl.Path:
+        """A new relative path to name a pack of the folder by"""
+        folder_path = globals.FILE_FOLDER.relative_to(globals.WORK_DIR) if folder == "default" else pl.Path(folder)
+        return folder_path / packing.PACK_FOLDER / os.urandom(8).hex()
+
+    def send_pack(self, file_crypt: FileCryptography, servercoms: ServComs, files: list):
+        """
+        Send many small files of one folder, already encrypted, together in one pack: one object on the server and
+        one upload instead of one per file. Older versions of the files on the server are deleted
+
+        Args:
+            file_crypt: the FileCryptography of the folder
+            servercoms: the ServComs of the folder
+            files: (file path, (ciphertext, additional data)) of every file, as given by FileCryptography.encrypt_many
+        """
+        folder = self.get_folder(files[0][0])
+        relative_paths = [file_path.relative_to(globals.WORK_DIR) for file_path, _ in files]
+        try:
+            pack = self.upload_pack(folder, file_crypt, servercoms, self.new_pack_path(folder),
+                                    [(relative_path, ciphertext, additional_data) for relative_path, (_, (
+                                        ciphertext, additional_data)) in zip(relative_paths, files)])
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            print("Server unavailable, " + str(len(files)) + " files not sent.")
+            return
+        print(str(len(files)) + " files send successfully in one pack!")
+        replaced = []
+        for fio in pack.member_infos():
+            replaced.append(globals.SERVER_FILE_DICT.get(fio.path, None))
+            globals.SERVER_FILE_DICT[fio.path] = fio
+        for relative_path, (file_path, (_, additional_data)) in zip(relative_paths, files):
+            file_crypt.content_index.record(relative_path, file_path, additional_data['n'], additional_data['t'])
+        # The files keep their encrypted names, so the versions replaced are those of the same name
+        replaced = [old_fio for old_fio, fio in zip(replaced, pack.member_infos())
+                    if old_fio is not None and old_fio.enc_path == fio.enc_path]
+        enc_names = [old_fio.enc_path for old_fio in replaced if old_fio.pack is None]
+        if enc_names:
+            servercoms.register_deletion_of_files(enc_names)
+            self.remove_server_files(folder, enc_names)
+        self.delete_packed_files([old_fio for old_fio in replaced if old_fio.pack is not None])
+
+    def upload_pack(self, folder: str, file_crypt: FileCryptography, servercoms: ServComs, pack_path: pl.Path,
+                    members: list) -> packing.Pack:
+        """
+        Put encrypted files together in a pack (see packing.build_pack) and send it
+
+        Args:
+            folder: the folder of the files, as in folder_to_file_crypt_servercoms_dict
+            file_crypt: the FileCryptography of the folder
+            servercoms: the ServComs of the folder
+            pack_path: the relative path to name the pack by
+            members: (relative path, ciphertext, additional data) of every file
+
+        Returns:
+            Pack: the pack sent
+        """
+        content, additional_data, index = packing.build_pack(file_crypt, pack_path, members)
+        servercoms.send_ciphertext(CiphertextBytes(content), additional_data)
+        pack = packing.Pack(FileInfo(pack_path, bytes.fromhex(additional_data['nonce1']), additional_data['n'],
+                                     additional_data['t']), index)
+        with self.pack_lock:
+            self.server_packs.setdefault(folder, {})[pack.fio.enc_path] = pack
+            self.server_file_dicts.setdefault(folder, {})[pack.fio.enc_path] = pack.fio
+            if self.metadata_db is not None:
+                self.metadata_db.put_packs(self.get_folder_key(folder), file_crypt.metadata_aesgcm, [pack])
+        return pack
+
+    def remove_packed_version(self, fio: FileInfo):
+        """Delete the version of a file in a pack, if the server file list has it, now that a version of the same
+        encrypted name is sent on its own"""
+        old_fio: FileInfo = globals.SERVER_FILE_DICT.get(fio.path, None)
+        if old_fio is not None and old_fio.pack is not None and old_fio.enc_path == fio.enc_path:
+            self.delete_packed_files([old_fio])
+
+    def delete_packed_files(self, fios: list):
+        """
+        Delete files in packs, by noting them in the list of deleted files of their pack. Packs with enough files
+        deleted are repacked in the background (see repack)
+
+        Args:
+            fios: the FileInfo of every file, telling its pack
+        """
+        paths_by_pack = {}  # encrypted name of the pack -> [relative paths]
+        for fio in fios:
+            paths_by_pack.setdefault(fio.pack, []).append(fio.path)
+        for pack_enc_name, rel_paths in paths_by_pack.items():
+            folder = self.get_folder(rel_paths[0])
+            file_crypt, servercoms = self.folder_to_file_crypt_servercoms_dict[folder]
+            pack = self.lock_pack(folder, pack_enc_name)
+            if pack is None:
+                continue
+            try:
+                with self.pack_lock:
+                    pack.deleted.update(rel_path.as_posix() for rel_path in rel_paths)
+                try:
+                    self.send_deleted_list(folder, file_crypt, servercoms, pack)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    print("Server unavailable, deletion of " + str(len(rel_paths)) + " files in a pack not sent.")
+                    continue
+                if pack.needs_repack():
+                    self.repack_executor.submit(self.repack, folder, pack.fio.enc_path)
+            finally:
+                pack.send_lock.release()
+
+    def lock_pack(self, folder: str, pack_enc_name: str) -> packing.Pack:
+        """
+        Acquire the send_lock of a pack, waiting for a list of its deleted files being sent or it being repacked
+
+        Args:
+            folder: the folder of the pack, as in folder_to_file_crypt_servercoms_dict
+            pack_enc_name: the encrypted name of the pack, or of a pack it was repacked from
+
+        Returns:
+            Pack: the pack, its send_lock held by the caller; None if the pack is gone
+        """
+        while True:
+            with self.pack_lock:
+                while pack_enc_name in self.repacked_packs:  # Repacked since the file list was made
+                    pack_enc_name = self.repacked_packs[pack_enc_name]
+                pack = self.server_packs.get(folder, {}).get(pack_enc_name, None)
+            if pack is None:
+                return None
+            pack.send_lock.acquire()
+            with self.pack_lock:
+                if self.server_packs.get(folder, {}).get(pack_enc_name, None) is pack:
+                    return pack
+            pack.send_lock.release()  # Repacked or dropped while waiting
+
+    def send_deleted_list(self, folder: str, file_crypt: FileCryptography, servercoms: ServComs,
+                          pack: packing.Pack):
+        """
+        Send the list of deleted files of a pack, next to the pack on the server, replacing the one sent before.
+        Call holding the send_lock of the pack (see lock_pack), such that the lists are sent in the order made
+
+        Args:
+            folder: the folder of the pack, as in folder_to_file_crypt_servercoms_dict
+            file_crypt: the FileCryptography of the folder
+            servercoms: the ServComs of the folder
+            pack: the pack, with its deleted files
+        """
+        with self.pack_lock:
+            content = bytes(json.dumps(sorted(pack.deleted)), 'utf-8')
+            name_nonce = pack.deleted_fio.nonce if pack.deleted_fio else globals.generate_random_nonce()
+        deleted_path = packing.deleted_list_path(pack.fio.path)
+        additional_data = file_crypt.create_additional_data(
+            pl.Path.joinpath(globals.WORK_DIR, deleted_path), name_nonce, globals.generate_random_nonce(), time.time(),
+            content[:globals.COMPRESSION_SAMPLE_SIZE])
+        servercoms.send_ciphertext(CiphertextBytes(file_crypt.encrypt_bytes(content, additional_data)), additional_data)
+        with self.pack_lock:
+            pack.deleted_fio = FileInfo(deleted_path, name_nonce, additional_data['n'], additional_data['t'])
+            self.server_file_dicts.setdefault(folder, {})[pack.deleted_fio.enc_path] = pack.deleted_fio
+            if self.metadata_db is not None:
+                self.metadata_db.put_packs(self.get_folder_key(folder), file_crypt.metadata_aesgcm, [pack])
+
+    def repack(self, folder: str, pack_enc_name: str):
+        """
+        Replace a pack with many files deleted by a pack of the files left, then delete the old pack. The ciphertext
+        of the files is copied as it is, nothing is decrypted. Run in the background by delete_packed_files.
+        Deletions in the pack wait for the repack (see lock_pack), other packs and the file lists do not
+
+        Args:
+            folder: the folder of the pack, as in folder_to_file_crypt_servercoms_dict
+            pack_enc_name: the encrypted name of the pack
+        """
+        pack = self.lock_pack(folder, pack_enc_name)
+        if pack is None:
+            return
+        pack_enc_name = pack.fio.enc_path
+        try:
+            with self.pack_lock:
+                if not pack.needs_repack():
+                    return
+                live_members = pack.live_members()
+                deleted_count = len(pack.deleted)
+                old_enc_names = [pack_enc_name] + ([pack.deleted_fio.enc_path] if pack.deleted_fio else [])
+            file_crypt, servercoms = self.folder_to_file_crypt_servercoms_dict[folder]
+            new_pack = None
+            try:
+                if live_members:
+                    first = min(offset for _, offset, _, _ in live_members)
+                    end = max(offset + length for _, offset, length, _ in live_members)
+                    content, _ = servercoms.get_file_range(pack_enc_name, first, end - first)
+                    new_pack = self.upload_pack(folder, file_crypt, servercoms, self.new_pack_path(folder),
+                                                [(pl.Path(rel_path), content[offset - first:offset - first + length],
+                                                  additional_data)
+                                                 for rel_path, offset, length, additional_data in live_members])
+                servercoms.register_deletion_of_files(old_enc_names)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, FileNotFoundError):
+                print("Unable to repack pack \"" + pack.fio.path.name + "\", tried again at the next deletion.")
+                return
+            with self.pack_lock:
+                self.server_packs[folder].pop(pack_enc_name, None)
+                if new_pack is not None:
+                    self.repacked_packs[pack_enc_name] = new_pack.fio.enc_path
+                    for fio in new_pack.member_infos():
+                        old_fio = globals.SERVER_FILE_DICT.get(fio.path, None)
+                        if old_fio is not None and old_fio.pack == pack_enc_name:
+                            globals.SERVER_FILE_DICT[fio.path] = fio
+            self.remove_server_files(folder, old_enc_names)
+            if self.metadata_db is not None:
+                self.metadata_db.remove_packs(self.get_folder_key(folder), [pack_enc_name])
+        finally:
+            pack.send_lock.release()
+        print("Repacked " + str(len(live_members)) + " files, " + str(deleted_count) + " deleted files dropped.")
+
+    def set_bandwidth_limits(self, upload_rate: float = None, download_rate: float = None, schedule: list = None):
+        """
+        Limit the bandwidth used for all folders, also for transfers under way. See ServComs.set_bandwidth_limits
+
+        Args:
+            upload_rate: the bytes per second that may be sent, None for no limit
+            download_rate: the bytes per second that may be received, None for no limit
+            schedule: other rates for certain times of the day. None keeps the current schedule
+        """
+        self.servercoms.set_bandwidth_limits(upload_rate, download_rate, schedule)
+
     def create_shared_folder(self, folder_name: pl.Path, key: bytes):
         """
         Create a new folder to be shared and save its assosiated filecrypt and servercoms for later use
@@ -200,8 +763,27 @@ class Client:
 
     def get_local_file_list(self):
         """Return a list where each element is the string name of this file"""
-        file_list = [i.relative_to(globals.WORK_DIR) for i in globals.FILE_FOLDER.glob("**/*.*")]
-        return file_list
+        return list(self.scan_local_files())
+
+    def scan_local_files(self) -> dict:
+        """
+        Walk the file folder once, taking the modification time of every file from its directory entry. Files being
+        decrypted into place (globals.PARTIAL_FILE_SUFFIX), e.g. left behind by a crash, are not local files
+
+        Returns:
+            dict: the relative path -> modification time of every local file
+        """
+        file_times = {}
+        folders = [globals.FILE_FOLDER]
+        while folders:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif '.' in entry.name and not entry.name.endswith(globals.PARTIAL_FILE_SUFFIX) \
+                            and entry.is_file():
+                        file_times[pl.Path(entry.path).relative_to(globals.WORK_DIR)] = entry.stat().st_mtime
+        return file_times
 
     def sync_files(self):
         """Sync files between server and client based on what file is the most recent"""
@@ -219,8 +801,219 @@ class Client:
                 self.get_file(rel_file_path)
             elif c_time > s_time:  # Client has the newest version
                 self.send_file(file_path)
+        self.save_content_indexes()
         self.start_observing()
 
+    async def send_file_async(self, file_path: pl.Path, file_name_nonce: bytes = None) -> None:
+        """
+        Coroutine version of send_file. The file is encrypted while uploaded, on the connection pool
+
+        Args:
+            file_path: the path of the file to send
+            file_name_nonce: if provided, the nonce to encrypt the file name under (see send_file). Otherwise a new nonce
+        """
+        if file_name_nonce is None:
+            file_name_nonce = globals.generate_random_nonce()
+        file_crypt, servercoms = self.get_file_crypt_servercoms(file_path)
+        if await asyncio.get_running_loop().run_in_executor(None, self.is_content_unchanged, file_crypt, file_path):
+            print("File \"" + file_path.stem + "\" unchanged, not sent.")
+            return
+        file_name_nonce, file_data_nonce = await asyncio.get_running_loop().run_in_executor(
+            None, self.get_upload_nonces, servercoms, file_path, file_name_nonce)
+        enc_file = await asyncio.get_running_loop().run_in_executor(
+            None, file_crypt.open_encrypted, file_path, file_name_nonce, file_data_nonce)
+        await AsyncServComs(servercoms).send_encrypted_file(enc_file)
+        relative_path = file_path.relative_to(globals.WORK_DIR)
+        print("File \"" + file_path.stem + "\" send successfully!")
+        fio = globals.FileInfo(relative_path, file_name_nonce, enc_file.additional_data['n'], file_path.stat().st_mtime)
+        await asyncio.get_running_loop().run_in_executor(None, self.remove_packed_version, fio)
+        await asyncio.get_running_loop().run_in_executor(None, self.add_server_file, fio)
+        await asyncio.get_running_loop().run_in_executor(
+            None, file_crypt.content_index.record, relative_path, file_path, fio.enc_path,
+            enc_file.additional_data['t'])
+
+    async def send_files_async(self, file_paths: list, max_concurrent: int = None) -> None:
+        """
+        Send many files, up to max_concurrent at a time
+
+        Args:
+            file_paths: the paths of the files to send
+            max_concurrent: the amount of files transferred at the same time (default=self.max_concurrent_transfers)
+        """
+        semaphore = asyncio.Semaphore(max_concurrent or self.max_concurrent_transfers)
+
+        async def send(file_path: pl.Path, file_name_nonce: bytes, encrypted):
+            async with semaphore:
+                if encrypted is None:  # Too big for a batch
+                    await self.send_file_async(file_path, file_name_nonce)
+                elif isinstance(encrypted, Exception):
+                    print("Unable to send file \"" + file_path.stem + "\": " + str(encrypted))
+                else:
+                    await self.send_ciphertext_async(file_path, file_name_nonce, *encrypted)
+
+        def get_batches() -> dict:
+            """The files changed since last sent, by folder. Reads (and hashes) every file, so not on the event loop"""
+            batches = {}  # One per folder; ServComs hashes to a str, so the objects themselves can not be keys
+            for file_path in file_paths:
+                file_crypt, servercoms = self.get_file_crypt_servercoms(file_path)
+                if self.is_content_unchanged(file_crypt, file_path):
+                    print("File \"" + file_path.stem + "\" unchanged, not sent.")
+                    continue
+                batches.setdefault((id(file_crypt), id(servercoms)), (file_crypt, servercoms, []))[2].append(file_path)
+            return batches
+
+        def get_nonces(servercoms: ServComs, batch_paths: list) -> list:
+            """The path and upload nonces of every file of a batch. Reads the upload journal, so not on the event loop"""
+            files = []
+            for file_path in batch_paths:
+                fio = globals.SERVER_FILE_DICT.get(file_path.relative_to(globals.WORK_DIR), None)
+                file_name_nonce = fio.nonce if fio else globals.generate_random_nonce()  # Keep name if on server
+                files.append((file_path,) + self.get_upload_nonces(servercoms, file_path, file_name_nonce))
+            return files
+
+        # Small files are encrypted in batches spread over the cores, a batch at a time to bound the memory used
+        batches = await asyncio.get_running_loop().run_in_executor(None, get_batches)
+        for file_crypt, servercoms, batch_paths in batches.values():
+            # The smallest files are gathered into packs (see send_pack), sent once full or all files are encrypted
+            pack_files, pack_size = [], 0
+            for start in range(0, len(batch_paths), globals.ENCRYPTION_BATCH_SIZE):
+                files = await asyncio.get_running_loop().run_in_executor(
+                    None, get_nonces, servercoms, batch_paths[start:start + globals.ENCRYPTION_BATCH_SIZE])
+                encrypted_files = await asyncio.get_running_loop().run_in_executor(None, file_crypt.encrypt_many, files)
+                sends = []
+                for (file_path, file_name_nonce, _), encrypted in zip(files, encrypted_files):
+                    if not self.is_packable(encrypted):
+                        sends.append(send(file_path, file_name_nonce, encrypted))
+                        continue
+                    if pack_size + len(encrypted[0]) > globals.PACK_MAX_SIZE:
+                        await asyncio.get_running_loop().run_in_executor(None, self.send_pack, file_crypt, servercoms,
+                                                                         pack_files)
+                        pack_files, pack_size = [], 0
+                    pack_files.append((file_path, encrypted))
+                    pack_size += len(encrypted[0])
+                await asyncio.gather(*sends)
+            if len(pack_files) >= globals.PACK_MIN_FILES:
+                await asyncio.get_running_loop().run_in_executor(None, self.send_pack, file_crypt, servercoms,
+                                                                 pack_files)
+            else:  # Too few to be worth a pack
+                await asyncio.gather(*[send(file_path, bytes.fromhex(encrypted[1]['nonce1']), encrypted)
+                                       for file_path, encrypted in pack_files])
+        await asyncio.get_running_loop().run_in_executor(None, self.save_content_indexes)
+
+    def is_packable(self, encrypted) -> bool:
+        """Whether a file encrypted by FileCryptography.encrypt_many is small enough to be sent in a pack"""
+        return globals.PACK_SMALL_FILES and globals.ENCRYPTION_FORMAT_VERSION >= 2 and isinstance(encrypted, tuple) \
+            and len(encrypted[0]) <= globals.PACK_MAX_FILE_SIZE
+
+    async def send_ciphertext_async(self, file_path: pl.Path, file_name_nonce: bytes, ciphertext: bytes,
+                                    additional_data: dict) -> None:
+        """
+        Send a file already encrypted in memory, e.g. by FileCryptography.encrypt_many
+
+        Args:
+            file_path: the path of the file sent
+            file_name_nonce: the nonce the file name is encrypted under
+            ciphertext: the encrypted file
+            additional_data: the additional data of the encrypted file
+        """
+        file_crypt, servercoms = self.get_file_crypt_servercoms(file_path)
+        await AsyncServComs(servercoms).send_ciphertext(CiphertextBytes(ciphertext), additional_data, file_path)
+        relative_path = file_path.relative_to(globals.WORK_DIR)
+        print("File \"" + file_path.stem + "\" send successfully!")
+        fio = globals.FileInfo(relative_path, file_name_nonce, additional_data['n'], additional_data['t'])
+        await asyncio.get_running_loop().run_in_executor(None, self.remove_packed_version, fio)
+        await asyncio.get_running_loop().run_in_executor(None, self.add_server_file, fio)
+        await asyncio.get_running_loop().run_in_executor(
+            None, file_crypt.content_index.record, relative_path, file_path, fio.enc_path, additional_data['t'])
+
+    async def get_file_async(self, file_name: pl.Path) -> None:
+        """
+        Coroutine version of get_file, leaving the observers alone (the caller should close them)
+
+        Args:
+            file_name: the un-encrypted (relative) name of the file to request from the server
+        """
+        file_crypt, servercoms = self.get_file_crypt_servercoms(file_name)
+        fio: FileInfo = globals.SERVER_FILE_DICT.get(file_name, None)
+        if not fio:
+            print("File not found on server")
+            return
+        try:
+            dec_file_path = await AsyncServComs(servercoms).run(self.fetch_file, servercoms, fio,
+                                                                self.decrypt_download(file_crypt, fio, servercoms))
+        except FileNotFoundError:
+            print("File not found on server.")
+            return
+        if dec_file_path is None:
+            print("Server send wrong file back!")
+            return
+        print("File \"" + str(file_name) + "\" received successfully!")
+
+    async def get_files_async(self, file_names: list, max_concurrent: int = None) -> None:
+        """
+        Get many files from the server, up to max_concurrent at a time
+
+        Args:
+            file_names: the un-encrypted (relative) names of the files to get
+            max_concurrent: the amount of files transferred at the same time (default=self.max_concurrent_transfers)
+        """
+        semaphore = asyncio.Semaphore(max_concurrent or self.max_concurrent_transfers)
+
+        async def get(file_name: pl.Path):
+            async with semaphore:
+                await self.get_file_async(file_name)
+
+        self.close_observers()
+        try:
+            await asyncio.gather(*[get(file_name) for file_name in file_names])
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, self.save_content_indexes)
+            self.start_observing()
+
+    async def update_server_file_list_async(self):
+        """Coroutine version of update_server_file_list, getting the file lists of all folders at the same time"""
+        folders = list(self.folder_to_file_crypt_servercoms_dict.items())
+        changes = await asyncio.gather(*[AsyncServComs(servcoms).get_file_list_changes()
+                                         for _, (_, servcoms) in folders])
+        for (folder, (filecrypt, servcoms)), folder_changes in zip(folders, changes):
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.merge_server_file_list_changes, folder, filecrypt, *folder_changes)
+            await AsyncServComs(servcoms).run(self.load_packs, folder, filecrypt, servcoms)
+        self.combine_server_file_lists()
+
+    async def sync_files_async(self, max_concurrent: int = None):
+        """
+        Coroutine version of sync_files, syncing up to max_concurrent files at a time
+
+        Args:
+            max_concurrent: the amount of files transferred at the same time (default=self.max_concurrent_transfers)
+        """
+        await self.update_server_file_list_async()
+        sync_dict = self.generate_sync_dict(update_server_file_list=False)
+        semaphore = asyncio.Semaphore(max_concurrent or self.max_concurrent_transfers)
+
+        async def sync(rel_file_path: pl.Path, c_time: float, s_time: float):
+            file_path = pl.Path.joinpath(globals.WORK_DIR, rel_file_path)
+            async with semaphore:
+                if c_time < s_time:  # Server has the newest version
+                    # Send and delete file locally, such that the client can recover it if needed
+                    if file_path.exists():
+                        server_fio = globals.SERVER_FILE_DICT.get(rel_file_path)
+                        await self.send_file_async(file_path)
+                        file_path.unlink()
+                        globals.SERVER_FILE_DICT[rel_file_path] = server_fio  # Get the server's version, not ours
+                    await self.get_file_async(rel_file_path)
+                elif c_time > s_time:  # Client has the newest version
+                    fio = globals.SERVER_FILE_DICT.get(rel_file_path, None)
+                    await self.send_file_async(file_path, fio.nonce if fio else None)
+
+        self.close_observers()
+        try:
+            await asyncio.gather(*[sync(file_path, *times) for file_path, times in sync_dict.items()])
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, self.save_content_indexes)
+            self.start_observing()
+
     def close_observers(self):
         """Close all observers observing a folder, thus ignoring all file events"""
         for observer in self.observers_list:
@@ -298,23 +1091,31 @@ class Client:
         # Sync to ensure all files are encrypted on the server under the new password
         self.sync_files()
 
-    def generate_sync_dict(self):
+    def generate_sync_dict(self, update_server_file_list: bool = True):
         """Generates a dictionary with key:files value:(client_time, server_time)
-        representing the time stamp of a file for client or server. time stamp 0 = this party does not have the file"""
+        representing the time stamp of a file for client or server. time stamp 0 = this party does not have the file
+
+        Args:
+            update_server_file_list: whether to get the server file list first, or use the current one
+        """
         # Create a dictionary with key = file name, value = timestamp for local files
-        local_file_list = self.get_local_file_list()
-        c_dict = {}
-        for element in local_file_list:
-            c_dict[element] = pl.Path.joinpath(globals.WORK_DIR, element).stat().st_mtime
+        c_dict = self.scan_local_files()
 
         # Do the same for server files:
-        self.update_server_file_list()
+        if update_server_file_list:
+            self.update_server_file_list()
         s_dict = {}
 
         file_info_object: globals.FileInfo
         for file_info_object in globals.SERVER_FILE_DICT.values():
             s_dict[file_info_object.path] = file_info_object.time_stamp
 
+        # Files saved again with the content they have on the server are not newer, whatever their time stamp
+        for key, c_time in c_dict.items():
+            if key in s_dict and c_time != s_dict[key] and self.is_content_unchanged(
+                    self.get_file_crypt_servercoms(key)[0], pl.Path.joinpath(globals.WORK_DIR, key)):
+                c_dict[key] = s_dict[key]
+
         # Copy the client dict, and add the uniques from the server dict.
         # Value = 0 since this means the client does not have this file, thus setting a timestamp of as old as possible
         full_dict = c_dict.copy()
@@ -36,7 +36,8 @@ class MyHandler(FileSystemEventHandler):
             event:a FileSystemEvent created by the OS.
         """
         file_path = pl.Path(event.src_path)
-        if file_path.is_dir() or file_path.name.startswith(".goutputstream-"):
+        if file_path.is_dir() or file_path.name.startswith(".goutputstream-") \
+                or file_path.name.endswith(globals.PARTIAL_FILE_SUFFIX):
             return
         relative_file_path = file_path.relative_to(globals.WORK_DIR)
         print("File created: " + str(relative_file_path))
@@ -57,14 +58,16 @@ class MyHandler(FileSystemEventHandler):
         """
         abs_path = pl.Path(event.src_path)
         if isinstance(event, DirDeletedEvent) or (platform.system() == "Windows" and abs_path.suffix == ""):
-            server_dict_copy = globals.SERVER_FILE_DICT.copy()
-            for filePath in server_dict_copy.keys():
+            rel_path = pl.Path.relative_to(abs_path, globals.WORK_DIR)
+            files_in_dir = []
+            for filePath in list(globals.SERVER_FILE_DICT.keys()):
                 try:
-                    rel_path = pl.Path.relative_to(abs_path, globals.WORK_DIR)
                     filePath.relative_to(rel_path)
-                    self.client.delete_remote_file(filePath)
+                    files_in_dir.append(filePath)
                 except ValueError:
                     pass
+            if files_in_dir:
+                self.client.delete_remote_files(files_in_dir)  # Archive the whole dir in one go
         if abs_path.name.startswith(".goutputstream-"):
             return
         relative_path = abs_path.relative_to(globals.WORK_DIR)
@@ -80,7 +83,8 @@ class MyHandler(FileSystemEventHandler):
         """
         cur_time = time.time()
         file_path = pl.Path(event.src_path)
-        if file_path.is_dir() or not file_path.is_file() or file_path.name.startswith(".goutputstream-"):
+        if file_path.is_dir() or not file_path.is_file() or file_path.name.startswith(".goutputstream-") \
+                or file_path.name.endswith(globals.PARTIAL_FILE_SUFFIX):
             return
         relative_file_path = file_path.relative_to(globals.WORK_DIR)
         if relative_file_path in self.new_files:
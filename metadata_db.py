@@ -0,0 +1,185 @@
+import json
+import pathlib as pl
+import sqlite3
+from threading import Lock
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from resources import globals
+
+SCHEMA_VERSION = 2  # Databases of another version are started over
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, cursor TEXT);
+CREATE TABLE IF NOT EXISTS files (folder TEXT, enc_name TEXT, nonce BLOB, time_stamp REAL,
+                                  PRIMARY KEY (folder, enc_name)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS packs (folder TEXT, enc_name TEXT, sealed BLOB, deleted_enc_name TEXT,
+                                  PRIMARY KEY (folder, enc_name)) WITHOUT ROWID;
+"""
+
+
+def seal(aesgcm: AESGCM, folder: str, enc_name: str, value) -> bytes:
+    """Encrypt a value (as JSON) to keep in the database, bound to the row of the folder and encrypted name"""
+    nonce = globals.generate_random_nonce()
+    return nonce + aesgcm.encrypt(nonce, bytes(json.dumps(value), 'utf-8'), bytes(folder + '/' + enc_name, 'utf-8'))
+
+
+def unseal(aesgcm: AESGCM, folder: str, enc_name: str, sealed: bytes):
+    """The value sealed by seal. Raises InvalidTag if it is damaged, of another row or sealed under another key"""
+    return json.loads(aesgcm.decrypt(sealed[:12], sealed[12:], bytes(folder + '/' + enc_name, 'utf-8')))
+
+
+class MetadataDB:
+    """
+    The server file lists of the folders as last seen, kept on disk between runs in an SQLite database: the
+    encrypted names, nonces and time stamps of the files, the indexes of the packs and the cursor the listing was at.
+    A client starting again then only asks the server for what changed since, and reads no pack index again.
+    Nothing in it is in plain text: names are decrypted again as in a listing (through the name cache), and the
+    indexes and deleted files of packs are sealed under a key of their folder (see seal).
+    Folders are known by the server and userID they are listed under (see Client.get_folder_key).
+    Every change is one transaction, written ahead to the log (WAL), so a crash never leaves a half-made change.
+    """
+
+    def __init__(self, db_path: pl.Path):
+        """
+        Args:
+            db_path: where to keep the database
+        """
+        self.db_path = db_path
+        self.lock = Lock()
+        self.connection = None
+        try:
+            self.connect()
+        except sqlite3.DatabaseError:  # A damaged database is started over
+            self.close()
+            for path in (db_path, db_path.with_name(db_path.name + '-wal'), db_path.with_name(db_path.name + '-shm')):
+                if path.exists():
+                    path.unlink()
+            self.connect()
+
+    def connect(self):
+        """Open the database, creating it if need be"""
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')  # Durable at every checkpoint, consistent always
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self.connection.executescript('DROP TABLE IF EXISTS folders; DROP TABLE IF EXISTS files; '
+                                          'DROP TABLE IF EXISTS packs; PRAGMA user_version = ' + str(SCHEMA_VERSION))
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        """Close the database"""
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def load_folder(self, folder: str, aesgcm: AESGCM) -> (object, list, dict):
+        """
+        Read what is known of the server file list of a folder
+
+        Args:
+            folder: the key of the folder
+            aesgcm: the cipher the packs of the folder are sealed with, see seal
+
+        Returns:
+            None if the folder is not known, else
+            the cursor the listing was at, None if the server gives no cursors
+            list: the encrypted name, nonce (hex) and time stamp of every file of the folder on the server, as in a
+                listing (see FileCryptography.decrypt_server_file_list)
+            dict: the encrypted name -> index, deleted files (set) and encrypted name of the list of deleted files of
+                every pack of the folder. Packs that can not be unsealed are left out
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT cursor FROM folders WHERE folder = ?', (folder,)).fetchone()
+            file_rows = self.connection.execute(
+                'SELECT enc_name, nonce, time_stamp FROM files WHERE folder = ?', (folder,)).fetchall()
+            pack_rows = self.connection.execute(
+                'SELECT enc_name, sealed, deleted_enc_name FROM packs WHERE folder = ?', (folder,)).fetchall()
+        if row is None:
+            return None
+        packs = {}
+        for enc_name, sealed, deleted_enc_name in pack_rows:
+            try:
+                index, deleted = unseal(aesgcm, folder, enc_name, sealed)
+            except (InvalidTag, ValueError):
+                continue
+            packs[enc_name] = index, set(deleted), deleted_enc_name
+        return json.loads(row[0]), [[enc_name, nonce.hex(), time_stamp] for enc_name, nonce, time_stamp in file_rows], \
+            packs
+
+    def apply_changes(self, folder: str, fios: list, archived_files: list, is_full_list: bool, cursor):
+        """
+        Merge changes of the server file list of a folder, along with the cursor they bring the listing to. A full
+        list is compared with the files kept, such that only the files added, changed or gone are written
+
+        Args:
+            folder: the key of the folder
+            fios: the FileInfo of the new or changed files
+            archived_files: the encrypted names of the files archived
+            is_full_list: True if fios is all files of the folder
+            cursor: the cursor of the listing after the changes, None if the server gives no cursors
+        """
+        with self.lock, self.connection:
+            if is_full_list:
+                kept = {enc_name: (nonce, time_stamp) for enc_name, nonce, time_stamp in self.connection.execute(
+                    'SELECT enc_name, nonce, time_stamp FROM files WHERE folder = ?', (folder,))}
+                listed = {fio.enc_path for fio in fios}
+                archived_files = [enc_name for enc_name in kept if enc_name not in listed]
+                fios = [fio for fio in fios if kept.get(fio.enc_path, None) != (fio.nonce, fio.time_stamp)]
+            self.connection.executemany('DELETE FROM files WHERE folder = ? AND enc_name = ?',
+                                        [(folder, enc_name) for enc_name in archived_files])
+            self.insert_files(folder, fios)
+            self.connection.execute('INSERT OR REPLACE INTO folders (folder, cursor) VALUES (?, ?)',
+                                    (folder, json.dumps(cursor)))
+
+    def put_files(self, folder: str, fios: list):
+        """Add or replace files of a folder, e.g. just sent"""
+        with self.lock, self.connection:
+            self.insert_files(folder, fios)
+
+    def remove_files(self, folder: str, enc_names: list):
+        """Remove files of a folder by their encrypted names, e.g. just archived"""
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM files WHERE folder = ? AND enc_name = ?',
+                                        [(folder, enc_name) for enc_name in enc_names])
+
+    def insert_files(self, folder: str, fios: list):
+        """Add or replace files, call holding the lock in a transaction"""
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO files (folder, enc_name, nonce, time_stamp) VALUES (?, ?, ?, ?)',
+            [(folder, fio.enc_path, fio.nonce, fio.time_stamp) for fio in fios])
+
+    def put_packs(self, folder: str, aesgcm: AESGCM, packs: list):
+        """Add or replace packs of a folder, along with their files and lists of deleted files. The index and deleted
+        files of each are sealed with aesgcm, see seal"""
+        rows = [(folder, pack.fio.enc_path, seal(aesgcm, folder, pack.fio.enc_path, [pack.index, sorted(pack.deleted)]),
+                 pack.deleted_fio.enc_path if pack.deleted_fio else None) for pack in packs]
+        with self.lock, self.connection:
+            self.insert_files(folder, [pack.fio for pack in packs] + [pack.deleted_fio for pack in packs
+                                                                        if pack.deleted_fio is not None])
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO packs (folder, enc_name, sealed, deleted_enc_name) VALUES (?, ?, ?, ?)', rows)
+
+    def remove_packs(self, folder: str, enc_names: list):
+        """Remove packs of a folder by their encrypted names"""
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM packs WHERE folder = ? AND enc_name = ?',
+                                        [(folder, enc_name) for enc_name in enc_names])
+
+
+_databases = {}
+_databases_lock = Lock()
+
+
+def get_metadata_db() -> MetadataDB:
+    """Get the database shared by every Client, at globals.METADATA_DB; None if nothing is to be kept"""
+    if globals.METADATA_DB is None:
+        return None
+    with _databases_lock:
+        db_path = pl.Path(globals.METADATA_DB)
+        if db_path not in _databases or _databases[db_path].connection is None:
+            _databases[db_path] = MetadataDB(db_path)
+        return _databases[db_path]
@@ -0,0 +1,228 @@
+import datetime
+import time
+from threading import Condition
+
+from resources import globals
+
+
+class TokenBucket:
+    """
+    Hands out bytes at a rate, allowing bursts of up to rate * globals.BANDWIDTH_BURST_SECONDS.
+    Waiting callers are woken when the rate changes, such that a new rate takes effect at once.
+    """
+
+    def __init__(self, rate: float = None):
+        """
+        Args:
+            rate: the bytes per second handed out, None for no limit
+        """
+        self.condition = Condition()
+        self.rate = rate
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.bytes_passed = 0
+        self.seconds_waited = 0.0
+
+    @property
+    def burst(self) -> float:
+        """The most bytes that may pass at once after being idle"""
+        if not self.rate:
+            return 0.0
+        return max(self.rate * globals.BANDWIDTH_BURST_SECONDS, globals.BANDWIDTH_CHUNK_SIZE)
+
+    def set_rate(self, rate: float = None):
+        """
+        Change the rate, taking effect at once, also for callers waiting in consume
+
+        Args:
+            rate: the bytes per second handed out, None for no limit
+        """
+        if rate == self.rate:  # The common case, e.g. every piece of an upload; no need for the lock
+            return
+        with self.condition:
+            if rate == self.rate:
+                return
+            was_limited = bool(self.rate)
+            self.refill()
+            self.rate = rate
+            self.tokens = min(self.tokens, self.burst) if was_limited else self.burst
+            self.condition.notify_all()
+
+    def refill(self):
+        """Add the tokens earned since the last refill. Call holding the condition"""
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def consume(self, amount: int):
+        """
+        Take amount bytes from the bucket, waiting until the rate allows them
+
+        Args:
+            amount: the amount of bytes about to be sent or received
+        """
+        with self.condition:
+            start = time.monotonic()
+            while self.rate:
+                self.refill()
+                needed = min(amount, self.burst)  # More than the burst can never be saved up; go into debt instead
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    break
+                self.condition.wait((needed - self.tokens) / self.rate)
+            self.seconds_waited += time.monotonic() - start
+            self.bytes_passed += amount
+
+
+class BandwidthLimiter:
+    """
+    Limits the upload and download rates towards a server with a token bucket for each direction.
+    The rates can be changed at any time, and a schedule can give other rates at certain times of the day.
+    """
+
+    def __init__(self, upload_rate: float = None, download_rate: float = None, schedule: list = None):
+        """
+        Args:
+            upload_rate: the bytes per second that may be sent, None for no limit
+            download_rate: the bytes per second that may be received, None for no limit
+            schedule: a list of (start, end, upload_rate, download_rate) where start and end are datetime.time. Between
+                start and end the rates of the entry are used instead; an entry may pass midnight (start > end)
+        """
+        self.upload_bucket = TokenBucket()
+        self.download_bucket = TokenBucket()
+        self.upload_rate = upload_rate
+        self.download_rate = download_rate
+        self.schedule = list(schedule) if schedule else []
+        self.apply_rates()
+
+    def set_rates(self, upload_rate: float = None, download_rate: float = None):
+        """
+        Set the rates used outside the scheduled times
+
+        Args:
+            upload_rate: the bytes per second that may be sent, None for no limit
+            download_rate: the bytes per second that may be received, None for no limit
+        """
+        self.upload_rate = upload_rate
+        self.download_rate = download_rate
+        self.apply_rates()
+
+    def set_schedule(self, schedule: list = None):
+        """
+        Replace the schedule, see __init__. None or an empty list removes it
+        """
+        self.schedule = list(schedule) if schedule else []
+        self.apply_rates()
+
+    def apply_rates(self):
+        """Give the buckets the rates in effect now, waking transfers waiting at an old rate"""
+        upload_rate, download_rate = self.get_rates()
+        self.upload_bucket.set_rate(upload_rate)
+        self.download_bucket.set_rate(download_rate)
+
+    def get_rates(self, now: datetime.time = None) -> (float, float):
+        """
+        The rates in effect at the given time of day
+
+        Args:
+            now: the time of day (default=the current local time)
+
+        Returns:
+            float: the upload rate in bytes per second, None for no limit
+            float: the download rate in bytes per second, None for no limit
+        """
+        if now is None:
+            now = datetime.datetime.now().time()
+        for start, end, upload_rate, download_rate in self.schedule:
+            if start <= now < end if start <= end else (now >= start or now < end):
+                return upload_rate, download_rate
+        return self.upload_rate, self.download_rate
+
+    def is_limited(self) -> bool:
+        """Whether either direction is limited now"""
+        return any(self.get_rates())
+
+    def throttle_upload(self, chunks):
+        """
+        Generator passing on the chunks of an upload at the upload rate, in pieces of at most
+        globals.BANDWIDTH_CHUNK_SIZE such that the traffic is smooth and not in bursts of whole chunks
+
+        Args:
+            chunks: an iterable of bytes
+        """
+        return self.throttle(chunks, self.upload_bucket, 0)
+
+    def throttle_download(self, chunks):
+        """
+        Generator passing on the chunks of a download at the download rate, see throttle_upload
+
+        Args:
+            chunks: an iterable of bytes, read from the response as they are asked for
+        """
+        return self.throttle(chunks, self.download_bucket, 1)
+
+    def throttle(self, chunks, bucket: TokenBucket, direction: int):
+        """Generator passing on chunks in pieces through bucket, using the rate of direction (0: up, 1: down). While
+        the direction is not limited, chunks are passed on whole as they are: nothing is waited for, locked or copied"""
+        for chunk in chunks:
+            rate = self.get_rates()[direction]
+            if not rate:
+                bucket.set_rate(rate)
+                bucket.bytes_passed += len(chunk)  # Not under the lock; the count is only for the stats
+                yield chunk
+                continue
+            view = memoryview(chunk)
+            for start in range(0, len(view), globals.BANDWIDTH_CHUNK_SIZE):
+                piece = view[start:start + globals.BANDWIDTH_CHUNK_SIZE]
+                bucket.set_rate(self.get_rates()[direction])
+                bucket.consume(len(piece))
+                yield bytes(piece)
+
+    def get_stats(self) -> dict:
+        """
+        Returns:
+            dict: the rates in effect now, and for each direction the bytes passed and the seconds spent waiting
+        """
+        upload_rate, download_rate = self.get_rates()
+        return {'upload_rate': upload_rate, 'download_rate': download_rate,
+                'uploaded': self.upload_bucket.bytes_passed, 'upload_wait': self.upload_bucket.seconds_waited,
+                'downloaded': self.download_bucket.bytes_passed, 'download_wait': self.download_bucket.seconds_waited}
+
+
+class ThrottledReader:
+    """File-like wrapper of bytes for request bodies that must have a known length, read at the upload rate"""
+
+    def __init__(self, data: bytes, limiter: BandwidthLimiter):
+        self.view = memoryview(data)
+        self.position = 0
+        self.limiter = limiter
+
+    def __len__(self):
+        return len(self.view) - self.position
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = len(self)
+        size = min(size, globals.BANDWIDTH_CHUNK_SIZE, len(self))
+        piece = self.view[self.position:self.position + size]
+        self.position += size
+        return b''.join(self.limiter.throttle_upload([piece]))
+
+
+def parse_schedule_entry(entry: str, upload_rate: float, download_rate: float) -> tuple:
+    """
+    Make a schedule entry from a time span given as text
+
+    Args:
+        entry: the span as 'HH:MM-HH:MM'
+        upload_rate: the bytes per second that may be sent within the span, None for no limit
+        download_rate: the bytes per second that may be received within the span, None for no limit
+
+    Returns:
+        tuple: (start, end, upload_rate, download_rate) as used in BandwidthLimiter schedules
+    """
+    start, end = entry.split('-')
+    return (datetime.datetime.strptime(start.strip(), '%H:%M').time(),
+            datetime.datetime.strptime(end.strip(), '%H:%M').time(),
+            upload_rate, download_rate)
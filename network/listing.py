@@ -0,0 +1,92 @@
+import struct
+
+LISTING_CONTENT_TYPE = 'application/x-cio-listing'
+MAGIC = b'CIOL\x01'
+NO_CURSOR = 2 ** 64 - 1
+_HEADER = struct.Struct('>BQII')  # flags (bit 0: full list), cursor, amount of files, amount of archived names
+_TIME_STAMP = struct.Struct('>d')
+
+
+class BadListingError(Exception):
+    pass
+
+
+def encode_name(enc_file_name: str) -> bytes:
+    """Turn an encrypted file name ('<hex>.cio') into the raw ciphertext"""
+    if not enc_file_name.endswith('.cio'):
+        raise BadListingError("Not an encrypted file name: " + enc_file_name)
+    return bytes.fromhex(enc_file_name[:-len('.cio')])
+
+
+def decode_name(raw_name: bytes) -> str:
+    """Turn the raw ciphertext of a file name into the encrypted file name ('<hex>.cio')"""
+    return raw_name.hex() + '.cio'
+
+
+def encode_listing(listing: dict) -> bytes:
+    """
+    Encode a listing into the compact binary format; raw bytes with length prefixes instead of hex in JSON
+
+    Args:
+        listing: a dict with 'file_list' (lists of encrypted name, nonce as hex and timestamp) and optionally
+            'archived' (encrypted names), 'cursor' (int) and 'full' (bool)
+
+    Returns:
+        bytes: the encoded listing
+    """
+    archived = listing.get('archived', [])
+    cursor = listing.get('cursor', None)
+    parts = [MAGIC, _HEADER.pack(int(listing.get('full', False)), NO_CURSOR if cursor is None else cursor,
+                                 len(listing['file_list']), len(archived))]
+    for enc_file_name, nonce, time_stamp in listing['file_list']:
+        raw_name = encode_name(enc_file_name)
+        raw_nonce = bytes.fromhex(nonce)
+        parts += [struct.pack('>H', len(raw_name)), raw_name,
+                  struct.pack('>B', len(raw_nonce)), raw_nonce,
+                  _TIME_STAMP.pack(float(time_stamp))]
+    for enc_file_name in archived:
+        raw_name = encode_name(enc_file_name)
+        parts += [struct.pack('>H', len(raw_name)), raw_name]
+    return b''.join(parts)
+
+
+def decode_listing(data: bytes) -> dict:
+    """
+    Decode a listing in the compact binary format into the same dict as the JSON format
+
+    Args:
+        data: the encoded listing
+
+    Returns:
+        dict: 'file_list', 'archived' and 'full', and 'cursor' if the server gave one
+    """
+    if not data.startswith(MAGIC):
+        raise BadListingError("Unknown listing format")
+    view = memoryview(data)
+    try:
+        flags, cursor, file_count, archived_count = _HEADER.unpack_from(view, len(MAGIC))
+        offset = len(MAGIC) + _HEADER.size
+        file_list = []
+        for _ in range(file_count):
+            name_length, = struct.unpack_from('>H', view, offset)
+            raw_name = bytes(view[offset + 2:offset + 2 + name_length])
+            offset += 2 + name_length
+            nonce_length = view[offset]
+            nonce = bytes(view[offset + 1:offset + 1 + nonce_length])
+            offset += 1 + nonce_length
+            time_stamp, = _TIME_STAMP.unpack_from(view, offset)
+            offset += _TIME_STAMP.size
+            file_list.append([decode_name(raw_name), nonce.hex(), time_stamp])
+        archived = []
+        for _ in range(archived_count):
+            name_length, = struct.unpack_from('>H', view, offset)
+            archived.append(decode_name(bytes(view[offset + 2:offset + 2 + name_length])))
+            offset += 2 + name_length
+    except (struct.error, IndexError):
+        raise BadListingError("Truncated listing")
+    if offset != len(data):
+        raise BadListingError("Trailing data after listing")
+    listing = {'file_list': file_list, 'archived': archived, 'full': bool(flags & 1)}
+    if cursor != NO_CURSOR:
+        listing['cursor'] = cursor
+    return listing
@@ -0,0 +1,180 @@
+import random
+import time
+from threading import Lock
+
+import requests
+
+from resources import globals
+
+RETRYABLE_STATUS_CODES = (429, 502, 503, 504)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+class DeadlineExceededError(requests.exceptions.Timeout):
+    pass
+
+
+class CircuitBreaker:
+    """Fails calls fast while the server seems down, letting a single trial call through every reset_timeout seconds"""
+
+    def __init__(self, failure_threshold: int = globals.CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = globals.CIRCUIT_RESET_TIMEOUT):
+        """
+        Args:
+            failure_threshold: the amount of failures in a row that opens the circuit
+            reset_timeout: the seconds to fail fast before letting a trial call through
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = Lock()
+        self.failures = 0
+        self.opened_at = None  # None when closed
+        self.trial_running = False
+
+    @property
+    def state(self) -> str:
+        """'closed' when calls go through, 'open' when they fail fast, 'half-open' when a trial call may go through"""
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_call(self):
+        """Raise CircuitOpenError if the call should not be made"""
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if state == 'half-open' and not self.trial_running:
+                self.trial_running = True
+                return
+            raise CircuitOpenError("Server unavailable; not trying again for a while.")
+
+    def record_success(self):
+        """Close the circuit"""
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def abandon_call(self):
+        """Forget a call that ended in an error saying nothing about the server, e.g. a local file error, such that
+        a trial call may go through again"""
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        """Count a failure, opening the circuit on too many of them or on a failed trial call"""
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+class RetryPolicy:
+    """Retries failed requests with capped exponential backoff and jitter, within a deadline for each operation"""
+
+    def __init__(self, max_attempts: int = globals.RETRY_MAX_ATTEMPTS, base_delay: float = globals.RETRY_BASE_DELAY,
+                 max_delay: float = globals.RETRY_MAX_DELAY, breaker: CircuitBreaker = None):
+        """
+        Args:
+            max_attempts: the most attempts made for one call
+            base_delay: the seconds to wait before the first retry, doubled for every following retry
+            max_delay: the most seconds to wait between two attempts
+            breaker: the circuit breaker to consult before every attempt (default=a new CircuitBreaker)
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker if breaker else CircuitBreaker()
+        self.stats_lock = Lock()
+        self.stats = {}  # operation -> counters, see record
+
+    def backoff(self, retry: int) -> float:
+        """
+        The seconds to wait before the given retry; exponential, capped and with jitter to spread out clients
+
+        Args:
+            retry: the number of the retry, starting from 0
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** retry)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, operation: str, attempt, deadline: float = None) -> requests.Response:
+        """
+        Call attempt until it succeeds, fails with a non-retryable error or the attempts or deadline run out
+
+        Args:
+            operation: the name of the operation, used to look up its deadline and for the counters
+            attempt: a callable taking the timeout (connect, read) to use and returning a requests.Response
+            deadline: the seconds the whole operation may take (default=globals.OPERATION_DEADLINES[operation])
+
+        Returns:
+            requests.Response: the first response that is not retryable, or the last response if none was
+        """
+        if deadline is None:
+            deadline = globals.OPERATION_DEADLINES.get(operation, globals.OPERATION_DEADLINES['default'])
+        start = time.monotonic()
+        retry = 0
+        while True:
+            self.breaker.before_call()
+            remaining = deadline - (time.monotonic() - start)
+            attempt_start = time.monotonic()
+            response, error = None, None
+            try:
+                response = attempt((globals.CONNECT_TIMEOUT, min(globals.READ_TIMEOUT, remaining)))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            except BaseException:  # Not a network error, e.g. the body could not be read; never leave a trial running
+                self.breaker.abandon_call()
+                raise
+            latency = time.monotonic() - attempt_start
+            if response is not None and response.status_code not in RETRYABLE_STATUS_CODES:
+                self.breaker.record_success()
+                self.record(operation, retry, latency, failed=False)
+                return response
+            self.breaker.record_failure()
+            delay = self.backoff(retry)
+            out_of_time = time.monotonic() - start + delay >= deadline
+            if retry + 1 >= self.max_attempts or out_of_time:
+                self.record(operation, retry, latency, failed=True)
+                if response is not None:
+                    return response  # The caller decides what the error response means
+                if out_of_time:
+                    raise DeadlineExceededError(operation + " did not succeed within " + str(deadline) + "s") \
+                        from error
+                raise error
+            if response is not None:
+                response.close()
+            retry += 1
+            time.sleep(delay)
+
+    def record(self, operation: str, retries: int, latency: float, failed: bool):
+        """Update the counters of operation with a finished call"""
+        with self.stats_lock:
+            stats = self.stats.setdefault(operation, {'calls': 0, 'retries': 0, 'failures': 0,
+                                                      'latency_total': 0.0, 'latency_max': 0.0})
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['failures'] += int(failed)
+            stats['latency_total'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+
+    def get_stats(self) -> dict:
+        """
+        Retry and latency counters
+
+        Returns:
+            dict: the state of the circuit, and for every operation the calls, retries, failures and latency of the
+            last attempt of the calls (total, mean and max)
+        """
+        with self.stats_lock:
+            operations = {}
+            for operation, stats in self.stats.items():
+                operations[operation] = dict(stats, latency_mean=stats['latency_total'] / stats['calls'])
+        return {'circuit': self.breaker.state, 'operations': operations}
@@ -0,0 +1,200 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+from network.bandwidth import BandwidthLimiter
+from network.retry import RetryPolicy
+from resources import globals
+
+# gzip and deflate, plus br and zstd when the optional brotli and zstandard packages are installed
+ACCEPT_ENCODING = make_headers(accept_encoding=True)['accept-encoding']
+
+
+class Transport:
+    """Pooled keep-alive HTTPS connections to one server, shared by every ServComs talking to that server"""
+
+    def __init__(self, server_location: str, pool_size: int = globals.CONNECTION_POOL_SIZE, verify=False):
+        """
+        Args:
+            server_location: the location (host:port) of the server the connections go to
+            pool_size: the maximum amount of connections kept alive towards the server
+            verify: passed on to requests; False or the path of the certificate to trust
+        """
+        self.server_location = server_location
+        self.base_url = 'https://' + server_location
+        self.pool_size = pool_size
+        self.verify = verify
+        self.session = requests.Session()
+        self.session.headers['Connection'] = 'keep-alive'
+        self.session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        # One pool for our one host. Block instead of opening throw-away connections when the pool is exhausted,
+        # such that every TLS session is kept and reused.
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', self.adapter)
+        self.stats_lock = Lock()
+        self.request_count = 0
+        self.wire_stats = {}  # operation -> bytes on the wire and after decoding, see read_content
+        self.segment_stats = {}  # operation -> bytes, seconds and throughput of transferred segments, see record_segment
+        # What the server has shown to support, e.g. {'stream_upload': True}. Missing means not yet known.
+        self.capabilities = {}
+        self.executor = None
+        self.retry_policy = RetryPolicy()  # One circuit breaker for the one server
+        # One limit for all traffic to the server, whichever folder or thread it is for
+        self.limiter = BandwidthLimiter(globals.UPLOAD_RATE_LIMIT, globals.DOWNLOAD_RATE_LIMIT)
+
+    def request(self, method: str, path: str, operation: str = 'default', body_factory=None,
+                **kwargs) -> requests.Response:
+        """
+        Make a request to the server over a pooled connection, retrying as per the retry policy
+
+        Args:
+            method: the HTTP method, e.g. 'GET' or 'POST'
+            path: the path on the server, starting with '/'
+            operation: the name of the operation, for its deadline and counters (see RetryPolicy)
+            body_factory: a callable giving a dict of the body arguments (data, files, json) for requests, and
+                optionally headers describing the body. Called for every attempt, such that a streamed body can be sent
+                again
+            **kwargs: passed on to requests.Session.request
+
+        Returns:
+            requests.Response: the response of the server
+        """
+        kwargs.setdefault('verify', self.verify)
+
+        def attempt(timeout) -> requests.Response:
+            with self.stats_lock:
+                self.request_count += 1
+            arguments = dict(kwargs)
+            if body_factory:
+                body = body_factory()
+                arguments['headers'] = dict(kwargs.get('headers') or {}, **body.pop('headers', {}))
+                arguments.update(body)
+            return self.session.request(method, self.base_url + path, timeout=timeout, **arguments)
+
+        return self.retry_policy.call(operation, attempt)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        """GET the path on the server, see request"""
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        """POST to the path on the server, see request"""
+        return self.request('POST', path, **kwargs)
+
+    def read_content(self, response: requests.Response, operation: str) -> bytes:
+        """
+        Read the whole body of a response, counting the bytes it took on the wire and after decompressing
+
+        Args:
+            response: the response to read
+            operation: the name of the operation to count the bytes under
+
+        Returns:
+            bytes: the decompressed body
+        """
+        content = response.content
+        wire_bytes = response.raw.tell() if response.raw is not None else len(content)
+        with self.stats_lock:
+            stats = self.wire_stats.setdefault(operation, {'responses': 0, 'wire_bytes': 0, 'content_bytes': 0})
+            stats['responses'] += 1
+            stats['wire_bytes'] += wire_bytes
+            stats['content_bytes'] += len(content)
+        return content
+
+    def record_segment(self, operation: str, byte_count: int, seconds: float):
+        """
+        Count a segment of a file transferred on its own, e.g. a range of a download
+
+        Args:
+            operation: the name of the operation to count the segment under
+            byte_count: the size of the segment
+            seconds: the time it took, retries included
+        """
+        throughput = byte_count / seconds if seconds > 0 else 0.0
+        with self.stats_lock:
+            stats = self.segment_stats.setdefault(operation, {'segments': 0, 'bytes': 0, 'seconds': 0.0,
+                                                              'throughput_min': throughput, 'throughput_max': 0.0})
+            stats['segments'] += 1
+            stats['bytes'] += byte_count
+            stats['seconds'] += seconds
+            stats['throughput_min'] = min(stats['throughput_min'], throughput)
+            stats['throughput_max'] = max(stats['throughput_max'], throughput)
+
+    def get_stats(self) -> dict:
+        """
+        Counters showing how well connections are reused, and how requests fare
+
+        Returns:
+            dict: requests made, connections opened, requests served over an already open connection, the bytes on
+            the wire and after decompressing of the responses read with read_content, the size and throughput (bytes
+            per second) of transferred segments (see record_segment), the bandwidth limits and
+            traffic (see BandwidthLimiter.get_stats), and the retry and latency counters (see RetryPolicy.get_stats)
+        """
+        pool = self.adapter.poolmanager.connection_from_url(self.base_url)
+        connections = pool.num_connections
+        stats = {'requests': self.request_count,
+                 'connections': connections,
+                 'reused': max(self.request_count - connections, 0),
+                 'pool_size': self.pool_size}
+        with self.stats_lock:
+            stats['wire'] = {operation: dict(counters) for operation, counters in self.wire_stats.items()}
+            stats['segments'] = {operation: dict(counters, throughput_mean=counters['bytes'] / counters['seconds']
+                                                 if counters['seconds'] > 0 else 0.0)
+                                 for operation, counters in self.segment_stats.items()}
+        stats['bandwidth'] = self.limiter.get_stats()
+        stats.update(self.retry_policy.get_stats())
+        return stats
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        """
+        The thread pool running blocking requests for asyncio callers; one thread per pooled connection
+
+        Returns:
+            ThreadPoolExecutor: the executor shared by every AsyncServComs for this server
+        """
+        with self.stats_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='transport')
+            return self.executor
+
+    def close(self):
+        """Close all pooled connections"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+_transports = {}
+_transports_lock = Lock()
+
+
+def get_transport(server_location: str, pool_size: int = None) -> Transport:
+    """
+    Get the transport shared by everyone talking to server_location, creating it if needed
+
+    Args:
+        server_location: the location (host:port) of the server
+        pool_size: the pool size to use if the transport is created by this call (default=globals.CONNECTION_POOL_SIZE)
+
+    Returns:
+        Transport: the shared transport for the server
+    """
+    with _transports_lock:
+        transport = _transports.get(server_location, None)
+        if not transport:
+            if pool_size is None:
+                pool_size = globals.CONNECTION_POOL_SIZE
+            transport = Transport(server_location, pool_size)
+            _transports[server_location] = transport
+        return transport
+
+
+def close_transports():
+    """Close and forget all shared transports"""
+    with _transports_lock:
+        for transport in _transports.values():
+            transport.close()
+        _transports.clear()
@@ -0,0 +1,116 @@
+import json
+import os
+import pathlib as pl
+from json import JSONDecodeError
+from threading import Lock
+
+from resources import globals
+
+
+class UploadJournal:
+    """
+    Remembers on disk the multipart uploads under way and the parts the server has acknowledged, such that an upload
+    cut off by a crash or network loss can go on from where it was. Rewritten atomically on every change.
+    """
+
+    def __init__(self, journal_path: pl.Path = None):
+        """
+        Args:
+            journal_path: where to keep the journal (default=globals.UPLOAD_JOURNAL)
+        """
+        self.journal_path = pl.Path(journal_path if journal_path else globals.UPLOAD_JOURNAL)
+        self.lock = Lock()
+        self.entries = None  # upload key -> entry, loaded at first use
+
+    def load(self) -> dict:
+        """Load the journal from disk the first time, call holding the lock"""
+        if self.entries is None:
+            try:
+                with open(self.journal_path, "rt") as file:
+                    self.entries = json.loads(file.read())
+            except (FileNotFoundError, JSONDecodeError):
+                self.entries = {}
+        return self.entries
+
+    def save(self):
+        """Write the journal to disk, replacing the old one in one step. Call holding the lock"""
+        tmp_path = self.journal_path.with_name(self.journal_path.name + '.tmp')
+        with open(tmp_path, "wt") as file:
+            file.write(json.dumps(self.entries))
+        os.replace(tmp_path, self.journal_path)
+
+    def get(self, key: str) -> dict:
+        """
+        Args:
+            key: the key of the upload
+
+        Returns:
+            dict: a copy of the entry of the upload, None if there is none
+        """
+        with self.lock:
+            entry = self.load().get(key, None)
+            return json.loads(json.dumps(entry)) if entry is not None else None
+
+    def put(self, key: str, entry: dict):
+        """
+        Record a new upload, replacing any earlier one under the same key
+
+        Args:
+            key: the key of the upload
+            entry: the upload id, size, part size, additional data, source and acknowledged parts (index -> hash)
+        """
+        with self.lock:
+            self.load()[key] = entry
+            self.save()
+
+    def mark_part(self, key: str, index: int, part_hash: str):
+        """
+        Record that the server acknowledged a part
+
+        Args:
+            key: the key of the upload
+            index: the index of the part
+            part_hash: the hex sha256 of the content of the part
+        """
+        with self.lock:
+            entry = self.load().get(key, None)
+            if entry is not None:
+                entry['parts'][str(index)] = part_hash
+                self.save()
+
+    def remove(self, key: str):
+        """Forget an upload, e.g. because it is finished"""
+        with self.lock:
+            if self.load().pop(key, None) is not None:
+                self.save()
+
+    def find_by_source(self, prefix: str, source_path: pl.Path) -> (str, dict):
+        """
+        Find an unfinished upload of the given (unencrypted) file
+
+        Args:
+            prefix: the start of the keys to look at, i.e. the server and user
+            source_path: the path of the file the upload was encrypted from
+
+        Returns:
+            str: the key of the upload, None if there is none
+            dict: a copy of the entry of the upload, None if there is none
+        """
+        with self.lock:
+            for key, entry in self.load().items():
+                if key.startswith(prefix) and entry.get('source', {}).get('path', None) == str(source_path):
+                    return key, json.loads(json.dumps(entry))
+        return None, None
+
+
+_journal = None
+_journal_lock = Lock()
+
+
+def get_upload_journal() -> UploadJournal:
+    """Get the upload journal shared by every ServComs"""
+    global _journal
+    with _journal_lock:
+        if _journal is None or _journal.journal_path != pl.Path(globals.UPLOAD_JOURNAL):
+            _journal = UploadJournal()
+        return _journal
@@ -70,18 +70,23 @@ def generate_random_key() -> bytes:
 class FileInfo:
     """Encapsulates the elements of a file"""
 
-    def __init__(self, rel_file_path: pl.Path, file_name_nonce: bytes, enc_path: str, time_stamp: float):
+    def __init__(self, rel_file_path: pl.Path, file_name_nonce: bytes, enc_path: str, time_stamp: float,
+                 pack: str = None, member: tuple = None):
         """
         Args:
             rel_file_path: the relative path of the file, relative to the project folder
             file_name_nonce: the nonce the filename has been encrypted under
             enc_path  : the encrypted file name
             time_stamp: the modify time of the file
+            pack: the encrypted name of the pack the file is in on the server, None if it is a file of its own
+            member: for a file in a pack, its offset in the pack, its length and its additional data
         """
         self.path = rel_file_path
         self.nonce = file_name_nonce
         self.enc_path = enc_path
         self.time_stamp = time_stamp
+        self.pack = pack
+        self.member = member
 
     def __str__(self) -> str:
         return self.path.as_posix() + "->" + self.enc_path
@@ -117,7 +122,65 @@ FILE_FOLDER = pl.Path.joinpath(WORK_DIR, "files")
 TEMPORARY_FOLDER = pl.Path.joinpath(WORK_DIR, "tmp")
 create_file_folders()
 SERVER_LOCATION = 'wyrnas.myqnapcloud.com:8001'
+ENCRYPTION_FORMAT_VERSION = 2  # 2: segmented, streamed. 1: one piece, for servers shared with older clients
+ENCRYPTION_SEGMENT_SIZE = 1024 * 1024  # Bytes of plaintext in each segment of the segmented format
+ENCRYPTION_WORKERS = os.cpu_count() or 1  # Threads encrypting/decrypting the segments of a file at the same time
+COMPRESSION = 'zlib'  # Codec compressing files before encryption ('zlib', 'zstd', 'lz4'), None to never compress
+COMPRESSION_SAMPLE_SIZE = 64 * 1024  # Bytes from the start of a file compressed to decide whether to compress it
+COMPRESSION_MAX_RATIO = 0.9  # Files whose sample does not shrink below this share of its size are not compressed
+COMPRESSION_MIN_SIZE = 256  # Files smaller than this are not compressed
+LISTING_CHUNK_SIZE = 4096  # Entries of a server listing decrypted together on one thread
+NAME_CACHE_SIZE = 250000  # Decrypted server file names remembered per folder
+NAME_CACHE_PERSIST = False  # Keep the decrypted server file names on disk (encrypted) between runs
+BATCH_ENCRYPTION_MAX_SIZE = 1024 * 1024  # Files up to this size are encrypted in batches when many are sent at once
+ENCRYPTION_BATCH_SIZE = 256  # Files encrypted in one batch, all held in memory until sent
+REUSE_IO_BUFFERS = True  # En/decrypt files on disk and downloads with readinto and en/decrypt_into on buffers used again
+CONTENT_INDEX_SAVE_INTERVAL = 5  # Fewest seconds between writes of the content index to disk, but at the end of a sync
+PARTIAL_FILE_SUFFIX = '.cio-part'  # Ending of files being decrypted, until moved into place
+CONNECTION_POOL_SIZE = 10  # Kept-alive connections per server
+STREAM_UPLOAD_THRESHOLD = 64 * 1024 * 1024  # Files of this size or bigger are streamed, if the server lacks multipart uploads
+MULTIPART_UPLOAD_THRESHOLD = 64 * 1024 * 1024  # Files of this size or bigger are uploaded in resumable parts
+MULTIPART_PART_SIZE = 8 * 1024 * 1024  # Bytes in each part of a multipart upload
+MULTIPART_PARALLEL_PARTS = 4  # Parts of one multipart upload sent at the same time
+CHUNKED_UPLOADS = False  # Send big files as deduplicated chunks; splitting runs in Python at about 5-7 MB/s a core, far below encrypting
+CHUNKED_UPLOAD_THRESHOLD = 16 * 1024 * 1024  # Files of this size or bigger are sent as deduplicated chunks, if CHUNKED_UPLOADS and the server keeps chunks
+CHUNK_MIN_SIZE = 256 * 1024  # Fewest bytes in a chunk of a file sent as chunks, but the last (see security/chunking.py)
+CHUNK_AVG_SIZE = 1024 * 1024  # About the bytes in a chunk on average
+CHUNK_MAX_SIZE = 4 * 1024 * 1024  # Most bytes in a chunk
+CHUNK_QUERY_BATCH_SIZE = 1000  # Chunk ids the server is asked about per request
+PACK_SMALL_FILES = True  # Send many small files at once in packs, one object per pack (see security/packing.py)
+PACK_MAX_FILE_SIZE = 64 * 1024  # Files whose ciphertext is at most this many bytes are put in packs
+PACK_MIN_FILES = 8  # Fewest small files sent at once for them to be packed; fewer are sent one by one
+PACK_MAX_SIZE = 8 * 1024 * 1024  # Most bytes of files in one pack
+PACK_INDEX_READ_SIZE = 64 * 1024  # Bytes read from the start of a pack for its index; more if the index is bigger
+PACK_REPACK_RATIO = 0.5  # Packs with this share of their files deleted or replaced are repacked in the background
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes held in memory at a time when streaming an upload
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes held in memory at a time when streaming a download
+DOWNLOAD_SEGMENT_SIZE = 8 * 1024 * 1024  # Bytes in each range of a download; smaller files take one request
+DOWNLOAD_PARALLEL_SEGMENTS = 4  # Ranges of one download fetched at the same time
+UPLOAD_RATE_LIMIT = None  # Bytes per second sent to a server, None for no limit
+DOWNLOAD_RATE_LIMIT = None  # Bytes per second received from a server, None for no limit
+BANDWIDTH_CHUNK_SIZE = 64 * 1024  # Bytes passed at a time through the bandwidth limiter
+BANDWIDTH_BURST_SECONDS = 0.5  # Seconds of traffic the bandwidth limiter lets through at once after being idle
+BINARY_LISTING = True  # Ask for the compact binary listing format, falling back to JSON if the server lacks it
+ARCHIVE_BATCH_SIZE = 1000  # Encrypted names archived per request when deleting many files
+MAX_CONCURRENT_TRANSFERS = 8  # Files sent/received at the same time by the async Client methods
+CONNECT_TIMEOUT = 10  # Seconds to wait for a connection to the server
+READ_TIMEOUT = 60  # Seconds to wait for the server to send something before giving up on a request
+RETRY_MAX_ATTEMPTS = 5  # Attempts made for one request before giving up
+RETRY_BASE_DELAY = 0.5  # Seconds before the first retry, doubled for every retry after
+RETRY_MAX_DELAY = 30  # Most seconds between two attempts
+CIRCUIT_FAILURE_THRESHOLD = 5  # Failures in a row after which requests fail fast
+CIRCUIT_RESET_TIMEOUT = 30  # Seconds to fail fast before trying the server again
+OPERATION_DEADLINES = {'default': 120, 'register': 60, 'list_files': 120, 'archive': 120,
+                       'upload': 6 * 3600, 'download': 6 * 3600}  # Seconds an operation may take, retries included
+SEND_FILE_ATTEMPTS = 5  # Attempts at sending a file that is locked by another program, or changes while sent
 KEY_HASHES = pl.Path.joinpath(RESOURCE_DIR, 'key_hashes.txt')
 ENC_OLD_KEYS = pl.Path.joinpath(RESOURCE_DIR, 'enc_keys.txt')  # Should contain old key encryptions
 SHARED_KEYS = RESOURCE_DIR / "shared_keys"
+REGISTERED_USERS = RESOURCE_DIR / "registered_users"  # Hashes of (server, userID) we have registered
+UPLOAD_JOURNAL = RESOURCE_DIR / "upload_journal"  # Multipart uploads under way, see network/upload_journal.py
+NAME_CACHE_FOLDER = RESOURCE_DIR / "name_cache"  # Decrypted server file names by folder key, see security/namecache.py
+CONTENT_INDEX_FOLDER = RESOURCE_DIR / "content_index"  # What local files held when synced, see security/contentindex.py
+METADATA_DB = RESOURCE_DIR / "metadata.db"  # The server file lists between runs, see metadata_db.py; None to keep none
 SERVER_FILE_DICT: Dict[pl.Path, FileInfo] = {}
@@ -0,0 +1,165 @@
+import hmac
+import math
+from hashlib import sha256
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from resources import globals
+from security.compression import choose_codec, compress_chunks, decompress_chunks
+
+GEAR_MASK = (1 << 64) - 1  # The gear hash is kept to 64 bits, so it only depends on the last 64 bytes
+NONCE_SIZE = 12  # Bytes of the random nonce starting every encrypted chunk
+
+
+def derive_key(key: bytes, info: bytes, length: int = 32) -> bytes:
+    """A key for one use, derived from key with HKDF; info tells the use"""
+    return HKDF(algorithm=hashes.SHA256(), length=length, salt=None, info=info).derive(key)
+
+
+class Chunker:
+    """
+    Splits files into chunks at boundaries found from their content (content-defined chunking), such that an edit
+    only changes the chunks around it and the chunks before and after it stay the same, and names and encrypts those
+    chunks such that the server can keep one copy of every chunk, whatever files and versions it is in.
+
+    A boundary is where a gear rolling hash (the hash shifted a bit left and the gear value of the next byte added)
+    has its top bits all zero. Chunks are at least globals.CHUNK_MIN_SIZE bytes, at most globals.CHUNK_MAX_SIZE,
+    and about globals.CHUNK_AVG_SIZE on average. The gear values are derived from the key, so the server can not
+    tell what files are stored from the sizes of their chunks.
+    A chunk is named by a keyed MAC of its content (chunk_id), and encrypted under a random nonce with its name as
+    additional data, such that the server can not hand out one chunk for another.
+    """
+
+    def __init__(self, key: bytes):
+        """
+        Args:
+            key: the key of the folder, the keys of the chunks are derived from
+        """
+        gear_bytes = derive_key(key, b'CloudIO chunk boundaries', 256 * 8)
+        self.gear = [int.from_bytes(gear_bytes[i:i + 8], 'big') for i in range(0, len(gear_bytes), 8)]
+        self.mac_key = derive_key(key, b'CloudIO chunk id')
+        self.aesgcm = AESGCM(derive_key(key, b'CloudIO chunks'))
+
+    def split(self, file):
+        """
+        Generator splitting an open file into chunks, holding at most two of the biggest chunks in memory
+
+        Args:
+            file: the file to split, opened for reading bytes
+
+        Yields:
+            bytes: the content of the file, a chunk at a time. An empty file gives no chunks
+        """
+        buffer = bytearray()
+        end_of_file = False
+        while True:
+            while not end_of_file and len(buffer) < globals.CHUNK_MAX_SIZE:
+                block = file.read(globals.CHUNK_MAX_SIZE)
+                end_of_file = not block
+                buffer += block
+            if not buffer:
+                return
+            length = self.find_boundary(buffer)
+            yield bytes(buffer[:length])
+            del buffer[:length]
+
+    def find_boundary(self, data) -> int:
+        """
+        Find where the first chunk of data ends. A Python loop over every byte: about 5-7 MB/s on one core, which is
+        why sending files as chunks is left to be switched on (globals.CHUNKED_UPLOADS)
+
+        Args:
+            data: the bytes to look in; if fewer than globals.CHUNK_MAX_SIZE, they are the end of the file
+
+        Returns:
+            int: the length of the first chunk
+        """
+        min_size = globals.CHUNK_MIN_SIZE
+        end = min(len(data), globals.CHUNK_MAX_SIZE)
+        if end <= min_size:
+            return end
+        mask_bits = max(round(math.log2(max(globals.CHUNK_AVG_SIZE - min_size, 2))), 1)
+        mask = ((1 << mask_bits) - 1) << (64 - mask_bits)
+        gear = self.gear
+        gear_hash = 0
+        for byte in data[max(min_size - 64, 0):min_size]:  # No boundary before min_size, only fill the hash
+            gear_hash = ((gear_hash << 1) + gear[byte]) & GEAR_MASK
+        position = min_size
+        for byte in data[min_size:end]:
+            gear_hash = ((gear_hash << 1) + gear[byte]) & GEAR_MASK
+            position += 1
+            if not gear_hash & mask:
+                return position
+        return end
+
+    def chunk_id(self, chunk: bytes) -> str:
+        """The name of a chunk on the server: the hex HMAC-SHA256 of its content"""
+        return hmac.new(self.mac_key, chunk, sha256).hexdigest()
+
+    def encrypt_chunk(self, chunk_id: str, chunk: bytes) -> bytes:
+        """
+        Encrypt a chunk, compressed first if worth it (see choose_codec)
+
+        Args:
+            chunk_id: the name of the chunk, see chunk_id
+            chunk: the content of the chunk
+
+        Returns:
+            bytes: the nonce and the ciphertext of the codec name (a length byte, then the name) and content
+        """
+        codec = choose_codec(chunk[:globals.COMPRESSION_SAMPLE_SIZE]) if globals.COMPRESSION else None
+        if codec is not None:
+            chunk = b''.join(compress_chunks([chunk], codec))
+        codec_name = bytes(codec or '', 'ascii')
+        nonce = globals.generate_random_nonce(NONCE_SIZE)
+        return nonce + self.aesgcm.encrypt(nonce, bytes([len(codec_name)]) + codec_name + chunk,
+                                           bytes(chunk_id, 'ascii'))
+
+    def decrypt_chunk(self, chunk_id: str, enc_chunk: bytes) -> bytes:
+        """
+        Decrypt a chunk encrypted by encrypt_chunk. Raises InvalidTag if it is damaged or not the chunk named
+
+        Args:
+            chunk_id: the name of the chunk asked for
+            enc_chunk: what the server sent for it
+
+        Returns:
+            bytes: the content of the chunk
+        """
+        if len(enc_chunk) < NONCE_SIZE + 16:
+            raise InvalidTag
+        plaintext = self.aesgcm.decrypt(enc_chunk[:NONCE_SIZE], enc_chunk[NONCE_SIZE:], bytes(chunk_id, 'ascii'))
+        codec_length = plaintext[0]
+        chunk = plaintext[1 + codec_length:]
+        if codec_length:
+            chunk = b''.join(decompress_chunks([chunk], plaintext[1:1 + codec_length].decode('ascii')))
+        return chunk
+
+    def decrypt_chunk_into(self, chunk_id: str, enc_chunk: bytes, buffer: bytearray):
+        """
+        decrypt_chunk without making new bytes for the plaintext: it is decrypted into buffer, used again for every
+        chunk. Chunks too big for the buffer, and ciphers without decrypt_into (cryptography before 45), are left
+        to decrypt_chunk
+
+        Args:
+            chunk_id: the name of the chunk asked for
+            enc_chunk: what the server sent for it
+            buffer: the buffer to decrypt into
+
+        Returns:
+            the content of the chunk, a view of buffer if not compressed; valid until buffer is used again
+        """
+        length = len(enc_chunk) - NONCE_SIZE - 16
+        if length < 1 or length > len(buffer) or not hasattr(self.aesgcm, 'decrypt_into'):
+            return self.decrypt_chunk(chunk_id, enc_chunk)
+        plaintext = memoryview(buffer)[:length]
+        self.aesgcm.decrypt_into(enc_chunk[:NONCE_SIZE], memoryview(enc_chunk)[NONCE_SIZE:],
+                                 bytes(chunk_id, 'ascii'), plaintext)
+        codec_length = plaintext[0]
+        if codec_length:
+            return b''.join(decompress_chunks([bytes(plaintext[1 + codec_length:])],
+                                              bytes(plaintext[1:1 + codec_length]).decode('ascii')))
+        return plaintext[1:]
@@ -0,0 +1,145 @@
+import zlib
+
+from resources import globals
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class UnknownCodecError(Exception):
+    pass
+
+
+class ZlibCodec:
+    """Compression with zlib, always at hand"""
+
+    def compressor(self):
+        return zlib.compressobj()
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+class ZstdCodec:
+    """Compression with Zstandard, if the zstandard package is installed"""
+
+    def compressor(self):
+        return zstandard.ZstdCompressor().compressobj()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class Lz4Codec:
+    """Compression with LZ4 frames, if the lz4 package is installed"""
+
+    class Compressor:
+        """Gives LZ4FrameCompressor the compress/flush interface of zlib"""
+
+        def __init__(self):
+            self.compressor = lz4.frame.LZ4FrameCompressor()
+            self.header = self.compressor.begin()
+
+        def compress(self, data: bytes) -> bytes:
+            header, self.header = self.header, b''
+            return header + self.compressor.compress(data)
+
+        def flush(self) -> bytes:
+            header, self.header = self.header, b''
+            return header + self.compressor.flush()
+
+    def compressor(self):
+        return self.Compressor()
+
+    def decompressor(self):
+        return lz4.frame.LZ4FrameDecompressor()
+
+
+def get_codecs() -> dict:
+    """The codecs usable here, by the name recorded in the additional data of files compressed with them"""
+    codecs = {'zlib': ZlibCodec()}
+    if zstandard is not None:
+        codecs['zstd'] = ZstdCodec()
+    if lz4 is not None:
+        codecs['lz4'] = Lz4Codec()
+    return codecs
+
+
+def get_codec(name: str):
+    """
+    Args:
+        name: the name of the codec, as in the additional data
+
+    Returns:
+        the codec, with a compressor and a decompressor method
+    """
+    codec = get_codecs().get(name, None)
+    if codec is None:
+        raise UnknownCodecError("Files compressed with " + name + " can not be read without its package installed")
+    return codec
+
+
+def choose_codec(sample) -> str:
+    """
+    Decide whether a file is worth compressing from a sample of its start, with the codec of globals.COMPRESSION.
+    Content already compressed, such as JPEGs or archives, barely shrinks and is left alone.
+
+    Args:
+        sample: the first (up to globals.COMPRESSION_SAMPLE_SIZE) bytes of the file
+
+    Returns:
+        str: the name of the codec to compress the file with, None to leave it uncompressed
+    """
+    if not globals.COMPRESSION or len(sample) < globals.COMPRESSION_MIN_SIZE:
+        return None
+    name = globals.COMPRESSION if globals.COMPRESSION in get_codecs() else 'zlib'  # Configured codec not installed
+    compressor = get_codec(name).compressor()
+    compressed_size = len(compressor.compress(bytes(sample))) + len(compressor.flush())
+    if compressed_size > len(sample) * globals.COMPRESSION_MAX_RATIO:
+        return None
+    return name
+
+
+def compress_chunks(chunks, name: str):
+    """
+    Generator compressing chunks of bytes as they come
+
+    Args:
+        chunks: an iterable of bytes
+        name: the name of the codec
+
+    Yields:
+        bytes: the compressed stream, in pieces of any size
+    """
+    compressor = get_codec(name).compressor()
+    for chunk in chunks:
+        compressed = compressor.compress(bytes(chunk))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def decompress_chunks(chunks, name: str):
+    """
+    Generator decompressing chunks of bytes as they come
+
+    Args:
+        chunks: an iterable of bytes making up a stream compressed by compress_chunks
+        name: the name of the codec
+
+    Yields:
+        bytes: the content, in pieces of any size
+    """
+    decompressor = get_codec(name).decompressor()
+    for chunk in chunks:
+        content = decompressor.decompress(chunk)
+        if content:
+            yield content
+    if hasattr(decompressor, 'flush'):
+        yield decompressor.flush()
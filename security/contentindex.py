@@ -0,0 +1,139 @@
+import hmac
+import json
+import os
+import pathlib as pl
+import time
+from hashlib import sha256
+from json import JSONDecodeError
+from threading import Lock
+
+from resources import globals
+
+
+class ContentIndex:
+    """
+    What the local files of a folder held when last sent to or received from the server: their size, modification
+    time and a keyed hash of their content, along with the server version (encrypted name and time stamp) they match.
+    A file saved again with the same content then need not be encrypted and sent again.
+    Kept on disk between runs, rewritten in one step.
+    """
+
+    def __init__(self, hash_key: bytes, index_path: pl.Path = None):
+        """
+        Args:
+            hash_key: the key of the keyed hash (HMAC-SHA256) of the content
+            index_path: where to keep the index between runs, None to only keep it in memory
+        """
+        self.hash_key = hash_key
+        self.index_path = index_path
+        self.lock = Lock()
+        self.entries = None  # relative path (posix) -> entry, loaded at first use
+        self.changed = False
+        self.saved_at = 0
+
+    def load(self) -> dict:
+        """Read the index from disk the first time, call holding the lock. A missing or damaged index is started over"""
+        if self.entries is None:
+            self.entries = {}
+            if self.index_path is not None:
+                try:
+                    with open(self.index_path, "rt") as file:
+                        self.entries = json.loads(file.read())
+                except (FileNotFoundError, JSONDecodeError):
+                    pass
+        return self.entries
+
+    def content_hash(self, file_path: pl.Path) -> str:
+        """The hex keyed hash of the content of a file, read a chunk at a time"""
+        mac = hmac.new(self.hash_key, digestmod=sha256)
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(globals.UPLOAD_CHUNK_SIZE), b''):
+                mac.update(chunk)
+        return mac.hexdigest()
+
+    def record(self, rel_path: pl.Path, file_path: pl.Path, enc_file_name: str, time_stamp: float):
+        """
+        Remember the content of a file, now that it is the server version given. Nothing is remembered if the file
+        has been modified since that version, e.g. while it was being sent
+
+        Args:
+            rel_path: the relative path of the file
+            file_path: the path of the file
+            enc_file_name: the encrypted name of the file on the server
+            time_stamp: the time stamp of the version on the server, the modification time it was sent with
+        """
+        try:
+            file_stat = file_path.stat()
+            content_hash = self.content_hash(file_path)
+            unchanged = file_stat.st_mtime == time_stamp and file_path.stat().st_mtime_ns == file_stat.st_mtime_ns
+        except OSError:
+            unchanged = False
+        with self.lock:
+            entries = self.load()
+            if unchanged:
+                entries[rel_path.as_posix()] = {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns,
+                                                'hash': content_hash, 'n': enc_file_name, 't': time_stamp}
+            elif entries.pop(rel_path.as_posix(), None) is None:
+                return
+            self.changed = True
+
+    def forget(self, rel_path: pl.Path):
+        """Forget a file, e.g. because it was deleted"""
+        with self.lock:
+            if self.load().pop(rel_path.as_posix(), None) is not None:
+                self.changed = True
+
+    def is_unchanged(self, rel_path: pl.Path, file_path: pl.Path, enc_file_name: str, time_stamp: float) -> bool:
+        """
+        Whether a file holds the same content as the server version given. A file of the size and modification time
+        recorded is taken as unchanged without reading it; one of the same size but modified since is hashed, and if
+        its content is the same only its modification time is noted
+
+        Args:
+            rel_path: the relative path of the file
+            file_path: the path of the file
+            enc_file_name: the encrypted name of the file on the server
+            time_stamp: the time stamp of the version on the server
+
+        Returns:
+            bool: True if the file need not be sent
+        """
+        with self.lock:
+            entry = self.load().get(rel_path.as_posix(), None)
+        if entry is None or entry['n'] != enc_file_name or entry['t'] != time_stamp:
+            return False
+        try:
+            file_stat = file_path.stat()
+            if file_stat.st_size != entry['size']:
+                return False
+            if file_stat.st_mtime_ns == entry['mtime_ns']:
+                return True
+            if self.content_hash(file_path) != entry['hash'] or file_path.stat().st_mtime_ns != file_stat.st_mtime_ns:
+                return False
+        except OSError:
+            return False
+        with self.lock:
+            self.load()[rel_path.as_posix()] = dict(entry, mtime_ns=file_stat.st_mtime_ns)
+            self.changed = True
+        return True
+
+    def save(self, force: bool = False):
+        """
+        Write the index to disk if it changed, replacing the old one in one step. Unless forced, it is written at most
+        once every globals.CONTENT_INDEX_SAVE_INTERVAL seconds; an index not written only costs a file hashed again
+
+        Args:
+            force: write it now, e.g. at the end of many transfers
+        """
+        if self.index_path is None:
+            return
+        with self.lock:
+            if not self.changed or not force and time.monotonic() - self.saved_at < globals.CONTENT_INDEX_SAVE_INTERVAL:
+                return
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.index_path.with_name(self.index_path.name + '.tmp')
+            with open(tmp_path, "wt") as file:
+                file.write(json.dumps(self.entries))
+            os.replace(tmp_path, self.index_path)
+            self.changed = False
+            self.saved_at = time.monotonic()
@@ -1,17 +1,190 @@
+import io
 import json
 import os
 import pathlib as pl
 import platform
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
+from threading import current_thread, local, Lock
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from hashlib import sha3_512
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from hashlib import blake2b, sha3_512
 
 from resources import globals
+from security.chunking import Chunker
+from security.compression import choose_codec, compress_chunks, decompress_chunks
+from security.contentindex import ContentIndex
+from security.namecache import NameCache
+
+
+TAG_SIZE = 16  # Bytes of the GCM tag ending every segment
+FINAL_SEGMENT = b'\x01'  # Last byte of the nonce of the last segment, b'\x00' for the others
 
 
 class OlderServerFileError(Exception):
     pass
 
 
+class FileChangedError(Exception):
+    pass
+
+
+def segment_nonce(index: int, final: bool) -> bytes:
+    """
+    The nonce of a segment of a file in the segmented format: the index as 11 bytes and a byte telling whether the
+    segment is the last. Segments moved, dropped or added after the last one therefore fail to authenticate.
+
+    Args:
+        index: the place of the segment in the file, from 0
+        final: whether the segment is the last of the file
+    """
+    return index.to_bytes(11, 'big') + (FINAL_SEGMENT if final else b'\x00')
+
+
+def read_segments(chunks, segment_size: int):
+    """
+    Generator regrouping chunks of bytes into segments of segment_size, telling for each whether it is the last.
+    Looks one byte ahead, so a last segment of exactly segment_size is known to be the last.
+
+    Args:
+        chunks: an iterable of bytes
+        segment_size: the size of every segment but the last
+
+    Yields:
+        (bytes, bool): a segment, and whether it is the last. An empty input gives one empty last segment
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) > segment_size:
+            yield bytes(buffer[:segment_size]), False
+            del buffer[:segment_size]
+    yield bytes(buffer), True
+
+
+_segment_pool = None
+_segment_pool_workers = 0
+_segment_pool_users = {}  # Pool -> number of users (see get_segment_pool); a replaced pool is shut down when unused
+_segment_pool_lock = Lock()
+SEGMENT_THREAD_NAME = 'cio-segments'
+_batch_buffers = local()  # The buffer each thread reads files of a batch into, see FileCryptography.encrypt_many
+
+
+def get_segment_pool() -> ThreadPoolExecutor:
+    """Get the thread pool shared by every file for encrypting and decrypting segments, of globals.ENCRYPTION_WORKERS
+    threads. The cryptography backend lets go of the GIL while it works, so the threads run on all the cores.
+    The pool is the caller's until it gives it back with release_segment_pool: if globals.ENCRYPTION_WORKERS changes
+    meanwhile, later callers get a new pool and the old one is only shut down once every caller has given it back"""
+    global _segment_pool, _segment_pool_workers
+    with _segment_pool_lock:
+        if _segment_pool is None or _segment_pool_workers != globals.ENCRYPTION_WORKERS:
+            if _segment_pool is not None and not _segment_pool_users.get(_segment_pool, 0):
+                _segment_pool.shutdown(wait=False)
+            _segment_pool = ThreadPoolExecutor(max_workers=globals.ENCRYPTION_WORKERS,
+                                               thread_name_prefix=SEGMENT_THREAD_NAME)
+            _segment_pool_workers = globals.ENCRYPTION_WORKERS
+        _segment_pool_users[_segment_pool] = _segment_pool_users.get(_segment_pool, 0) + 1
+        return _segment_pool
+
+
+def release_segment_pool(pool: ThreadPoolExecutor):
+    """Give back a pool got from get_segment_pool, shutting it down if it has been replaced and is no longer used"""
+    with _segment_pool_lock:
+        _segment_pool_users[pool] -= 1
+        if not _segment_pool_users[pool]:
+            del _segment_pool_users[pool]
+            if pool is not _segment_pool:
+                pool.shutdown(wait=False)
+
+
+def map_segments(function, arguments, in_flight: int = None):
+    """
+    Generator applying function to the segments given by arguments on globals.ENCRYPTION_WORKERS threads, yielding
+    the results in order. Arguments are only taken from the iterable while fewer than two per thread are under way,
+    so at most that many segments are held in memory however big the file is.
+
+    Args:
+        function: the function to apply, e.g. encrypting one segment
+        arguments: an iterable of tuples of arguments for function, one per segment
+        in_flight: the most segments under way at once (default=two per thread)
+
+    Yields:
+        the result of function for each tuple of arguments, in the order of the arguments
+    """
+    workers = globals.ENCRYPTION_WORKERS
+    if workers <= 1 or current_thread().name.startswith(SEGMENT_THREAD_NAME):  # Waiting on the pool in it could hang
+        for argument in arguments:
+            yield function(*argument)
+        return
+    pool = get_segment_pool()
+    pending = deque()
+    try:
+        for argument in arguments:
+            pending.append(pool.submit(function, *argument))
+            if len(pending) >= (in_flight or 2 * workers):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:  # Stopped early, e.g. by a bad segment; drop the work no one will take
+        for future in pending:
+            future.cancel()
+        release_segment_pool(pool)
+
+
+def encrypt_into(aesgcm: AESGCM, nonce: bytes, data, associated_data: bytes, buffer) -> None:
+    """AESGCM.encrypt_into where the cryptography package has it (45 and later), else encrypt and copy into buffer"""
+    if hasattr(aesgcm, 'encrypt_into'):
+        aesgcm.encrypt_into(nonce, data, associated_data, buffer)
+    else:
+        buffer[:] = aesgcm.encrypt(nonce, data, associated_data)
+
+
+def decrypt_into(aesgcm: AESGCM, nonce: bytes, data, associated_data: bytes, buffer) -> None:
+    """AESGCM.decrypt_into where the cryptography package has it (45 and later), else decrypt and copy into buffer"""
+    if len(data) < TAG_SIZE:
+        raise InvalidTag
+    if hasattr(aesgcm, 'decrypt_into'):
+        aesgcm.decrypt_into(nonce, data, associated_data, buffer)
+    else:
+        buffer[:] = aesgcm.decrypt(nonce, data, associated_data)
+
+
+class ChunksReader(io.RawIOBase):
+    """An iterable of bytes, e.g. the chunks of a download, read as a file with readinto (see
+    FileCryptography.crypt_file); wrap it in an io.BufferedReader"""
+
+    def __init__(self, chunks):
+        """
+        Args:
+            chunks: an iterable of bytes, in order
+        """
+        self.chunks = iter(chunks)
+        self.chunk = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        """Copy the next bytes of the chunks into buffer; 0 at the end"""
+        while not self.chunk:
+            try:
+                self.chunk = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+        length = min(len(buffer), len(self.chunk))
+        buffer[:length] = self.chunk[:length]
+        self.chunk = self.chunk[length:]
+        return length
+
+
+def uses_io_buffers(additional_data: dict) -> bool:
+    """Whether files on disk in the format of additional_data are en/decrypted by FileCryptography.crypt_file"""
+    return globals.REUSE_IO_BUFFERS and additional_data.get('v', 1) >= 2 and 'c' not in additional_data
+
+
 class FileCryptography:
     """Class for encrypting files, keys or strings from the provided key"""
 
@@ -20,10 +193,19 @@ class FileCryptography:
         Args:
             key: the key for all en(de)cryption
         """
+        self.key = key
         self.aesgcm = AESGCM(key=key)
         hasher = sha3_512()
         hasher.update(key)
         self.hash = hasher.digest().hex()
+        cache_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'CloudIO name cache').derive(key)
+        self.name_cache = NameCache(AESGCM(cache_key),
+                                    globals.NAME_CACHE_FOLDER / self.hash[:32] if globals.NAME_CACHE_PERSIST else None)
+        self.chunker = Chunker(key)
+        index_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'CloudIO content index').derive(key)
+        self.content_index = ContentIndex(index_key, globals.CONTENT_INDEX_FOLDER / self.hash[:32])
+        metadata_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'CloudIO metadata').derive(key)
+        self.metadata_aesgcm = AESGCM(metadata_key)  # Seals what the metadata database keeps of packs
 
     def __hash__(self):
         return self.hash
@@ -53,7 +235,8 @@ class FileCryptography:
         return enc_file_name
 
     def encrypt_file(self, file_path: pl.Path, name_nonce: bytes, data_nonce: bytes) -> (pl.Path, dict):
-        """Encrypt file_path and return path of the encrypted file
+        """Encrypt file_path and return path of the encrypted file. Files are encrypted a segment at a time in the
+        format of globals.ENCRYPTION_FORMAT_VERSION (see encrypt_stream), compressed first if worth it
 
         Args:
             file_path: the path to the file to be encrypted
@@ -64,32 +247,230 @@ class FileCryptography:
             pl.Path: the path of the encrypted file
             dict: a dict with information about said file
         """
-        relative_file_path = file_path.relative_to(globals.WORK_DIR)
-        enc_file_name = self.encrypt_relative_file_path(relative_file_path, name_nonce)
-
-        file_mtime = file_path.stat().st_mtime  # Time of last modification of the file
-        additional_data = {'t': file_mtime,
-                           'n': enc_file_name,
-                           'nonce1': name_nonce.hex(),
-                           'nonce2': data_nonce.hex()}
-        additional_data_json = json.dumps(additional_data)
-
-        enc_file_path = pl.Path.joinpath(pl.Path(globals.TEMPORARY_FOLDER), enc_file_name)
         # Open the file to be encrypted and extract its data
         with open(file_path, 'rb') as file:
-            enc_file_data = self.aesgcm.encrypt(
-                data_nonce,
-                file.read(),
-                associated_data=bytes(additional_data_json, 'utf-8'))
+            additional_data = self.create_additional_data(file_path, name_nonce, data_nonce,
+                                                          sample=file.read(globals.COMPRESSION_SAMPLE_SIZE))
+            file.seek(0)
+            enc_file_path = pl.Path.joinpath(pl.Path(globals.TEMPORARY_FOLDER), additional_data['n'])
             try:
                 # create the enctpyted file
                 with open(enc_file_path, "wb") as enc_file:
-                    enc_file.write(enc_file_data)
+                    if uses_io_buffers(additional_data):
+                        self.crypt_file(file, enc_file, additional_data, decrypt=False)
+                    else:
+                        for enc_segment in self.encrypt_stream(file, additional_data):
+                            enc_file.write(enc_segment)
             except FileNotFoundError:
                 if platform.system() == "Windows" and len(enc_file_path) > 260:
                     print("Please enable NTFS long paths in your system.(Filesystem Registry entry)")
         return enc_file_path, additional_data
 
+    def open_encrypted(self, file_path: pl.Path, name_nonce: bytes, data_nonce: bytes) -> 'EncryptedFile':
+        """
+        The encrypted version of file_path, encrypted while it is read such that no ciphertext is written to disk
+
+        Args:
+            file_path: the path to the file to be encrypted
+            name_nonce: the nonce to encrypt the file name under along with self.key
+            data_nonce: the nonce to encrypt the file data under along with self.key
+
+        Returns:
+            EncryptedFile: the ciphertext of the file, to be read by the upload
+        """
+        with open(file_path, 'rb') as file:  # Raise PermissionError now, if the file is in use by another program
+            file_stat = os.fstat(file.fileno())
+            sample = file.read(globals.COMPRESSION_SAMPLE_SIZE)
+        return EncryptedFile(self, file_path, self.create_additional_data(file_path, name_nonce, data_nonce,
+                                                                          sample=sample), file_stat)
+
+    def encrypt_many(self, files: list) -> list:
+        """
+        Encrypt many small files at once, spread over the threads of the segment pool (see map_segments). Each file is
+        opened once, its size and modification time taken from the open file, and read whole into a buffer the thread
+        keeps for its next file. Files bigger than globals.BATCH_ENCRYPTION_MAX_SIZE are left to open_encrypted.
+
+        Args:
+            files: a list of (file_path, name_nonce, data_nonce), as for encrypt_file
+
+        Returns:
+            list: for each file, in the order of files, the ciphertext and additional data, None if the file is too big
+                for a batch, or the OSError or FileChangedError raised if it could not be read
+        """
+        return list(map_segments(self.encrypt_small_file, files))
+
+    def encrypt_small_file(self, file_path: pl.Path, name_nonce: bytes, data_nonce: bytes):
+        """The work of encrypt_many for one file, returning its result for the file"""
+        try:
+            with open(file_path, 'rb') as file:
+                file_stat = os.fstat(file.fileno())
+                if file_stat.st_size > globals.BATCH_ENCRYPTION_MAX_SIZE:
+                    return None
+                if len(getattr(_batch_buffers, 'buffer', b'')) <= file_stat.st_size:
+                    _batch_buffers.buffer = bytearray(max(file_stat.st_size + 1, 64 * 1024))
+                view = memoryview(_batch_buffers.buffer)
+                size = file.readinto(view[:file_stat.st_size + 1])  # A byte more, to notice the file growing
+            if size != file_stat.st_size:
+                raise FileChangedError(str(file_path) + " changed while being encrypted")
+            additional_data = self.create_additional_data(file_path, name_nonce, data_nonce, file_stat.st_mtime,
+                                                          view[:min(size, globals.COMPRESSION_SAMPLE_SIZE)])
+            return self.encrypt_bytes(view[:size], additional_data), additional_data
+        except (OSError, FileChangedError) as error:
+            return error
+
+    def encrypt_bytes(self, content, additional_data: dict) -> bytes:
+        """
+        Encrypt content held in memory on the calling thread, into the same ciphertext encrypt_stream gives
+
+        Args:
+            content: the bytes-like content of the file
+            additional_data: the additional data of the file, see create_additional_data
+
+        Returns:
+            bytes: the ciphertext
+        """
+        additional_data_bytes = bytes(json.dumps(additional_data), 'utf-8')
+        data_nonce = bytes.fromhex(additional_data['nonce2'])
+        if additional_data.get('v', 1) == 1:
+            return self.aesgcm.encrypt(data_nonce, content, associated_data=additional_data_bytes)
+        aesgcm = self.file_aesgcm(data_nonce)
+        segment_size = additional_data['s']
+        if 'c' in additional_data:
+            content = b''.join(compress_chunks([content], additional_data['c']))
+        segment_count = max(-(-len(content) // segment_size), 1)
+        return b''.join(aesgcm.encrypt(segment_nonce(index, index == segment_count - 1),
+                                       content[index * segment_size:(index + 1) * segment_size],
+                                       additional_data_bytes)
+                        for index in range(segment_count))
+
+    def decrypt_many(self, files: list) -> list:
+        """
+        Decrypt many small files held in memory into place at once, spread over the threads of the segment pool
+
+        Args:
+            files: a list of (enc_file_name, ciphertext, additional_data), see decrypt_into_place
+
+        Returns:
+            list: for each file, in the order of files, the path of the decrypted file, or the exception raised for it
+                (e.g. InvalidTag or OlderServerFileError)
+        """
+        def decrypt(enc_file_name, ciphertext: bytes, additional_data: dict):
+            try:
+                return self.decrypt_into_place(enc_file_name, [ciphertext], additional_data)
+            except Exception as error:
+                return error
+        return list(map_segments(decrypt, files))
+
+    def create_additional_data(self, file_path: pl.Path, name_nonce: bytes, data_nonce: bytes,
+                               file_mtime: float = None, sample: bytes = None) -> dict:
+        """
+        The additional data of a file about to be encrypted, authenticated along with its content
+
+        Args:
+            file_path: the path to the file to be encrypted
+            name_nonce: the nonce to encrypt the file name under along with self.key
+            data_nonce: the nonce to encrypt the file data under along with self.key
+            file_mtime: the time of last modification of the file, if already known
+            sample: the first globals.COMPRESSION_SAMPLE_SIZE bytes of the file, if already read
+
+        Returns:
+            dict: the modification time, encrypted name, nonces and, for the segmented format, version, segment size
+                and the codec the content is compressed with, if any
+        """
+        relative_file_path = file_path.relative_to(globals.WORK_DIR)
+        enc_file_name = self.encrypt_relative_file_path(relative_file_path, name_nonce)
+
+        if file_mtime is None:
+            file_mtime = file_path.stat().st_mtime  # Time of last modification of the file
+        additional_data = {'t': file_mtime,
+                           'n': enc_file_name,
+                           'nonce1': name_nonce.hex(),
+                           'nonce2': data_nonce.hex()}
+        if globals.ENCRYPTION_FORMAT_VERSION >= 2:
+            additional_data['v'] = globals.ENCRYPTION_FORMAT_VERSION
+            additional_data['s'] = globals.ENCRYPTION_SEGMENT_SIZE
+            if sample is None and globals.COMPRESSION:
+                with open(file_path, 'rb') as file:
+                    sample = file.read(globals.COMPRESSION_SAMPLE_SIZE)
+            codec = choose_codec(sample) if globals.COMPRESSION else None
+            if codec is not None:
+                additional_data['c'] = codec
+        return additional_data
+
+    def encrypt_stream(self, file, additional_data: dict):
+        """
+        Generator encrypting an open file into ciphertext in the format given by additional_data, holding at most a
+        segment in memory.
+
+        The segmented format (version 2) splits the content in segments of additional_data['s'] bytes, each encrypted
+        on its own, under a key derived for this file from self.key and the data nonce (see file_aesgcm), and a nonce
+        telling its place (see segment_nonce). The additional data is authenticated with every segment.
+        If the additional data names a codec ('c'), the content is compressed with it first, and the segments are of
+        the compressed content.
+        Version 1 (no 'v' in the additional data) is the whole content encrypted in one go, read into memory.
+
+        Args:
+            file: the file to encrypt, opened for reading bytes
+            additional_data: the additional data of the file, see create_additional_data
+
+        Yields:
+            bytes: the ciphertext, a segment at a time
+        """
+        additional_data_bytes = bytes(json.dumps(additional_data), 'utf-8')
+        data_nonce = bytes.fromhex(additional_data['nonce2'])
+        if additional_data.get('v', 1) == 1:
+            yield self.aesgcm.encrypt(data_nonce, file.read(), associated_data=additional_data_bytes)
+            return
+        aesgcm = self.file_aesgcm(data_nonce)
+        segment_size = additional_data['s']
+        chunks = iter(lambda: file.read(segment_size), b'')
+        if 'c' in additional_data:
+            chunks = compress_chunks(chunks, additional_data['c'])
+        yield from map_segments(
+            lambda index, segment, final: aesgcm.encrypt(segment_nonce(index, final), segment, additional_data_bytes),
+            ((index, segment, final) for index, (segment, final) in enumerate(read_segments(chunks, segment_size))))
+
+    def decrypt_stream(self, enc_chunks, additional_data: dict):
+        """
+        Generator decrypting ciphertext given in chunks of any size, holding at most a segment in memory.
+        Raises InvalidTag if a segment was changed, moved or dropped, or if the ciphertext is cut off.
+
+        Args:
+            enc_chunks: an iterable of bytes making up the ciphertext, in order
+            additional_data: the additional data of the file, telling the format (see encrypt_stream)
+
+        Yields:
+            bytes: the plaintext, a segment at a time
+        """
+        additional_data_bytes = bytes(json.dumps(additional_data), 'utf-8')
+        data_nonce = bytes.fromhex(additional_data['nonce2'])
+        if additional_data.get('v', 1) == 1:
+            yield self.aesgcm.decrypt(data_nonce, b''.join(enc_chunks), associated_data=additional_data_bytes)
+            return
+        aesgcm = self.file_aesgcm(data_nonce)
+        enc_segments = read_segments(enc_chunks, additional_data['s'] + TAG_SIZE)
+        segments = map_segments(
+            lambda index, enc_segment, final: aesgcm.decrypt(segment_nonce(index, final), enc_segment,
+                                                             additional_data_bytes),
+            ((index, enc_segment, final) for index, (enc_segment, final) in enumerate(enc_segments)))
+        if 'c' in additional_data:
+            segments = decompress_chunks(segments, additional_data['c'])
+        yield from segments
+
+    def file_aesgcm(self, data_nonce: bytes) -> AESGCM:
+        """
+        The cipher for the segments of one file, under a key derived from self.key and the data nonce of the file.
+        Every file having its own key leaves the whole nonce for the place of the segment.
+
+        Args:
+            data_nonce: the random data nonce of the file
+
+        Returns:
+            AESGCM: the cipher for the file
+        """
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=data_nonce, info=b'CloudIO segmented file')
+        return AESGCM(hkdf.derive(self.key))
+
     def decrypt_relative_file_path(self, enc_file_path, nonce: bytes) -> pl.Path:
         """
         Decrypt a relative file path into a pl.Path
@@ -116,7 +497,7 @@ class FileCryptography:
         return pl.Path(decrypted_file_path)
 
     def decrypt_file(self, file_path: pl.Path, additional_data: dict) -> pl.Path:
-        """Decrypt and create file, retun path of decrypted file
+        """Decrypt and create file, retun path of decrypted file. See decrypt_into_place
 
         Args:
             file_path (pl.Path) : the path of the encrypted file to be decrypted
@@ -126,7 +507,139 @@ class FileCryptography:
             pl.Path: the path leading to the location of the decrypted file
 
         """
-        dec_file_name = self.decrypt_relative_file_path(file_path, bytes.fromhex(additional_data['nonce1']))
+        with open(file_path, 'rb') as file:
+            if uses_io_buffers(additional_data):
+                return self.place_plaintext(
+                    file_path, additional_data, lambda dec_file: self.crypt_file(file, dec_file, additional_data,
+                                                                                 decrypt=True))
+            enc_chunks = iter(lambda: file.read(globals.ENCRYPTION_SEGMENT_SIZE + TAG_SIZE), b'')
+            return self.decrypt_into_place(file_path, enc_chunks, additional_data)
+
+    def crypt_file(self, source, destination, additional_data: dict, decrypt: bool, stream: bool = False):
+        """
+        Encrypt or decrypt an open file of the segmented format (uncompressed) into another, without making new bytes
+        for every segment: segments are read with readinto and en/decrypted into buffers, which are written from
+        and used again for later segments. The segments are spread over the segment pool as in map_segments, one per
+        thread at a time, and there is a pair of buffers for each and one for the segment being written.
+
+        Args:
+            source: the file to read, opened for reading bytes; its size tells how many segments there are
+            destination: the file to write, opened for writing bytes
+            additional_data: the additional data of the file, see create_additional_data
+            decrypt: True to decrypt source, False to encrypt it
+            stream: True if source is of unknown size, e.g. a download read through a BufferedReader over a
+                ChunksReader; the last segment is then told by peeking past it
+        """
+        additional_data_bytes = bytes(json.dumps(additional_data), 'utf-8')
+        aesgcm = self.file_aesgcm(bytes.fromhex(additional_data['nonce2']))
+        in_size = additional_data['s'] + TAG_SIZE if decrypt else additional_data['s']
+        size = None if stream else os.fstat(source.fileno()).st_size - source.tell()
+        segment_count = None if stream else max(-(-size // in_size), 1)
+        workers = max(globals.ENCRYPTION_WORKERS, 1)
+        buffers = Queue()
+        for _ in range(workers + 1 if stream else min(segment_count, workers + 1)):
+            buffer_size = in_size if stream else min(in_size, size)
+            buffers.put((bytearray(buffer_size), bytearray(buffer_size + TAG_SIZE)))
+
+        def read():
+            index = 0
+            while True:
+                in_buffer, out_buffer = buffers.get()  # Waits for a segment written if all are in use
+                if stream:
+                    length = source.readinto(in_buffer)
+                    final = length < in_size or not source.peek(1)
+                else:
+                    length = min(in_size, size - index * in_size)
+                    if source.readinto(memoryview(in_buffer)[:length]) != length:
+                        raise FileChangedError(str(source.name) + " changed while being read")
+                    final = index == segment_count - 1
+                yield index, final, memoryview(in_buffer)[:length], in_buffer, out_buffer
+                if final:
+                    return
+                index += 1
+
+        def crypt(index: int, final: bool, view: memoryview, in_buffer: bytearray, out_buffer: bytearray):
+            nonce = segment_nonce(index, final)
+            if decrypt:
+                out_view = memoryview(out_buffer)[:max(len(view) - TAG_SIZE, 0)]
+                decrypt_into(aesgcm, nonce, view, additional_data_bytes, out_view)
+            else:
+                out_view = memoryview(out_buffer)[:len(view) + TAG_SIZE]
+                encrypt_into(aesgcm, nonce, view, additional_data_bytes, out_view)
+            return out_view, (in_buffer, out_buffer)
+
+        for out_view, buffer_pair in map_segments(crypt, read(), workers):
+            destination.write(out_view)
+            buffers.put(buffer_pair)
+
+    def decrypt_into_place(self, enc_file_name, enc_chunks, additional_data: dict) -> pl.Path:
+        """Decrypt ciphertext as it comes, e.g. from a download, into the file it belongs in. The plaintext is written
+        next to its final place and only moved there once all of it has been authenticated, such that a damaged file
+        never replaces a good one and no half-written file is ever seen in its place
+
+        Args:
+            enc_file_name (str, pl.Path): the (encrypted) name of the file, telling where it belongs
+            enc_chunks: an iterable of bytes making up the ciphertext, in order
+            additional_data (dict) : the additional data needed for decryption, such as nonce
+
+        Returns:
+            pl.Path: the path leading to the location of the decrypted file
+
+        """
+        def write_plaintext(dec_file):
+            if uses_io_buffers(additional_data):
+                source = io.BufferedReader(ChunksReader(enc_chunks), globals.DOWNLOAD_CHUNK_SIZE)
+                self.crypt_file(source, dec_file, additional_data, decrypt=True, stream=True)
+                return
+            for dec_segment in self.decrypt_stream(enc_chunks, additional_data):
+                dec_file.write(dec_segment)
+        return self.place_plaintext(enc_file_name, additional_data, write_plaintext)
+
+    def decrypt_chunked_into_place(self, enc_file_name, enc_chunks, additional_data: dict, get_chunks) -> pl.Path:
+        """Decrypt a file sent as chunks (see ChunkedFile) into the file it belongs in: the manifest is decrypted,
+        and the chunks it lists are fetched, decrypted and written in order, as for decrypt_into_place
+
+        Args:
+            enc_file_name (str, pl.Path): the (encrypted) name of the file, telling where it belongs
+            enc_chunks: an iterable of bytes making up the ciphertext of the manifest, in order
+            additional_data (dict) : the additional data of the manifest
+            get_chunks: called with a list of chunk ids, giving an iterable of the encrypted chunks in that order,
+                e.g. ServComs.get_chunks
+
+        Returns:
+            pl.Path: the path leading to the location of the decrypted file
+
+        """
+        manifest = json.loads(b''.join(self.decrypt_stream(enc_chunks, additional_data)))
+
+        def write_plaintext(dec_file):
+            size = 0
+            chunk_ids = [chunk_id for chunk_id, _ in manifest['chunks']]
+            # One buffer for every chunk: the biggest chunk and its codec name
+            buffer = bytearray(max([chunk_size for _, chunk_size in manifest['chunks']] + [0]) + 256)
+            for (chunk_id, chunk_size), enc_chunk in zip(manifest['chunks'], get_chunks(chunk_ids)):
+                chunk = self.chunker.decrypt_chunk_into(chunk_id, enc_chunk, buffer)
+                if len(chunk) != chunk_size:
+                    raise InvalidTag
+                dec_file.write(chunk)
+                size += chunk_size
+            if size != manifest['size']:
+                raise InvalidTag
+        return self.place_plaintext(enc_file_name, additional_data, write_plaintext)
+
+    def place_plaintext(self, enc_file_name, additional_data: dict, write_plaintext) -> pl.Path:
+        """
+        Write a decrypted file next to its place, and move it there once written, see decrypt_into_place
+
+        Args:
+            enc_file_name (str, pl.Path): the (encrypted) name of the file, telling where it belongs
+            additional_data (dict) : the additional data of the file
+            write_plaintext: called with the file to write the plaintext to, opened for writing bytes
+
+        Returns:
+            pl.Path: the path leading to the location of the decrypted file
+        """
+        dec_file_name = self.decrypt_relative_file_path(enc_file_name, bytes.fromhex(additional_data['nonce1']))
         dec_file_path = pl.Path.joinpath(globals.WORK_DIR, dec_file_name)
         # Check if we already have the file, and if so, if it is newer than our own version
         if dec_file_path.exists():
@@ -135,19 +648,20 @@ class FileCryptography:
             if last_mod_time_c > last_mod_time_s:
                 raise OlderServerFileError("Server send old file to replace local version!")
             # ToDo: Exit gracefully ?
-        additional_data_json = json.dumps(additional_data)
         dec_file_path.parent.mkdir(parents=True, exist_ok=True)  # ToDO: Access and Modify data is not true for folders
-        # Open the encrypted file, decrypt it and safe its content to a new file
-        with open(file_path, 'rb') as file:
-            dec_file_data = self.aesgcm.decrypt(
-                bytes.fromhex(additional_data['nonce2']),
-                file.read(),
-                associated_data=bytes(additional_data_json, 'utf-8'))
-            with open(dec_file_path, "wb+") as dec_file:
-                dec_file.write(dec_file_data)
-        #  Set access and modify as per additional data:
-        file_last_mod = additional_data["t"]
-        os.utime(str(dec_file_path), (file_last_mod, file_last_mod))
+        partial_file_path = dec_file_path.with_name(dec_file_path.name + globals.PARTIAL_FILE_SUFFIX)
+        # Decrypt the ciphertext and safe its content to a new file
+        try:
+            with open(partial_file_path, "wb") as dec_file:
+                write_plaintext(dec_file)
+            #  Set access and modify as per additional data:
+            file_last_mod = additional_data["t"]
+            os.utime(str(partial_file_path), (file_last_mod, file_last_mod))
+            os.replace(partial_file_path, dec_file_path)
+        except BaseException:  # E.g. InvalidTag or a broken download; leave no damaged plaintext around
+            if partial_file_path.exists():
+                partial_file_path.unlink()
+            raise
         return dec_file_path
 
     def decrypt_server_file_list(self, enc_relative_path_list_with_nonces_and_timestamp: list) -> dict:
@@ -159,15 +673,58 @@ class FileCryptography:
         Returns:
             dict: a dictionary where each sub-list has been made into a FileInfo object with path as key
 
+        Names decrypted before are taken from self.name_cache, so listing again only decrypts the new files.
+        Big listings are decrypted in chunks of globals.LISTING_CHUNK_SIZE on the segment pool (see map_segments);
+        the chunks are merged in order, so the result and the first error raised are as if decrypted one by one.
         """
+        entries = enc_relative_path_list_with_nonces_and_timestamp
+        chunks = ((entries[start:start + globals.LISTING_CHUNK_SIZE],)
+                  for start in range(0, len(entries), globals.LISTING_CHUNK_SIZE))
         file_dict = {}
-        for enc_relative_path, nonce, time_stamp in enc_relative_path_list_with_nonces_and_timestamp:
-            nonce = bytes.fromhex(nonce)
-            time_stamp = float(time_stamp)
-            dec_file_rel_path = self.decrypt_relative_file_path(enc_relative_path, nonce)  # Assert Succeeds
-            file_dict[dec_file_rel_path] = globals.FileInfo(dec_file_rel_path, nonce, enc_relative_path, time_stamp)
+        for file_infos in map_segments(self.decrypt_listing_chunk, chunks):
+            for fio in file_infos:
+                file_dict[fio.path] = fio
+        self.name_cache.save()
         return file_dict
 
+    def decrypt_listing_chunk(self, entries: list) -> list:
+        """
+        The work of decrypt_server_file_list for a chunk of the listing
+
+        Args:
+            entries: lists of encrypted name, nonce as hex and time stamp
+
+        Returns:
+            list: a FileInfo for each entry, in order
+        """
+        keys = [(enc_relative_path, bytes.fromhex(nonce)) for enc_relative_path, nonce, _ in entries]
+        file_infos = []
+        decrypted = []
+        try:
+            for (enc_relative_path, nonce), (_, _, time_stamp), dec_file_rel_path in \
+                    zip(keys, entries, self.name_cache.get_many(keys)):
+                if dec_file_rel_path is None:
+                    dec_file_rel_path = self.decrypt_listed_name(enc_relative_path, nonce)  # Assert Succeeds
+                    decrypted.append(((enc_relative_path, nonce), dec_file_rel_path))
+                file_infos.append(globals.FileInfo(dec_file_rel_path, nonce, enc_relative_path, float(time_stamp)))
+        finally:  # Also keep what was decrypted before a bad name
+            self.name_cache.put_many(decrypted)
+        return file_infos
+
+    def decrypt_listed_name(self, enc_file_name: str, nonce: bytes) -> pl.Path:
+        """
+        decrypt_relative_file_path for the names in listings, plain '<hex>.cio', taking them apart as text instead
+        of as paths. Anything else is left to decrypt_relative_file_path, so the checks and errors are the same
+        """
+        if not isinstance(enc_file_name, str) or not enc_file_name.endswith('.cio') or len(enc_file_name) == len('.cio') \
+                or '/' in enc_file_name or '\\' in enc_file_name:
+            return self.decrypt_relative_file_path(enc_file_name, nonce)
+        decrypted_file_path = self.aesgcm.decrypt(nonce, bytes.fromhex(enc_file_name[:-len('.cio')]),
+                                                  associated_data=None).decode(encoding='utf-8')
+        if ".." in decrypted_file_path.split("/"):
+            raise PermissionError("Not allowed to ascend folder structure! Don't trust the sender of this file D:")
+        return pl.Path(decrypted_file_path)
+
     def encrypt_key(self, key: bytes, nonce: bytes) -> bytes:
         """Encrypts a key with this file_crypts key
 
@@ -192,3 +749,249 @@ class FileCryptography:
             bytes: the byte representation of the decrypted key
         """
         return self.aesgcm.decrypt(nonce, key_ct, associated_data=None)
+
+
+class EncryptedFile:
+    """
+    The ciphertext of a file, computed from the plaintext file when read. Any range of segments can be read on its
+    own, as segments are encrypted independently; the ciphertext is the same every time it is read.
+    Compressed files and files in the one-piece format (version 1) are not seekable; their segments depend on all of
+    the content before them, so reading a range encrypts the whole file, and size is only an estimate.
+    Every read encrypts the file again under the same nonces, so it must still be the file it was opened as: reads
+    raise FileChangedError once its size or modification time is another. As a rewrite within one tick of the clock
+    keeps both, the hash of every piece of plaintext is also recorded the first time it is encrypted, and a piece
+    read with other content later is never encrypted (see check_piece).
+    """
+
+    def __init__(self, file_crypt: FileCryptography, file_path: pl.Path, additional_data: dict,
+                 file_stat: os.stat_result = None):
+        """
+        Args:
+            file_crypt: the FileCryptography to encrypt with
+            file_path: the path of the (plaintext) file
+            additional_data: the additional data of the file, see FileCryptography.create_additional_data
+            file_stat: the stat of the file when it was opened, if not now
+        """
+        self.file_crypt = file_crypt
+        self.file_path = file_path
+        self.additional_data = additional_data
+        file_stat = file_stat or file_path.stat()
+        self.plain_size = file_stat.st_size
+        self.mtime_ns = file_stat.st_mtime_ns
+        self.version = additional_data.get('v', 1)
+        self.seekable = self.version != 1 and 'c' not in additional_data
+        if self.version == 1:
+            self.segment_count = 1
+            self.alignment = 1
+            self.size = self.plain_size + TAG_SIZE
+        else:
+            self.segment_count = max(-(-self.plain_size // additional_data['s']), 1)
+            self.alignment = additional_data['s'] + TAG_SIZE if self.seekable else 1  # Ranges start at a segment
+            self.size = self.plain_size + self.segment_count * TAG_SIZE  # For compressed files, at most about this
+        if self.seekable:
+            self.aesgcm = file_crypt.file_aesgcm(bytes.fromhex(additional_data['nonce2']))
+            self.additional_data_bytes = bytes(json.dumps(additional_data), 'utf-8')
+            self.buffers = Queue()  # Buffers segments are read into, used again by later reads (see read_range)
+        self.piece_hashes = {}  # Offset -> hash of the plaintext read there the first time, see check_piece
+
+    def check_unchanged(self, file):
+        """Raise FileChangedError if the open file is not the file as it was opened, see the class"""
+        file_stat = os.fstat(file.fileno())
+        if file_stat.st_size != self.plain_size or file_stat.st_mtime_ns != self.mtime_ns:
+            raise FileChangedError(str(self.file_path) + " changed while being sent")
+
+    def check_piece(self, offset: int, piece):
+        """
+        Raise FileChangedError if a piece of plaintext about to be encrypted is not what was read at its offset the
+        first time, recording its hash if it is the first time. Called from the threads of the segment pool
+
+        Args:
+            offset: where in the file the piece is
+            piece: the plaintext read there (bytes-like)
+        """
+        piece_hash = blake2b(piece, digest_size=16).digest()
+        if self.piece_hashes.setdefault(offset, piece_hash) != piece_hash:
+            raise FileChangedError(str(self.file_path) + " changed while being sent")
+
+    def chunks(self):
+        """Generator giving the whole ciphertext, a segment at a time (or, through reused buffers, about
+        globals.UPLOAD_CHUNK_SIZE at a time; see read_range), reading the file once"""
+        with open(self.file_path, 'rb') as file:
+            self.check_unchanged(file)
+            if self.seekable:
+                step = max(globals.UPLOAD_CHUNK_SIZE // self.alignment, 2 * globals.ENCRYPTION_WORKERS, 1)
+                for first in range(0, self.segment_count, step):
+                    yield bytes(self.read_range(file, first, min(first + step, self.segment_count)))
+            else:
+                yield from self.file_crypt.encrypt_stream(CheckedReader(file, self.check_piece), self.additional_data)
+            self.check_unchanged(file)
+
+    def read(self, offset: int, length: int) -> bytes:
+        """
+        Read a range of the ciphertext, encrypting only the segments in it
+
+        Args:
+            offset: the first byte of the range; a multiple of self.alignment
+            length: the amount of bytes to read
+
+        Returns:
+            bytes: the ciphertext in the range
+        """
+        if not self.seekable:
+            return b''.join(self.chunks())[offset:offset + length]
+        if offset % self.alignment:
+            raise ValueError("Ranges of segmented ciphertext must start at a segment")
+        first = offset // self.alignment
+        last = min(-(-(offset + length) // self.alignment), self.segment_count)
+        with open(self.file_path, 'rb') as file:
+            self.check_unchanged(file)
+            return bytes(memoryview(self.read_range(file, first, last))[:length])
+
+    def read_range(self, file, first: int, last: int) -> bytearray:
+        """
+        Encrypt segments of the open file into one buffer, without making new bytes for every segment: each is read
+        with readinto into a buffer used again by later reads, and encrypted into its place in the range. The
+        segments are spread over the segment pool, as in map_segments
+
+        Args:
+            file: the file, opened for reading bytes
+            first: the index of the first segment
+            last: the index after the last segment
+
+        Returns:
+            bytearray: the ciphertext of the segments
+        """
+        segment_size = self.additional_data['s']
+        ciphertext = bytearray(max(min(last * self.alignment, self.size) - first * self.alignment, 0))
+        ciphertext_view = memoryview(ciphertext)
+
+        def read_segments_in_range():
+            file.seek(first * segment_size)
+            for index in range(first, last):
+                final = index == self.segment_count - 1
+                length = self.plain_size - index * segment_size if final else segment_size
+                try:
+                    buffer = self.buffers.get_nowait()
+                except Empty:
+                    buffer = bytearray(segment_size)
+                if file.readinto(memoryview(buffer)[:length]) != length:
+                    raise FileChangedError(str(self.file_path) + " changed while being sent")
+                yield index, final, buffer, length
+
+        def encrypt(index: int, final: bool, buffer: bytearray, length: int):
+            start = (index - first) * self.alignment
+            self.check_piece(index * segment_size, memoryview(buffer)[:length])
+            encrypt_into(self.aesgcm, segment_nonce(index, final), memoryview(buffer)[:length],
+                         self.additional_data_bytes, ciphertext_view[start:start + length + TAG_SIZE])
+            self.buffers.put(buffer)
+
+        for _ in map_segments(encrypt, read_segments_in_range()):
+            pass
+        return ciphertext
+
+    def read_all(self) -> bytes:
+        """The whole ciphertext, in memory"""
+        return b''.join(self.chunks())
+
+    def content_hash(self) -> str:
+        """The keyed hash of the plaintext, see ContentIndex.content_hash"""
+        return self.file_crypt.content_index.content_hash(self.file_path)
+
+    def chunked(self) -> 'ChunkedFile':
+        """The same file, to be sent as deduplicated chunks instead, see ChunkedFile"""
+        return ChunkedFile(self.file_crypt, self.file_path, self.additional_data)
+
+
+class CheckedReader:
+    """File-like wrapper of an open file giving every piece read to a check before handing it on, see
+    EncryptedFile.check_piece"""
+
+    def __init__(self, file, check):
+        self.file = file
+        self.check = check
+        self.position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        piece = self.file.read(size)
+        self.check(self.position, piece)
+        self.position += len(piece)
+        return piece
+
+
+class ChunkedFile:
+    """
+    A file sent as chunks (see security/chunking.py): every chunk is encrypted on its own and stored on the server
+    under its id, once, whatever files and versions it is in, so only the chunks the server lacks are sent.
+    A manifest listing the chunks of the file in order is encrypted and sent as the file itself, with 'm' in its
+    additional data.
+    """
+
+    def __init__(self, file_crypt: FileCryptography, file_path: pl.Path, additional_data: dict):
+        """
+        Args:
+            file_crypt: the FileCryptography to encrypt with
+            file_path: the path of the (plaintext) file
+            additional_data: the additional data of the file, see FileCryptography.create_additional_data
+        """
+        self.file_crypt = file_crypt
+        self.file_path = file_path
+        self.additional_data = additional_data
+        self.chunks = []  # [chunk id, size] of every chunk, in order
+        self.locations = {}  # chunk id -> (offset, size) of the first chunk with it
+        self.size = 0
+
+    def chunk_ids(self) -> list:
+        """
+        Split the file into chunks, reading it once
+
+        Returns:
+            list: the ids of the chunks of the file, each once
+        """
+        chunker = self.file_crypt.chunker
+        with open(self.file_path, 'rb') as file:
+            file_stat = os.fstat(file.fileno())
+            for chunk in chunker.split(file):
+                chunk_id = chunker.chunk_id(chunk)
+                self.chunks.append([chunk_id, len(chunk)])
+                self.locations.setdefault(chunk_id, (self.size, len(chunk)))
+                self.size += len(chunk)
+            if self.size != file_stat.st_size or os.fstat(file.fileno()).st_mtime_ns != file_stat.st_mtime_ns:
+                raise FileChangedError(str(self.file_path) + " changed while being split into chunks")
+        return list(self.locations)
+
+    def read_chunk(self, chunk_id: str) -> bytes:
+        """
+        Read a chunk from the file again and encrypt it, see Chunker.encrypt_chunk
+
+        Args:
+            chunk_id: the id of the chunk, as given by chunk_ids
+
+        Returns:
+            bytes: the encrypted chunk
+        """
+        offset, size = self.locations[chunk_id]
+        with open(self.file_path, 'rb') as file:
+            file.seek(offset)
+            chunk = file.read(size)
+        if self.file_crypt.chunker.chunk_id(chunk) != chunk_id:
+            raise FileChangedError(str(self.file_path) + " changed while being sent")
+        return self.file_crypt.chunker.encrypt_chunk(chunk_id, chunk)
+
+    def manifest(self) -> (bytes, dict):
+        """
+        The encrypted manifest of the file, to be sent once the chunks are on the server
+
+        Returns:
+            bytes: the ciphertext of the manifest, in the segmented format
+            dict: its additional data; that of the file, with 'm' added, the codec chosen for the manifest and a new
+                nonce2. The file itself may have been, or be, encrypted under the nonce2 of the file (e.g. an upload
+                resumed from the journal), and the manifest must never be encrypted under the same key and nonce
+        """
+        content = bytes(json.dumps({'size': self.size, 'chunks': self.chunks}), 'utf-8')
+        additional_data = {key: value for key, value in self.additional_data.items() if key != 'c'}
+        additional_data['m'] = 1
+        additional_data['nonce2'] = globals.generate_random_nonce().hex()
+        codec = choose_codec(content[:globals.COMPRESSION_SAMPLE_SIZE]) if globals.COMPRESSION else None
+        if codec is not None:
+            additional_data['c'] = codec
+        return self.file_crypt.encrypt_bytes(content, additional_data), additional_data
@@ -0,0 +1,127 @@
+import json
+import os
+import pathlib as pl
+from collections import OrderedDict
+from json import JSONDecodeError
+from threading import Lock
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from resources import globals
+
+
+class NameCache:
+    """
+    The decrypted names of server files, by their encrypted name and nonce; the name of a file never changes for those.
+    Holds at most globals.NAME_CACHE_SIZE names, forgetting the least recently used first. If a cache path is given
+    the names are kept on disk between runs, encrypted.
+    """
+
+    def __init__(self, aesgcm: AESGCM, cache_path: pl.Path = None):
+        """
+        Args:
+            aesgcm: the cipher to encrypt the cache on disk with
+            cache_path: where to keep the cache between runs, None to only keep it in memory
+        """
+        self.aesgcm = aesgcm
+        self.cache_path = cache_path
+        self.lock = Lock()
+        self.names = None  # (encrypted name, nonce) -> decrypted relative path, loaded at first use
+        self.changed = False
+
+    def load(self) -> OrderedDict:
+        """Read the cache from disk the first time, call holding the lock. A missing or damaged cache is started over"""
+        if self.names is not None:
+            return self.names
+        self.names = OrderedDict()
+        if self.cache_path is None:
+            return self.names
+        try:
+            with open(self.cache_path, "rb") as file:
+                content = file.read()
+            names = json.loads(self.aesgcm.decrypt(content[:12], content[12:], associated_data=None))
+        except (FileNotFoundError, InvalidTag, JSONDecodeError, ValueError):
+            return self.names
+        for enc_file_name, nonce, path in names[-globals.NAME_CACHE_SIZE:]:
+            self.names[(enc_file_name, bytes.fromhex(nonce))] = pl.Path(path)
+        return self.names
+
+    def get(self, enc_file_name: str, nonce: bytes) -> pl.Path:
+        """
+        Args:
+            enc_file_name: the encrypted name of the file
+            nonce: the nonce the name is encrypted under
+
+        Returns:
+            pl.Path: the decrypted name, None if not known
+        """
+        key = (enc_file_name, nonce)
+        with self.lock:
+            names = self.load()
+            path = names.get(key, None)
+            if path is not None:
+                names.move_to_end(key)
+            return path
+
+    def put(self, enc_file_name: str, nonce: bytes, path: pl.Path):
+        """Remember the decrypted name of a file, see get"""
+        with self.lock:
+            names = self.load()
+            names[(enc_file_name, nonce)] = path
+            names.move_to_end((enc_file_name, nonce))
+            while len(names) > globals.NAME_CACHE_SIZE:
+                names.popitem(last=False)
+            self.changed = True
+
+    def get_many(self, keys: list) -> list:
+        """
+        get for many names at once, taking the lock once
+
+        Args:
+            keys: a list of (encrypted name, nonce)
+
+        Returns:
+            list: the decrypted name of each, None for those not known
+        """
+        with self.lock:
+            names = self.load()
+            paths = [names.get(key, None) for key in keys]
+            for key, path in zip(keys, paths):
+                if path is not None:
+                    names.move_to_end(key)
+            return paths
+
+    def put_many(self, items: list):
+        """
+        put for many names at once, taking the lock once
+
+        Args:
+            items: a list of ((encrypted name, nonce), decrypted name)
+        """
+        if not items:
+            return
+        with self.lock:
+            names = self.load()
+            names.update(items)
+            while len(names) > globals.NAME_CACHE_SIZE:
+                names.popitem(last=False)
+            self.changed = True
+
+    def save(self):
+        """Write the cache to disk if it changed, replacing the old one in one step"""
+        if self.cache_path is None:
+            return
+        with self.lock:
+            if not self.changed:
+                return
+            names = [[enc_file_name, nonce.hex(), path.as_posix()]
+                     for (enc_file_name, nonce), path in self.names.items()]
+            nonce = globals.generate_random_nonce()
+            content = nonce + self.aesgcm.encrypt(nonce, bytes(json.dumps(names), 'utf-8'), associated_data=None)
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.cache_path.with_name(self.cache_path.name + '.tmp')
+            with open(tmp_path, "wb") as file:
+                file.write(content)
+            os.replace(tmp_path, self.cache_path)
+            self.changed = False
@@ -0,0 +1,110 @@
+import json
+import pathlib as pl
+import time
+from threading import Lock
+
+from resources import globals
+
+PACK_FOLDER = '.cio-packs'  # Folder the packs of a folder are named in on the server; never a local folder
+DELETED_SUFFIX = '.deleted'  # Ending of the name of the list of deleted members of a pack
+INDEX_LENGTH_SIZE = 8  # Bytes starting every pack, the big-endian length of its encrypted index
+
+
+def is_pack_path(rel_path: pl.Path) -> bool:
+    """Whether a (decrypted) server file name is that of a pack or the list of deleted members of one"""
+    return PACK_FOLDER in rel_path.parts
+
+
+def deleted_list_path(pack_path: pl.Path) -> pl.Path:
+    """The name of the list of deleted members of the pack of the given name"""
+    return pack_path.with_name(pack_path.name + DELETED_SUFFIX)
+
+
+def build_pack(file_crypt, pack_path: pl.Path, members: list) -> (bytes, dict, list):
+    """
+    Put many small encrypted files together in one pack: the length of the index, the encrypted index and the
+    files, each as encrypted on its own. The index lists, for every file, its relative path, where it is in the pack
+    and its additional data; it is encrypted with the additional data of the pack, so it belongs to that pack only.
+
+    Args:
+        file_crypt: the FileCryptography of the folder
+        pack_path: the relative path the pack is named by, in the PACK_FOLDER of the folder
+        members: (relative path, ciphertext, additional data) of every file
+
+    Returns:
+        bytes: the content of the pack
+        dict: the additional data of the pack
+        list: the index, with where each file is from the start of the pack
+    """
+    index = []
+    offset = 0
+    for rel_path, ciphertext, additional_data in members:
+        index.append([rel_path.as_posix(), offset, len(ciphertext), additional_data])
+        offset += len(ciphertext)
+    index_content = bytes(json.dumps(index), 'utf-8')
+    additional_data = file_crypt.create_additional_data(
+        pl.Path.joinpath(globals.WORK_DIR, pack_path), globals.generate_random_nonce(), globals.generate_random_nonce(),
+        time.time(), index_content[:globals.COMPRESSION_SAMPLE_SIZE])
+    enc_index = file_crypt.encrypt_bytes(index_content, additional_data)
+    data_start = INDEX_LENGTH_SIZE + len(enc_index)
+    for entry in index:
+        entry[1] += data_start
+    content = b''.join([len(enc_index).to_bytes(INDEX_LENGTH_SIZE, 'big'), enc_index] +
+                       [ciphertext for _, ciphertext, _ in members])
+    return content, additional_data, index
+
+
+def read_pack_index(file_crypt, read_range) -> (list, dict):
+    """
+    Read the index of a pack from its start, see build_pack. Raises InvalidTag if it is damaged or of another pack
+
+    Args:
+        file_crypt: the FileCryptography of the folder
+        read_range: called with an offset and length, giving that range of the pack and the additional data of the
+            pack, as ServComs.get_file_range
+
+    Returns:
+        list: the index, with where each file is from the start of the pack
+        dict: the additional data of the pack
+    """
+    start, additional_data = read_range(0, globals.PACK_INDEX_READ_SIZE)
+    index_length = int.from_bytes(start[:INDEX_LENGTH_SIZE], 'big')
+    enc_index = start[INDEX_LENGTH_SIZE:INDEX_LENGTH_SIZE + index_length]
+    if len(enc_index) < index_length:  # A big index; read the rest of it
+        enc_index += read_range(len(start), index_length - len(enc_index))[0]
+    index = json.loads(b''.join(file_crypt.decrypt_stream([enc_index], additional_data)))
+    data_start = INDEX_LENGTH_SIZE + index_length
+    for entry in index:
+        entry[1] += data_start
+    return index, additional_data
+
+
+class Pack:
+    """A pack on the server, with what we know of its members"""
+
+    def __init__(self, fio: globals.FileInfo, index: list):
+        """
+        Args:
+            fio: the FileInfo of the pack on the server
+            index: the index of the pack, see read_pack_index
+        """
+        self.fio = fio
+        self.index = index
+        self.deleted = set()  # Relative paths (posix) of the members deleted or replaced since the pack was sent
+        self.deleted_fio = None  # The FileInfo of the list of deleted members on the server, if there is one
+        self.send_lock = Lock()  # Held while the list of deleted members is sent or the pack repacked, one at a time
+
+    def live_members(self) -> list:
+        """The entries of the index of the members not deleted or replaced"""
+        return [entry for entry in self.index if entry[0] not in self.deleted]
+
+    def member_infos(self) -> list:
+        """The FileInfo of every member not deleted or replaced, telling where in the pack it is"""
+        return [globals.FileInfo(pl.Path(rel_path), bytes.fromhex(additional_data['nonce1']), additional_data['n'],
+                                 additional_data['t'], pack=self.fio.enc_path,
+                                 member=(offset, length, additional_data))
+                for rel_path, offset, length, additional_data in self.live_members()]
+
+    def needs_repack(self) -> bool:
+        """Whether enough of the members are deleted or replaced for the pack to be repacked"""
+        return len(self.deleted) >= len(self.index) * globals.PACK_REPACK_RATIO
@@ -0,0 +1,94 @@
+"""
+Measure how the encryption and decryption of one large file scale with the amount of threads working on its segments
+(globals.ENCRYPTION_WORKERS), and the peak memory of encrypting and decrypting a file on disk with and without
+globals.REUSE_IO_BUFFERS. Not part of the unit tests; run from the project folder with
+
+    python -m tests.benchmark_encryption [size in MiB] [most threads]
+"""
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+from resources import globals
+from security.filecryptography import FileCryptography
+
+
+def measure(file_crypt: FileCryptography, content: bytes, additional_data: dict, workers: int) -> (float, float):
+    """
+    Encrypt and decrypt content on the given amount of threads
+
+    Returns:
+        float: the encryption throughput in MiB/s
+        float: the decryption throughput in MiB/s
+    """
+    globals.ENCRYPTION_WORKERS = workers
+    start = time.perf_counter()
+    enc_segments = list(file_crypt.encrypt_stream(io.BytesIO(content), additional_data))
+    encrypted = time.perf_counter()
+    for _ in file_crypt.decrypt_stream(enc_segments, additional_data):
+        pass
+    decrypted = time.perf_counter()
+    size = len(content) / (1024 * 1024)
+    return size / (encrypted - start), size / (decrypted - encrypted)
+
+
+def measure_memory(file_crypt: FileCryptography, size_mib: int, reuse_buffers: bool) -> (float, float, float):
+    """
+    Encrypt a file of size_mib MiB to disk and decrypt it again, with or without reused buffers
+
+    Returns:
+        float: the peak of memory allocated by Python while encrypting, in MiB
+        float: the peak of memory allocated by Python while decrypting, in MiB
+        float: the seconds taken in all
+    """
+    globals.REUSE_IO_BUFFERS = reuse_buffers
+    file_path = globals.TEMPORARY_FOLDER / "benchmark_plaintext"
+    with open(file_path, 'wb') as file:
+        for _ in range(size_mib):
+            file.write(os.urandom(1024 * 1024))
+    try:
+        start = time.perf_counter()
+        tracemalloc.start()
+        enc_file_path, additional_data = file_crypt.encrypt_file(file_path, globals.generate_random_nonce(),
+                                                                 globals.generate_random_nonce())
+        encrypt_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        file_crypt.decrypt_file(enc_file_path, additional_data)
+        decrypt_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        seconds = time.perf_counter() - start
+        enc_file_path.unlink()
+    finally:
+        file_path.unlink()
+    return encrypt_peak / (1024 * 1024), decrypt_peak / (1024 * 1024), seconds
+
+
+def main(size_mib: int = 256, max_workers: int = None):
+    max_workers = max_workers or os.cpu_count() or 1
+    file_crypt = FileCryptography(globals.generate_random_key())
+    content = os.urandom(size_mib * 1024 * 1024)
+    additional_data = {'t': 0, 'n': 'benchmark.cio', 'nonce1': globals.generate_random_nonce().hex(),
+                       'nonce2': globals.generate_random_nonce().hex(),
+                       'v': globals.ENCRYPTION_FORMAT_VERSION, 's': globals.ENCRYPTION_SEGMENT_SIZE}
+    print("{} MiB in segments of {} KiB, {} cores".format(size_mib, globals.ENCRYPTION_SEGMENT_SIZE // 1024,
+                                                          os.cpu_count()))
+    print("threads  encrypt MiB/s  decrypt MiB/s  speedup")
+    baseline = None
+    for workers in sorted({2 ** power for power in range(max_workers.bit_length()) if 2 ** power <= max_workers}
+                          | {max_workers}):
+        encrypt_rate, decrypt_rate = measure(file_crypt, content, additional_data, workers)
+        baseline = baseline or encrypt_rate
+        print("{:7d}  {:13.0f}  {:13.0f}  {:7.2f}".format(workers, encrypt_rate, decrypt_rate, encrypt_rate / baseline))
+    globals.ENCRYPTION_WORKERS = max_workers
+    print("\nfile on disk, {} threads   encrypt peak MiB  decrypt peak MiB  seconds".format(max_workers))
+    for reuse_buffers in (False, True):
+        encrypt_peak, decrypt_peak, seconds = measure_memory(file_crypt, size_mib, reuse_buffers)
+        print("{:26}  {:16.1f}  {:16.1f}  {:7.2f}".format("reused buffers" if reuse_buffers else "new bytes per segment",
+                                                          encrypt_peak, decrypt_peak, seconds))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(argument) for argument in sys.argv[1:3]]))
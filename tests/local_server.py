@@ -0,0 +1,396 @@
+import datetime
+import gzip
+import hashlib
+import inspect
+import json
+import os
+import pathlib as pl
+import ssl
+import tempfile
+import threading
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from network.listing import encode_listing, LISTING_CONTENT_TYPE
+
+
+class LocalServer:
+    """Stand-in for the CloudIOServer, serving over TLS on localhost such that ServComs can be tested offline"""
+
+    def __init__(self, binary_downloads: bool = True, stream_uploads: bool = True, bulk_archive: bool = True,
+                 incremental_listing: bool = True, compression: bool = True, binary_listing: bool = True,
+                 multipart_uploads: bool = True, ranged_downloads: bool = True, chunk_store: bool = True):
+        """
+        Args:
+            binary_downloads: whether to offer the raw binary download format, otherwise only the legacy JSON format
+            stream_uploads: whether to accept streamed (chunked) uploads
+            bulk_archive: whether to accept archiving many files in one request
+            incremental_listing: whether to hand out cursors and list only the changes since a cursor
+            compression: whether to gzip JSON and listing responses for clients accepting it
+            binary_listing: whether to offer the compact binary listing format, otherwise only JSON
+            multipart_uploads: whether to accept uploads in parts
+            ranged_downloads: whether to answer Range requests for files with only the range asked for
+            chunk_store: whether to keep chunks of files sent as chunks
+        """
+        self.binary_downloads = binary_downloads
+        self.stream_uploads = stream_uploads
+        self.bulk_archive = bulk_archive
+        self.incremental_listing = incremental_listing
+        self.compression = compression
+        self.binary_listing = binary_listing
+        self.multipart_uploads = multipart_uploads
+        self.ranged_downloads = ranged_downloads
+        self.chunk_store = chunk_store
+        self.uploads = {}  # upload_id -> (userID, additional_data, size, {index -> part content})
+        self.users = {}  # userID -> {enc_file_name -> (content, additional_data)}
+        self.chunks = {}  # userID -> {chunk_id -> content}
+        self.generation = 0  # Increased by every change, handed out as listing cursor
+        self.oldest_cursor = 0  # Cursors from before a reset can not be answered with changes
+        self.changed = {}  # userID -> {enc_file_name -> generation it was (re)uploaded}
+        self.archived = {}  # userID -> {enc_file_name -> generation it was archived}
+        self.lock = threading.RLock()
+        self.request_log = []  # (method, path) of every request received
+        self.registrations = 0
+        # [status, endpoint, after]: answer the next request to endpoint (None for any) with status instead of
+        # handling it, after letting the first after requests through. A status of None drops the connection, a
+        # status of 'truncate' handles the request but drops the connection halfway through the body of the answer
+        self.faults = []
+        self.cert_dir = tempfile.TemporaryDirectory()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.stand_in = self
+        self.httpd.socket = self.create_ssl_context().wrap_socket(self.httpd.socket, server_side=True)
+        self.location = '127.0.0.1:' + str(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self) -> str:
+        """
+        Start serving in a background thread
+
+        Returns:
+            str: the location of the server, to be given to ServComs
+        """
+        self.thread.start()
+        return self.location
+
+    def stop(self):
+        """Stop serving and remove the certificate"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.cert_dir.cleanup()
+
+    def create_ssl_context(self) -> ssl.SSLContext:
+        """Create a self-signed certificate for localhost and a server side SSL context using it"""
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+            .public_key(private_key.public_key()).serial_number(x509.random_serial_number()) \
+            .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=1)) \
+            .sign(private_key, hashes.SHA256())
+        cert_path = pl.Path(self.cert_dir.name) / 'cert.pem'
+        key_path = pl.Path(self.cert_dir.name) / 'key.pem'
+        cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+        key_path.write_bytes(private_key.private_bytes(serialization.Encoding.PEM,
+                                                       serialization.PrivateFormat.PKCS8,
+                                                       serialization.NoEncryption()))
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_path, key_path)
+        return context
+
+    def store_file(self, userID: str, content: bytes, additional_data: dict):
+        """Store an uploaded file under the name given in its additional data"""
+        with self.lock:
+            self.generation += 1
+            self.users.setdefault(userID, {})[additional_data['n']] = (content, additional_data)
+            self.changed.setdefault(userID, {})[additional_data['n']] = self.generation
+            self.archived.get(userID, {}).pop(additional_data['n'], None)
+
+    def get_stored_file(self, userID: str, enc_file_name: str):
+        """Look up a stored file, returns None if the user or file is unknown"""
+        with self.lock:
+            return self.users.get(userID, {}).get(enc_file_name, None)
+
+    def archive_stored_file(self, userID: str, enc_file_name: str) -> bool:
+        """Archive a stored file, returns False if the user or file is unknown"""
+        with self.lock:
+            if self.users.get(userID, {}).pop(enc_file_name, None) is None:
+                return False
+            self.generation += 1
+            self.changed[userID].pop(enc_file_name, None)
+            self.archived.setdefault(userID, {})[enc_file_name] = self.generation
+            return True
+
+    def fail_next(self, count: int, status=503, endpoint: str = None, after: int = 0):
+        """Answer the next count requests (to endpoint, if given) with status, drop their connection if status is
+        None, or cut off the answer halfway if status is 'truncate'. The first after requests are handled as normal"""
+        with self.lock:
+            self.faults += [[status, endpoint, after]] + [[status, endpoint, 0] for _ in range(count - 1)]
+
+    def reset(self):
+        """Forget all users and files. Cursors handed out before are answered with the full list"""
+        with self.lock:
+            self.users.clear()
+            self.chunks.clear()
+            self.uploads.clear()
+            self.changed.clear()
+            self.archived.clear()
+            self.generation += 1
+            self.oldest_cursor = self.generation
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Request handler for the LocalServer, routing on the first element of the path"""
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real server
+
+    def log_message(self, format, *args):
+        pass  # Keep test output clean
+
+    @property
+    def stand_in(self) -> LocalServer:
+        return self.server.stand_in
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def route(self, method: str):
+        """Dispatch the request to handle_<method>_<endpoint> with the remaining path elements as arguments"""
+        path, _, query = self.path.partition('?')
+        parts = [part for part in path.split('/') if part]
+        self.query = dict(pair.split('=', 1) for pair in query.split('&') if '=' in pair)
+        self.stand_in.request_log.append((method, path))
+        body = self.read_body()
+        fault = False
+        self.truncate = False
+        with self.stand_in.lock:
+            for i, (status, endpoint, after) in enumerate(self.stand_in.faults):
+                if endpoint is None or parts and parts[0] == endpoint:
+                    if after:
+                        self.stand_in.faults[i][2] -= 1
+                    else:
+                        fault = self.stand_in.faults.pop(i)[0]
+                    break
+        if fault is None:
+            self.close_connection = True
+            return
+        if fault == 'truncate':
+            self.truncate = True
+        elif fault:
+            self.send_json(fault, {'error': 'injected fault'})
+            return
+        handler = getattr(self, 'handle_' + method.lower() + '_' + (parts[0] if parts else ''), None)
+        if handler is not None and parts[0] not in ('register', 'unregister'):
+            with self.stand_in.lock:
+                if parts[-1] not in self.stand_in.users:  # The userID is the last element of the path
+                    self.send_json(401, {'error': 'unknown user'})
+                    return
+        try:
+            inspect.signature(handler).bind(body, *parts[1:])
+        except (TypeError, ValueError):  # No handler or wrong amount of path elements
+            self.send_json(404, {'error': 'unknown endpoint'})
+            return
+        handler(body, *parts[1:])
+
+    def read_body(self) -> bytes:
+        """Read the request body, decoding chunked transfer encoding"""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()  # The final CRLF
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()  # The CRLF ending each chunk
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def send_body(self, status: int, body: bytes, content_type: str, headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if self.stand_in.compression and content_type != 'application/octet-stream' \
+                and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.truncate:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def send_json(self, status: int, obj):
+        self.send_body(status, bytes(json.dumps(obj), 'utf-8'), 'application/json')
+
+    def handle_post_register(self, body: bytes, userID: str):
+        with self.stand_in.lock:
+            if userID in self.stand_in.users:
+                self.send_json(400, {'error': 'user already registered'})
+                return
+            self.stand_in.users[userID] = {}
+            self.stand_in.registrations += 1
+        self.send_json(200, {})
+
+    def handle_post_unregister(self, body: bytes, userID: str):
+        with self.stand_in.lock:
+            self.stand_in.users.pop(userID, None)
+        self.send_json(200, {})
+
+    def handle_post_upload_file(self, body: bytes, userID: str):
+        message = BytesParser().parsebytes(
+            b'Content-Type: ' + bytes(self.headers['Content-Type'], 'utf-8') + b'\r\n\r\n' + body)
+        fields = {}
+        for part in message.get_payload():
+            fields[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True)
+        self.stand_in.store_file(userID, fields['file_content'], json.loads(fields['additional_data']))
+        self.send_json(200, {})
+
+    def handle_post_upload_file_stream(self, body: bytes, userID: str):
+        if not self.stand_in.stream_uploads:
+            self.send_json(404, {'error': 'unknown endpoint'})
+            return
+        self.stand_in.store_file(userID, body, json.loads(self.headers['X-Additional-Data']))
+        self.send_json(200, {})
+
+    def handle_post_multipart_start(self, body: bytes, userID: str):
+        if not self.stand_in.multipart_uploads:
+            self.send_json(404, {'error': 'unknown endpoint'})
+            return
+        request = json.loads(body)
+        upload_id = os.urandom(8).hex()
+        with self.stand_in.lock:
+            self.stand_in.uploads[upload_id] = (userID, request['additional_data'], request['size'], {})
+        self.send_json(200, {'upload_id': upload_id})
+
+    def handle_post_multipart_part(self, body: bytes, upload_id: str, index: str, userID: str):
+        if hashlib.sha256(body).hexdigest() != self.headers.get('X-Part-Sha256', ''):
+            self.send_json(400, {'error': 'part damaged'})
+            return
+        with self.stand_in.lock:
+            upload = self.stand_in.uploads.get(upload_id, None)
+            if upload is None or upload[0] != userID:
+                self.send_json(404, {'error': 'no such upload'})
+                return
+            upload[3][int(index)] = body
+        self.send_json(200, {})
+
+    def handle_get_multipart_status(self, body: bytes, upload_id: str, userID: str):
+        with self.stand_in.lock:
+            upload = self.stand_in.uploads.get(upload_id, None)
+            if upload is None or upload[0] != userID:
+                self.send_json(404, {'error': 'no such upload'})
+                return
+            parts = {str(index): hashlib.sha256(content).hexdigest() for index, content in upload[3].items()}
+        self.send_json(200, {'parts': parts})
+
+    def handle_post_multipart_complete(self, body: bytes, upload_id: str, userID: str):
+        with self.stand_in.lock:
+            upload = self.stand_in.uploads.get(upload_id, None)
+            if upload is None or upload[0] != userID:
+                self.send_json(404, {'error': 'no such upload'})
+                return
+            _, additional_data, size, parts = upload
+            missing = [index for index in range(json.loads(body)['parts']) if index not in parts]
+            content = b''.join(parts[index] for index in sorted(parts))
+            if missing or len(content) != size:
+                self.send_json(400, {'error': 'parts missing', 'missing': missing})
+                return
+            self.stand_in.uploads.pop(upload_id)
+            self.stand_in.store_file(userID, content, additional_data)
+        self.send_json(200, {})
+
+    def handle_post_chunks_missing(self, body: bytes, userID: str):
+        if not self.stand_in.chunk_store:
+            self.send_json(404, {'error': 'unknown endpoint'})
+            return
+        with self.stand_in.lock:
+            chunks = self.stand_in.chunks.get(userID, {})
+            missing = [chunk_id for chunk_id in json.loads(body)['chunks'] if chunk_id not in chunks]
+        self.send_json(200, {'missing': missing})
+
+    def handle_post_upload_chunk(self, body: bytes, chunk_id: str, userID: str):
+        if not self.stand_in.chunk_store:
+            self.send_json(404, {'error': 'unknown endpoint'})
+            return
+        with self.stand_in.lock:
+            self.stand_in.chunks.setdefault(userID, {}).setdefault(chunk_id, body)
+        self.send_json(200, {})
+
+    def handle_get_get_chunk(self, body: bytes, chunk_id: str, userID: str):
+        with self.stand_in.lock:
+            content = self.stand_in.chunks.get(userID, {}).get(chunk_id, None)
+        if content is None:
+            self.send_json(404, {'error': 'no such chunk'})
+            return
+        self.send_body(200, content, 'application/octet-stream')
+
+    def handle_get_get_file(self, body: bytes, enc_file_name: str, userID: str):
+        stored = self.stand_in.get_stored_file(userID, enc_file_name)
+        if stored is None:
+            self.send_json(404, {'error': 'no such file'})
+            return
+        content, additional_data = stored
+        byte_range = self.headers.get('Range', '')
+        if self.stand_in.binary_downloads and 'application/octet-stream' in self.headers.get('Accept', '') \
+                and self.stand_in.ranged_downloads and byte_range.startswith('bytes='):
+            first, _, last = byte_range[len('bytes='):].partition('-')
+            first, last = int(first), min(int(last) if last else len(content) - 1, len(content) - 1)
+            if first > last:
+                self.send_json(416, {'error': 'range not satisfiable'})
+                return
+            self.send_body(206, content[first:last + 1], 'application/octet-stream',
+                           {'X-Additional-Data': json.dumps(additional_data),
+                            'Content-Range': 'bytes ' + str(first) + '-' + str(last) + '/' + str(len(content))})
+        elif self.stand_in.binary_downloads and 'application/octet-stream' in self.headers.get('Accept', ''):
+            self.send_body(200, content, 'application/octet-stream',
+                           {'X-Additional-Data': json.dumps(additional_data)})
+        else:
+            self.send_json(200, {'file': content.hex(), 'additional_data': additional_data})
+
+    def handle_get_list_files(self, body: bytes, userID: str):
+        with self.stand_in.lock:
+            files = self.stand_in.users.get(userID, {})
+            if not self.stand_in.incremental_listing:
+                file_list = [[name, data['nonce1'], data['t']] for name, (_, data) in files.items()]
+                self.send_listing({'file_list': file_list})
+                return
+            since = int(self.query.get('since', -1))
+            full = since < self.stand_in.oldest_cursor
+            changed = self.stand_in.changed.get(userID, {})
+            file_list = [[name, data['nonce1'], data['t']] for name, (_, data) in files.items()
+                         if full or changed[name] > since]
+            archived = [] if full else [name for name, generation in self.stand_in.archived.get(userID, {}).items()
+                                        if generation > since]
+            listing = {'file_list': file_list, 'archived': archived, 'cursor': self.stand_in.generation, 'full': full}
+        self.send_listing(listing)
+
+    def send_listing(self, listing: dict):
+        if self.stand_in.binary_listing and LISTING_CONTENT_TYPE in self.headers.get('Accept', ''):
+            self.send_body(200, encode_listing(listing), LISTING_CONTENT_TYPE)
+        else:
+            self.send_json(200, listing)
+
+    def handle_post_archive_file(self, body: bytes, enc_file_name: str, userID: str):
+        if not self.stand_in.archive_stored_file(userID, enc_file_name):
+            self.send_json(404, {'error': 'no such file'})
+        else:
+            self.send_json(200, {})
+
+    def handle_post_archive_files(self, body: bytes, userID: str):
+        if not self.stand_in.bulk_archive:
+            self.send_json(404, {'error': 'unknown endpoint'})
+            return
+        missing = [enc_file_name for enc_file_name in json.loads(body)['files']
+                   if not self.stand_in.archive_stored_file(userID, enc_file_name)]
+        self.send_json(200, {'missing': missing})
@@ -1,8 +1,31 @@
 import pathlib as pl
+import shutil
+import tempfile
+
 from resources import globals
 from security import keyderivation
 
 
+class temporary_state_files:
+    """Points the files the client keeps its state in at a temporary folder, such that tests neither read the state
+    of the user nor leave theirs behind in resources"""
+
+    SETTINGS = ('REGISTERED_USERS', 'UPLOAD_JOURNAL', 'CONTENT_INDEX_FOLDER',
+                'NAME_CACHE_FOLDER', 'METADATA_DB')  # The globals naming the state files
+
+    def __init__(self):
+        self.folder = pl.Path(tempfile.mkdtemp())
+        self.settings = {name: getattr(globals, name) for name in self.SETTINGS}
+        for name, path in self.settings.items():
+            setattr(globals, name, self.folder / pl.Path(path).name)
+
+    def recover(self):
+        """Point the state files back at resources, removing the temporary folder"""
+        for name, path in self.settings.items():
+            setattr(globals, name, path)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
 class global_test_configer:
     """Class for setting up the test environment, ensuring the testing process does not mess with the user"""
 
@@ -16,6 +39,7 @@ class global_test_configer:
 
     def setup_resources(self):
         """Save the current user profile in memory and clears for test user"""
+        self.state_files = temporary_state_files()
         try:
             self.key_hashes = self.kd.get_hashes_of_keys()
             pl.Path(globals.KEY_HASHES).unlink()
@@ -55,6 +79,7 @@ class global_test_configer:
 
     def recover_resources(self):
         """Save the current user profile to the disk from memory, clearing the test user"""
+        self.state_files.recover()
         try:
             self.recover_key_hashes()
         except AttributeError:  # If file not found attribute doesn't exist.
@@ -0,0 +1,92 @@
+import datetime
+import threading
+import time
+import unittest
+
+from network.bandwidth import BandwidthLimiter, parse_schedule_entry, ThrottledReader, TokenBucket
+from resources import globals
+
+
+class TestBandwidth(unittest.TestCase):
+    """Class for unittesting the bandwidth.py module"""
+
+    def test_bucket_limits_rate(self):
+        """Test that taking more than the burst from a bucket takes the time the rate says"""
+        bucket = TokenBucket(256 * 1024)
+        start = time.monotonic()
+        for _ in range(6):
+            bucket.consume(64 * 1024)
+        elapsed = time.monotonic() - start
+        # 384 KiB with a burst of 128 KiB at 256 KiB/s
+        self.assertGreaterEqual(elapsed, 0.9)
+        self.assertLess(elapsed, 2)
+
+    def test_unlimited_bucket_does_not_wait(self):
+        """Test that a bucket without rate lets everything through at once"""
+        bucket = TokenBucket()
+        start = time.monotonic()
+        bucket.consume(1024 ** 3)
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(bucket.bytes_passed, 1024 ** 3)
+
+    def test_throttle_smooths_chunks(self):
+        """Test that big chunks are passed on in small pieces, keeping their content"""
+        limiter = BandwidthLimiter(upload_rate=1024 ** 3)
+        chunks = [bytes([i]) * (globals.BANDWIDTH_CHUNK_SIZE * 2 + 1) for i in range(3)]
+        pieces = list(limiter.throttle_upload(chunks))
+        self.assertTrue(all(len(piece) <= globals.BANDWIDTH_CHUNK_SIZE for piece in pieces))
+        self.assertEqual(b''.join(pieces), b''.join(chunks))
+
+    def test_unlimited_throttle_passes_chunks_through(self):
+        """Test that chunks are passed on whole and uncopied when not limited, yet counted in the stats"""
+        limiter = BandwidthLimiter(download_rate=1024 ** 3)
+        chunks = [bytes([i]) * (globals.BANDWIDTH_CHUNK_SIZE * 2 + 1) for i in range(3)]
+        passed = list(limiter.throttle_upload(chunks))
+        self.assertEqual(len(passed), len(chunks))
+        self.assertTrue(all(piece is chunk for piece, chunk in zip(passed, chunks)))
+        self.assertEqual(limiter.get_stats()['uploaded'], sum(len(chunk) for chunk in chunks))
+
+    def test_rates_change_at_runtime(self):
+        """Test that changing the rates takes effect for a transfer under way"""
+        limiter = BandwidthLimiter(upload_rate=1024)
+        pieces = limiter.throttle_upload([b'0' * globals.BANDWIDTH_CHUNK_SIZE * 8])
+        next(pieces)  # Within the burst
+        limiter.set_rates(None, None)
+        start = time.monotonic()
+        self.assertEqual(len(list(pieces)), 7)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_waiting_transfer_is_woken_by_new_rate(self):
+        """Test that a transfer waiting at a slow rate goes on at once when the limit is lifted"""
+        limiter = BandwidthLimiter(upload_rate=1024)
+        pieces = limiter.throttle_upload([b'0' * globals.BANDWIDTH_CHUNK_SIZE * 2])
+        next(pieces)
+        timer = threading.Timer(0.2, limiter.set_rates, (None, None))
+        timer.start()
+        start = time.monotonic()
+        next(pieces)  # Would take a minute at 1 KiB/s
+        self.assertLess(time.monotonic() - start, 1)
+        timer.join()
+
+    def test_schedule(self):
+        """Test that scheduled rates apply within their span, also when it passes midnight"""
+        schedule = [parse_schedule_entry('08:00-18:00', 1000, 2000), parse_schedule_entry('22:00-02:00', 10, None)]
+        limiter = BandwidthLimiter(upload_rate=5, download_rate=6, schedule=schedule)
+        self.assertEqual(limiter.get_rates(datetime.time(12, 0)), (1000, 2000))
+        self.assertEqual(limiter.get_rates(datetime.time(18, 0)), (5, 6))
+        self.assertEqual(limiter.get_rates(datetime.time(23, 30)), (10, None))
+        self.assertEqual(limiter.get_rates(datetime.time(1, 0)), (10, None))
+        self.assertEqual(limiter.get_rates(datetime.time(3, 0)), (5, 6))
+        self.assertRaises(ValueError, parse_schedule_entry, '8-18', None, None)
+
+    def test_throttled_reader(self):
+        """Test that the reader gives back all data, with a length requests can use for Content-Length"""
+        data = bytes(range(256)) * 1000
+        reader = ThrottledReader(data, BandwidthLimiter(upload_rate=1024 ** 3))
+        self.assertEqual(len(reader), len(data))
+        received = b''
+        piece = reader.read(8192)
+        while piece:
+            received += piece
+            piece = reader.read(8192)
+        self.assertEqual(received, data)
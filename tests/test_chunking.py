@@ -0,0 +1,72 @@
+import contextlib
+import io
+import os
+import unittest
+
+from cryptography.exceptions import InvalidTag
+
+from resources import globals
+from security.chunking import Chunker
+
+
+class TestChunking(unittest.TestCase):
+    """Class for unittesting the content-defined chunking of chunking.py"""
+
+    def setUp(self):
+        self.chunker = Chunker(globals.generate_random_key())
+
+    def test_chunks_make_up_the_file(self):
+        """Test that the chunks of a file are within the sizes asked for and make up the file, also an empty one"""
+        content = os.urandom(200 * 1024)
+        with self.small_chunks():
+            chunks = list(self.chunker.split(io.BytesIO(content)))
+            self.assertEqual(list(self.chunker.split(io.BytesIO(b''))), [])
+        self.assertEqual(b''.join(chunks), content)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 1024)
+            self.assertLessEqual(len(chunk), 16 * 1024)
+        self.assertGreater(len(chunks), 20)
+
+    def test_edit_changes_only_nearby_chunks(self):
+        """Test that bytes inserted in the middle of a file leave the chunks before and after them alone"""
+        content = os.urandom(200 * 1024)
+        edited = content[:100 * 1024] + b'inserted' + content[100 * 1024:]
+        with self.small_chunks():
+            chunks = list(self.chunker.split(io.BytesIO(content)))
+            edited_chunks = list(self.chunker.split(io.BytesIO(edited)))
+        self.assertLessEqual(len(set(edited_chunks) - set(chunks)), 2)
+
+    def test_boundaries_depend_on_key(self):
+        """Test that another key splits the same content elsewhere, so chunk sizes do not give the content away"""
+        content = os.urandom(200 * 1024)
+        with self.small_chunks():
+            sizes = [len(chunk) for chunk in self.chunker.split(io.BytesIO(content))]
+            other_sizes = [len(chunk) for chunk in
+                           Chunker(globals.generate_random_key()).split(io.BytesIO(content))]
+        self.assertNotEqual(sizes, other_sizes)
+
+    def test_chunk_encryption(self):
+        """Test that chunks decrypt to their content, compressed or not, and that a chunk handed out under another
+        id or damaged fails to authenticate"""
+        for chunk in (os.urandom(5000), b'a' * 5000):
+            chunk_id = self.chunker.chunk_id(chunk)
+            enc_chunk = self.chunker.encrypt_chunk(chunk_id, chunk)
+            self.assertEqual(self.chunker.decrypt_chunk(chunk_id, enc_chunk), chunk)
+            self.assertEqual(bytes(self.chunker.decrypt_chunk_into(chunk_id, enc_chunk, bytearray(6000))), chunk)
+            self.assertRaises(InvalidTag, self.chunker.decrypt_chunk, self.chunker.chunk_id(b'other'), enc_chunk)
+            self.assertRaises(InvalidTag, self.chunker.decrypt_chunk_into, chunk_id,
+                              enc_chunk[:-1] + bytes([enc_chunk[-1] ^ 1]), bytearray(6000))
+            self.assertRaises(InvalidTag, self.chunker.decrypt_chunk, chunk_id,
+                              enc_chunk[:-1] + bytes([enc_chunk[-1] ^ 1]))
+            self.assertRaises(InvalidTag, self.chunker.decrypt_chunk, chunk_id, enc_chunk[:10])
+        self.assertLess(len(enc_chunk), 1000)  # The repeated bytes were compressed
+
+    @contextlib.contextmanager
+    def small_chunks(self):
+        """Context in which files are split in chunks of 1 to 16 KiB"""
+        settings = (globals.CHUNK_MIN_SIZE, globals.CHUNK_AVG_SIZE, globals.CHUNK_MAX_SIZE)
+        globals.CHUNK_MIN_SIZE, globals.CHUNK_AVG_SIZE, globals.CHUNK_MAX_SIZE = 1024, 4 * 1024, 16 * 1024
+        try:
+            yield
+        finally:
+            globals.CHUNK_MIN_SIZE, globals.CHUNK_AVG_SIZE, globals.CHUNK_MAX_SIZE = settings
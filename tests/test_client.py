@@ -7,6 +7,7 @@ from time import sleep
 import requests
 
 import client
+from ServerComs import ServComs
 from client import Client
 from resources import globals
 from security import keyderivation
@@ -23,6 +24,7 @@ class TestClient(unittest.TestCase):
             userID: The ID of the user to unregister on the server
         """
         requests.post('https://' + self.serverIp + '/unregister/' + userID, verify=False)
+        ServComs(self.serverIp, userID).set_registered(False)  # Such that the user is registered again when used
 
     def setUp(self):
         self.serverIp = 'wyrnas.myqnapcloud.com:8001'  # '127.0.0.1:443'
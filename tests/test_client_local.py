@@ -0,0 +1,413 @@
+import asyncio
+import os
+import pathlib as pl
+import threading
+import unittest
+
+from client import Client
+from resources import globals
+from security import keyderivation
+from tests import setup_test_environment as ste
+from tests.local_server import LocalServer
+
+
+class TestClientLocal(unittest.TestCase):
+    """Class for unittesting the client.py module against a local stand-in server"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalServer()
+        cls.serverIp = cls.server.start()
+        cls.username = "abecattematteman"
+        cls.pw = '1234567890101112'
+        cls.kd = keyderivation.KeyDerivation(cls.username)
+        cls.ste = ste.global_test_configer(cls.kd)
+        cls.kd.select_first_pw(cls.pw)
+        cls.client = Client(username=cls.username, password=cls.pw, server_location=cls.serverIp)
+        cls.client.close_observers()  # The tests decide when files are sent
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.close_observers()
+        cls.client.metadata_db.close()
+        cls.ste.recover_resources()
+        cls.server.stop()
+
+    def setUp(self):
+        self.random_files_list = []
+
+    def tearDown(self):
+        for file in self.random_files_list:
+            if file.exists():
+                file.unlink()
+        self.server.reset()  # Start the next test from an empty server
+        self.client.update_server_file_list()
+        globals.clear_tmp()
+
+    def test_send_files_async_uploads_all_files(self):
+        """Test that sending many files concurrently gets all of them on the server"""
+        file_paths = [self.create_random_file() for _ in range(20)]
+        asyncio.run(self.client.send_files_async(file_paths, max_concurrent=4))
+        self.client.update_server_file_list()
+        for file_path in file_paths:
+            self.assertIn(file_path.relative_to(globals.WORK_DIR), globals.SERVER_FILE_DICT)
+
+    def test_send_files_async_reads_files_off_the_event_loop(self):
+        """Test that hashing the files, reading the upload journal and writing the metadata database are done on other
+        threads than the event loop, which is left to the transfers"""
+        file_paths = [self.create_random_file() for _ in range(3)]
+        threads = []
+
+        def on_thread(function):
+            def wrapper(*args):
+                threads.append(threading.current_thread())
+                return function(*args)
+            return wrapper
+
+        for name in ('is_content_unchanged', 'get_upload_nonces', 'add_server_file'):
+            setattr(self.client, name, on_thread(getattr(self.client, name)))
+        try:
+            asyncio.run(self.client.send_files_async(file_paths))
+        finally:
+            for name in ('is_content_unchanged', 'get_upload_nonces', 'add_server_file'):
+                delattr(self.client, name)
+        self.assertGreaterEqual(len(threads), 3 * len(file_paths))
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_get_files_async_restores_files(self):
+        """Test that files deleted locally are all received again when getting them concurrently"""
+        file_paths = [self.create_random_file() for _ in range(10)]
+        contents = [file_path.read_bytes() for file_path in file_paths]
+        asyncio.run(self.client.send_files_async(file_paths))
+        for file_path in file_paths:
+            file_path.unlink()
+        asyncio.run(self.client.get_files_async([file_path.relative_to(globals.WORK_DIR) for file_path in file_paths]))
+        self.client.close_observers()
+        for file_path, content in zip(file_paths, contents):
+            self.assertEqual(file_path.read_bytes(), content, "Files differ!")
+
+    def test_sync_files_async_sends_new_local_files(self):
+        """Test that an async sync sends the files the server does not have"""
+        file_paths = [self.create_random_file() for _ in range(5)]
+        asyncio.run(self.client.sync_files_async(max_concurrent=2))
+        self.client.close_observers()
+        self.client.update_server_file_list()
+        for file_path in file_paths:
+            self.assertIn(file_path.relative_to(globals.WORK_DIR), globals.SERVER_FILE_DICT)
+
+    def test_partial_files_are_not_synced(self):
+        """Test that a file left half decrypted, e.g. by a crash, is neither a local file nor sent by a sync"""
+        file_path = self.create_random_file()
+        partial_file_path = file_path.with_name(file_path.name + globals.PARTIAL_FILE_SUFFIX)
+        file_path.rename(partial_file_path)
+        self.random_files_list.append(partial_file_path)
+        self.assertNotIn(partial_file_path.relative_to(globals.WORK_DIR), self.client.scan_local_files())
+        self.client.sync_files()
+        self.client.close_observers()
+        self.client.update_server_file_list()
+        self.assertNotIn(partial_file_path.relative_to(globals.WORK_DIR), globals.SERVER_FILE_DICT)
+
+    def test_delete_remote_files(self):
+        """Test that deleting many files removes them from the server and the server file list"""
+        file_paths = [self.create_random_file() for _ in range(5)]
+        asyncio.run(self.client.send_files_async(file_paths))
+        rel_paths = [file_path.relative_to(globals.WORK_DIR) for file_path in file_paths]
+        self.client.delete_remote_files(rel_paths[:3])
+        for rel_path in rel_paths[:3]:
+            self.assertNotIn(rel_path, globals.SERVER_FILE_DICT)
+        self.client.update_server_file_list()
+        self.assertEqual(sorted(globals.SERVER_FILE_DICT), sorted(rel_paths[3:]))
+
+    def test_server_file_list_is_updated_incrementally(self):
+        """Test that after the first listing only changes are listed, and merged into the server file list"""
+        file_paths = [self.create_random_file() for _ in range(4)]
+        asyncio.run(self.client.send_files_async(file_paths[:3]))
+        self.client.update_server_file_list()
+        rel_paths = [file_path.relative_to(globals.WORK_DIR) for file_path in file_paths]
+        self.assertIsNotNone(self.client.servercoms.list_cursor)
+        # Another client deletes one file and adds one
+        servercoms = self.client.servercoms
+        self.server.archive_stored_file(servercoms.userID, globals.SERVER_FILE_DICT[rel_paths[0]].enc_path)
+        asyncio.run(self.client.send_files_async(file_paths[3:]))
+        changed_files, archived_files, is_full_list = servercoms.get_file_list_changes()
+        self.assertFalse(is_full_list)
+        self.assertEqual(len(changed_files), 1)
+        self.assertEqual(len(archived_files), 1)
+        self.client.merge_server_file_list_changes('default', self.client.file_crypt, changed_files,
+                                                   archived_files, is_full_list)
+        self.client.combine_server_file_lists()
+        self.assertEqual(sorted(globals.SERVER_FILE_DICT), sorted(rel_paths[1:]))
+
+    def test_interrupted_upload_resumes(self):
+        """Test that sending a file again after the connection dropped sends only the parts the server lacks"""
+        file_path = self.create_random_file(size=64 * 1024)
+        settings = (globals.MULTIPART_UPLOAD_THRESHOLD, globals.MULTIPART_PART_SIZE, globals.MULTIPART_PARALLEL_PARTS,
+                    globals.ENCRYPTION_SEGMENT_SIZE)
+        # Parts of two segments of 4 KiB of ciphertext
+        globals.MULTIPART_UPLOAD_THRESHOLD, globals.MULTIPART_PART_SIZE, globals.MULTIPART_PARALLEL_PARTS, \
+            globals.ENCRYPTION_SEGMENT_SIZE = 0, 8 * 1024, 1, 4 * 1024 - 16
+        retry_policy = self.client.servercoms.transport.retry_policy
+        try:
+            self.server.fail_next(1, None, 'multipart_part', after=3)
+            retry_policy.max_attempts = 1
+            self.client.send_file(file_path)  # Cut off after three parts
+            retry_policy.max_attempts = globals.RETRY_MAX_ATTEMPTS
+            self.assertNotIn(file_path.relative_to(globals.WORK_DIR), globals.SERVER_FILE_DICT)
+            parts_before = len([path for _, path in self.server.request_log if path.startswith('/multipart_part/')])
+            self.client.send_file(file_path)
+        finally:
+            retry_policy.max_attempts = globals.RETRY_MAX_ATTEMPTS
+            globals.MULTIPART_UPLOAD_THRESHOLD, globals.MULTIPART_PART_SIZE, globals.MULTIPART_PARALLEL_PARTS, \
+                globals.ENCRYPTION_SEGMENT_SIZE = settings
+        parts = len([path for _, path in self.server.request_log if path.startswith('/multipart_part/')])
+        self.assertEqual(parts - parts_before, 6)  # Of the 9 parts of 64 KiB and the encryption overhead
+        self.assertEqual(os.listdir(globals.TEMPORARY_FOLDER), [], "Ciphertext written to tmp.")
+        self.assertIsNone(self.client.servercoms.find_resumable_upload(file_path))
+        self.client.update_server_file_list()
+        self.assertIn(file_path.relative_to(globals.WORK_DIR), globals.SERVER_FILE_DICT)
+
+    def test_rewritten_file_upload_not_resumed(self):
+        """Test that an upload cut off is not resumed once the file is rewritten, even keeping its size and
+        modification time, such that no nonce encrypts other content"""
+        file_path = self.create_random_file(size=64 * 1024)
+        settings = (globals.MULTIPART_UPLOAD_THRESHOLD, globals.MULTIPART_PART_SIZE, globals.MULTIPART_PARALLEL_PARTS,
+                    globals.ENCRYPTION_SEGMENT_SIZE)
+        globals.MULTIPART_UPLOAD_THRESHOLD, globals.MULTIPART_PART_SIZE, globals.MULTIPART_PARALLEL_PARTS, \
+            globals.ENCRYPTION_SEGMENT_SIZE = 0, 8 * 1024, 1, 4 * 1024 - 16
+        retry_policy = self.client.servercoms.transport.retry_policy
+        try:
+            self.server.fail_next(1, None, 'multipart_part', after=3)
+            retry_policy.max_attempts = 1
+            self.client.send_file(file_path)  # Cut off after three parts
+        finally:
+            retry_policy.max_attempts = globals.RETRY_MAX_ATTEMPTS
+            globals.MULTIPART_UPLOAD_THRESHOLD, globals.MULTIPART_PART_SIZE, globals.MULTIPART_PARALLEL_PARTS, \
+                globals.ENCRYPTION_SEGMENT_SIZE = settings
+        content_hash = self.client.get_file_crypt_servercoms(file_path)[0].content_index.content_hash
+        old_stat = file_path.stat()
+        old_nonces = self.client.servercoms.find_resumable_upload(file_path, content_hash)
+        self.assertIsNotNone(old_nonces)
+        file_path.write_bytes(os.urandom(old_stat.st_size))
+        os.utime(file_path, ns=(old_stat.st_atime_ns, old_stat.st_mtime_ns))
+        self.assertIsNone(self.client.servercoms.find_resumable_upload(file_path, content_hash))
+        name_nonce = globals.generate_random_nonce()
+        nonces = self.client.get_upload_nonces(self.client.servercoms, file_path, name_nonce)
+        self.assertEqual(nonces[0], name_nonce)
+        self.assertNotEqual(nonces[1], bytes.fromhex(old_nonces['nonce2']))
+
+    def test_file_changed_while_sent_is_sent_again(self):
+        """Test that a file changing while being sent is sent again under a fresh nonce, with its new content"""
+        file_path = self.create_random_file()
+        new_content = os.urandom(1024)
+        servercoms = self.client.servercoms
+        send_encrypted_file = servercoms.send_encrypted_file
+        sent = []
+
+        def change_then_send(enc_file):
+            if not sent:
+                file_path.write_bytes(new_content)
+                file_stat = file_path.stat()
+                os.utime(file_path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 1000))
+            sent.append(enc_file.additional_data)
+            return send_encrypted_file(enc_file)
+
+        servercoms.send_encrypted_file = change_then_send
+        try:
+            self.client.send_file(file_path)
+        finally:
+            del servercoms.send_encrypted_file
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(sent[0]['nonce1'], sent[1]['nonce1'])
+        self.assertNotEqual(sent[0]['nonce2'], sent[1]['nonce2'])
+        file_path.unlink()
+        self.client.get_file(file_path.relative_to(globals.WORK_DIR))
+        self.client.close_observers()
+        self.assertEqual(file_path.read_bytes(), new_content)
+
+    def test_edited_file_sends_only_changed_chunks(self):
+        """Test that a file sent as chunks, edited and sent again only sends the chunks around the edit, that a copy
+        of it sends none, and that both are put together again when received"""
+        file_path = self.create_random_file(size=256 * 1024)
+        copy_path = self.create_random_file()
+        settings = (globals.CHUNKED_UPLOADS, globals.CHUNKED_UPLOAD_THRESHOLD, globals.CHUNK_MIN_SIZE,
+                    globals.CHUNK_AVG_SIZE, globals.CHUNK_MAX_SIZE)
+        globals.CHUNKED_UPLOADS, globals.CHUNKED_UPLOAD_THRESHOLD, globals.CHUNK_MIN_SIZE, globals.CHUNK_AVG_SIZE, \
+            globals.CHUNK_MAX_SIZE = True, 0, 1024, 4 * 1024, 16 * 1024
+        try:
+            self.client.send_file(file_path)
+            chunks_before = self.count_requests('upload_chunk')
+            self.assertGreater(chunks_before, 20)
+            content = bytearray(file_path.read_bytes())
+            content[100 * 1024:100 * 1024 + 10] = os.urandom(10)
+            content[200 * 1024:200 * 1024] = b'inserted'
+            file_path.write_bytes(content)
+            fio = globals.SERVER_FILE_DICT[file_path.relative_to(globals.WORK_DIR)]
+            self.client.send_file(file_path, fio.nonce)
+            self.assertLessEqual(self.count_requests('upload_chunk') - chunks_before, 4)
+            copy_path.write_bytes(content)
+            chunks_before = self.count_requests('upload_chunk')
+            self.client.send_file(copy_path)
+            self.assertEqual(self.count_requests('upload_chunk'), chunks_before)
+        finally:
+            globals.CHUNKED_UPLOADS, globals.CHUNKED_UPLOAD_THRESHOLD, globals.CHUNK_MIN_SIZE, \
+                globals.CHUNK_AVG_SIZE, globals.CHUNK_MAX_SIZE = settings
+        self.client.update_server_file_list()
+        for path in (file_path, copy_path):
+            path.unlink()
+            self.client.get_file(path.relative_to(globals.WORK_DIR))
+            self.client.close_observers()
+            self.assertEqual(path.read_bytes(), content, "Files differ!")
+
+    def test_file_saved_again_unchanged_is_not_sent(self):
+        """Test that a file saved again with the same content is neither sent nor taken as newer when syncing, and
+        that once its content changes it is sent"""
+        file_path = self.create_random_file()
+        rel_path = file_path.relative_to(globals.WORK_DIR)
+        content = file_path.read_bytes()
+        self.client.send_file(file_path)
+        self.client.update_server_file_list()
+        uploads_before = self.count_requests('upload_file')
+        file_path.write_bytes(content)
+        file_stat = file_path.stat()
+        os.utime(file_path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 10 ** 9))
+        self.client.send_file(file_path, globals.SERVER_FILE_DICT[rel_path].nonce)
+        sync_dict = self.client.generate_sync_dict()
+        self.assertEqual(sync_dict[rel_path][0], sync_dict[rel_path][1])
+        self.assertEqual(self.count_requests('upload_file'), uploads_before)
+        file_path.write_bytes(os.urandom(len(content)))
+        self.client.send_file(file_path, globals.SERVER_FILE_DICT[rel_path].nonce)
+        self.assertEqual(self.count_requests('upload_file'), uploads_before + 1)
+
+    def test_small_files_are_sent_in_one_pack(self):
+        """Test that many small files are sent in one upload, listed by another client from the pack and received
+        again from their ranges of it"""
+        file_paths = [self.create_random_file() for _ in range(20)]
+        contents = [file_path.read_bytes() for file_path in file_paths]
+        uploads_before = self.count_requests('upload_file')
+        asyncio.run(self.client.send_files_async(file_paths))
+        self.assertEqual(self.count_requests('upload_file'), uploads_before + 1)
+        self.list_from_scratch()
+        rel_paths = [file_path.relative_to(globals.WORK_DIR) for file_path in file_paths]
+        self.assertEqual(sorted(globals.SERVER_FILE_DICT), sorted(rel_paths))
+        self.assertEqual(len({globals.SERVER_FILE_DICT[rel_path].pack for rel_path in rel_paths}), 1)
+        for file_path in file_paths:
+            file_path.unlink()
+        asyncio.run(self.client.get_files_async(rel_paths))
+        self.client.close_observers()
+        for file_path, content in zip(file_paths, contents):
+            self.assertEqual(file_path.read_bytes(), content, "Files differ!")
+
+    def test_pack_with_many_deleted_files_is_repacked(self):
+        """Test that files deleted from a pack are gone for another client, and that once enough are deleted the
+        pack is replaced by one of the files left"""
+        file_paths = [self.create_random_file() for _ in range(10)]
+        asyncio.run(self.client.send_files_async(file_paths))
+        rel_paths = [file_path.relative_to(globals.WORK_DIR) for file_path in file_paths]
+        old_pack = globals.SERVER_FILE_DICT[rel_paths[0]].pack
+        self.client.delete_remote_files(rel_paths[:3])
+        self.list_from_scratch()
+        self.assertEqual(sorted(globals.SERVER_FILE_DICT), sorted(rel_paths[3:]))
+        self.client.delete_remote_files(rel_paths[3:6])
+        self.client.repack_executor.submit(lambda: None).result()  # Wait for the repacking
+        self.assertIsNone(self.server.get_stored_file(self.client.userID, old_pack))
+        self.list_from_scratch()
+        self.assertEqual(sorted(globals.SERVER_FILE_DICT), sorted(rel_paths[6:]))
+        pack, = self.client.server_packs['default'].values()
+        self.assertEqual(len(pack.index), 4)
+        content = file_paths[9].read_bytes()
+        file_paths[9].unlink()
+        self.client.get_file(rel_paths[9])
+        self.client.close_observers()
+        self.assertEqual(file_paths[9].read_bytes(), content, "Files differ!")
+
+    def test_repack_does_not_hold_up_file_lists(self):
+        """Test that the server file lists are combined while a pack is being repacked, such that the repacking
+        thread only holds the pack lock between its requests"""
+        file_paths = [self.create_random_file() for _ in range(10)]
+        asyncio.run(self.client.send_files_async(file_paths))
+        rel_paths = [file_path.relative_to(globals.WORK_DIR) for file_path in file_paths]
+        servercoms = self.client.servercoms
+        get_file_range = servercoms.get_file_range
+        combined_during_repack = []
+
+        def combine_then_get_file_range(*args):
+            if threading.current_thread().name.startswith('cio-repack'):
+                combiner = threading.Thread(target=self.client.combine_server_file_lists)
+                combiner.start()
+                combiner.join(10)
+                combined_during_repack.append(not combiner.is_alive())
+            return get_file_range(*args)
+
+        servercoms.get_file_range = combine_then_get_file_range
+        try:
+            self.client.delete_remote_files(rel_paths[:6])
+            self.client.repack_executor.submit(lambda: None).result()  # Wait for the repacking
+        finally:
+            del servercoms.get_file_range
+        self.assertEqual(combined_during_repack, [True])
+        pack, = self.client.server_packs['default'].values()
+        self.assertEqual(len(pack.index), 4)
+
+    def test_packed_file_sent_again_leaves_pack(self):
+        """Test that a file of a pack sent again on its own replaces its version in the pack, which does not come
+        back once the file is deleted"""
+        file_paths = [self.create_random_file() for _ in range(10)]
+        asyncio.run(self.client.send_files_async(file_paths))
+        rel_path = file_paths[0].relative_to(globals.WORK_DIR)
+        file_paths[0].write_bytes(os.urandom(1024))
+        self.client.send_file(file_paths[0], globals.SERVER_FILE_DICT[rel_path].nonce)
+        self.list_from_scratch()
+        self.assertIsNone(globals.SERVER_FILE_DICT[rel_path].pack)
+        self.client.delete_remote_file(rel_path)
+        self.list_from_scratch()
+        self.assertNotIn(rel_path, globals.SERVER_FILE_DICT)
+        self.assertEqual(len(globals.SERVER_FILE_DICT), 9)
+
+    def test_restarted_client_lists_only_changes(self):
+        """Test that a client started again takes up the server file list where it was, reading no pack again, and
+        then gets what changed since; also when the server gave no cursor"""
+        file_paths = [self.create_random_file() for _ in range(12)]
+        asyncio.run(self.client.send_files_async(file_paths[:10]))  # In a pack
+        self.client.send_file(file_paths[10])
+        self.client.update_server_file_list()
+        downloads_before = self.count_requests('get_file')
+        restarted = Client(username=self.username, password=self.pw, server_location=self.serverIp)
+        restarted.close_observers()
+        self.assertEqual(self.count_requests('get_file'), downloads_before)
+        rel_paths = [file_path.relative_to(globals.WORK_DIR) for file_path in file_paths]
+        self.assertEqual(sorted(globals.SERVER_FILE_DICT), sorted(rel_paths[:11]))
+        self.client.send_file(file_paths[11])
+        self.client.delete_remote_file(rel_paths[10])
+        restarted.update_server_file_list()
+        self.assertEqual(sorted(globals.SERVER_FILE_DICT), sorted(rel_paths[:10] + rel_paths[11:]))
+        self.client.metadata_db.apply_changes(self.client.get_folder_key('default'), [], [], False, None)
+        restarted = Client(username=self.username, password=self.pw, server_location=self.serverIp)
+        restarted.close_observers()
+        self.assertEqual(self.count_requests('get_file'), downloads_before)
+        self.assertEqual(sorted(globals.SERVER_FILE_DICT), sorted(rel_paths[:10] + rel_paths[11:]))
+
+    def list_from_scratch(self):
+        """Get the server file list as a client that never saw it would, reading the packs again"""
+        self.client.server_file_dicts, self.client.server_packs = {}, {}
+        self.client.servercoms.list_cursor = None
+        self.client.update_server_file_list()
+
+    def count_requests(self, endpoint: str) -> int:
+        """The amount of requests the server got to the endpoint"""
+        return len([path for _, path in self.server.request_log if path.split('/')[1] == endpoint])
+
+    def create_random_file(self, path: pl.Path = globals.FILE_FOLDER, size: int = 1024) -> pl.Path:
+        """Create a random file in the file folder, give back the path
+
+        Args:
+            path: where to place the random file (default= files folder)
+            size: the amount of random bytes in the file
+
+        Returns:
+            pl.Path: the path of the just created random file
+        """
+        random_file_path = pl.Path.joinpath(path, os.urandom(8).hex() + ".test")
+        self.random_files_list.append(random_file_path)
+        with open(random_file_path, 'wb') as new_file:
+            new_file.write(os.urandom(size))
+        return random_file_path
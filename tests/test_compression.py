@@ -0,0 +1,42 @@
+import os
+import pathlib as pl
+import unittest
+
+from resources import globals
+from security import compression
+
+
+class TestCompression(unittest.TestCase):
+    """Class for unittesting the compression before encryption of compression.py"""
+
+    def test_compressed_content_is_skipped(self):
+        """Test that a JPEG or random bytes are left uncompressed, while text is compressed"""
+        with open(pl.Path(globals.TEST_FILE_FOLDER, "pic1.jpg"), 'rb') as file:
+            self.assertIsNone(compression.choose_codec(file.read(globals.COMPRESSION_SAMPLE_SIZE)))
+        self.assertIsNone(compression.choose_codec(os.urandom(globals.COMPRESSION_SAMPLE_SIZE)))
+        with open(pl.Path(globals.TEST_FILE_FOLDER, "profanity_wordlist.txt"), 'rb') as file:
+            self.assertEqual(compression.choose_codec(file.read(globals.COMPRESSION_SAMPLE_SIZE)), 'zlib')
+
+    def test_compression_can_be_turned_off(self):
+        """Test that no codec is chosen when compression is turned off, or for tiny files"""
+        codec = globals.COMPRESSION
+        globals.COMPRESSION = None
+        try:
+            self.assertIsNone(compression.choose_codec(b'a' * 10000))
+        finally:
+            globals.COMPRESSION = codec
+        self.assertIsNone(compression.choose_codec(b'a' * (globals.COMPRESSION_MIN_SIZE - 1)))
+
+    def test_round_trip_in_any_chunks(self):
+        """Test that every installed codec decompresses what it compressed, however the stream is chunked"""
+        content = b''.join(b'line %d,%d\n' % (i, i * i) for i in range(20000))
+        for name in compression.get_codecs():
+            compressed = b''.join(compression.compress_chunks([content[:1000], content[1000:]], name))
+            self.assertLess(len(compressed), len(content) / 2)
+            chunks = [compressed[i:i + 333] for i in range(0, len(compressed), 333)]
+            self.assertEqual(b''.join(compression.decompress_chunks(chunks, name)), content)
+
+    def test_unknown_codec(self):
+        """Test that content compressed with a codec not installed is refused"""
+        self.assertRaises(compression.UnknownCodecError,
+                          lambda: b''.join(compression.decompress_chunks([b'x'], 'no such codec')))
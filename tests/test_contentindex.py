@@ -0,0 +1,64 @@
+import os
+import pathlib as pl
+import unittest
+
+from resources import globals
+from security.contentindex import ContentIndex
+
+
+class TestContentIndex(unittest.TestCase):
+    """Class for unittesting the index of the content of local files of contentindex.py"""
+
+    def setUp(self):
+        self.index_path = globals.TEMPORARY_FOLDER / "content_index_test"
+        self.index = ContentIndex(globals.generate_random_key(), self.index_path)
+        self.file_path = globals.TEMPORARY_FOLDER / "indexed.txt"
+        self.rel_path = self.file_path.relative_to(globals.WORK_DIR)
+        self.file_path.write_bytes(os.urandom(1000))
+        self.time_stamp = self.file_path.stat().st_mtime
+
+    def tearDown(self):
+        globals.clear_tmp()
+
+    def test_same_content_saved_again_is_unchanged(self):
+        """Test that a file rewritten with the same content is unchanged, with its new time noted, while other
+        content, another size or another server version is not"""
+        content = self.file_path.read_bytes()
+        self.index.record(self.rel_path, self.file_path, 'a.cio', self.time_stamp)
+        self.assertTrue(self.index.is_unchanged(self.rel_path, self.file_path, 'a.cio', self.time_stamp))
+        self.touch(content)
+        self.assertTrue(self.index.is_unchanged(self.rel_path, self.file_path, 'a.cio', self.time_stamp))
+        self.assertEqual(self.index.entries[self.rel_path.as_posix()]['mtime_ns'], self.file_path.stat().st_mtime_ns)
+        self.assertFalse(self.index.is_unchanged(self.rel_path, self.file_path, 'a.cio', self.time_stamp + 1))
+        self.assertFalse(self.index.is_unchanged(self.rel_path, self.file_path, 'b.cio', self.time_stamp))
+        self.touch(content[:-1] + bytes([content[-1] ^ 1]))
+        self.assertFalse(self.index.is_unchanged(self.rel_path, self.file_path, 'a.cio', self.time_stamp))
+        self.touch(content + b'x')
+        self.assertFalse(self.index.is_unchanged(self.rel_path, self.file_path, 'a.cio', self.time_stamp))
+
+    def test_file_modified_since_version_is_not_recorded(self):
+        """Test that a file modified after the version sent, e.g. while it was sent, is not taken as sent"""
+        self.index.record(self.rel_path, self.file_path, 'a.cio', self.time_stamp)
+        self.touch(os.urandom(1000))
+        self.index.record(self.rel_path, self.file_path, 'a.cio', self.time_stamp)
+        self.assertFalse(self.index.is_unchanged(self.rel_path, self.file_path, 'a.cio', self.time_stamp))
+        self.assertNotIn(self.rel_path.as_posix(), self.index.entries)
+
+    def test_index_is_kept_between_runs(self):
+        """Test that a saved index is read again, with the same key, and that a forgotten file is gone from it"""
+        key = globals.generate_random_key()
+        index = ContentIndex(key, self.index_path)
+        index.record(self.rel_path, self.file_path, 'a.cio', self.time_stamp)
+        index.save()
+        self.assertTrue(ContentIndex(key, self.index_path).is_unchanged(self.rel_path, self.file_path, 'a.cio',
+                                                                        self.time_stamp))
+        index.forget(self.rel_path)
+        index.save(force=True)
+        self.assertFalse(ContentIndex(key, self.index_path).is_unchanged(self.rel_path, self.file_path, 'a.cio',
+                                                                         self.time_stamp))
+
+    def touch(self, content: bytes):
+        """Rewrite the test file with content, a second later than it was"""
+        file_stat = self.file_path.stat()
+        self.file_path.write_bytes(content)
+        os.utime(self.file_path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 10 ** 9))
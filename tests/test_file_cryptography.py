@@ -1,10 +1,14 @@
+import contextlib
+import io
+import json
+import os
 import pathlib as pl
 
 import cryptography
 import unittest
 
-from security import keyderivation
-from security.filecryptography import FileCryptography
+from security import filecryptography, keyderivation
+from security.filecryptography import FileCryptography, TAG_SIZE
 import tests.setup_test_environment as ste
 from resources import globals
 from tests import test_keyderivation
@@ -77,6 +81,315 @@ class test_file_cryptography(unittest.TestCase):
         enc_file_path = self.file_crypt.encrypt_relative_file_path(file_path, nonce)
         self.assertRaises(PermissionError, self.file_crypt.decrypt_relative_file_path, enc_file_path, nonce)
 
+    def test_segmented_encrypt_decrypt(self):
+        """test that a file of many segments, also ending on a segment boundary, decrypts to the same file"""
+        pic_path = pl.PurePath.joinpath(globals.TEST_FILE_FOLDER, "pic1.jpg")
+        with open(pic_path, "rb") as file:
+            start_file = file.read()
+        for segment_size in (1000, len(start_file) // 4, len(start_file)):
+            with self.segment_size(segment_size):
+                encrypted_file_path, additional_data = self.file_crypt.encrypt_file(
+                    pic_path, globals.generate_random_nonce(), globals.generate_random_nonce())
+            self.assertEqual(additional_data['v'], 2)
+            self.assertEqual(encrypted_file_path.stat().st_size,
+                             len(start_file) + -(-len(start_file) // segment_size) * TAG_SIZE)
+            file_decrypted = self.file_crypt.decrypt_file(encrypted_file_path, additional_data)
+            with open(file_decrypted, "rb") as file:
+                self.assertEqual(start_file, file.read(), "Files differ!")
+
+    def test_stream_decrypts_any_chunking(self):
+        """test that ciphertext decrypts no matter how it is chunked, also for an empty file"""
+        for content in (b'', os.urandom(5000)):
+            additional_data = {'t': 0, 'n': 'x.cio', 'nonce1': '00', 'nonce2': globals.generate_random_nonce().hex(),
+                               'v': 2, 's': 1024}
+            ciphertext = b''.join(self.file_crypt.encrypt_stream(io.BytesIO(content), additional_data))
+            chunks = [ciphertext[i:i + 77] for i in range(0, len(ciphertext), 77)]
+            self.assertEqual(b''.join(self.file_crypt.decrypt_stream(chunks, additional_data)), content)
+
+    def test_segments_cut_off_or_moved_are_detected(self):
+        """test that dropping the last segments or swapping segments fails to authenticate"""
+        additional_data = {'t': 0, 'n': 'x.cio', 'nonce1': '00', 'nonce2': globals.generate_random_nonce().hex(),
+                           'v': 2, 's': 1024}
+        segments = list(self.file_crypt.encrypt_stream(io.BytesIO(os.urandom(4096)), additional_data))
+        self.assertEqual(len(segments), 4)
+        for damaged in (segments[:3], segments[:2] + segments[3:], [segments[1], segments[0]] + segments[2:],
+                        segments + segments[3:]):
+            self.assertRaises(cryptography.exceptions.InvalidTag,
+                              lambda: b''.join(self.file_crypt.decrypt_stream(damaged, additional_data)))
+
+    def test_legacy_format_still_decrypts(self):
+        """test that files encrypted in one piece, with no version in the additional data, still decrypt"""
+        with open(self.file_path, "rb") as file:
+            start_file = file.read()
+        format_version = globals.ENCRYPTION_FORMAT_VERSION
+        globals.ENCRYPTION_FORMAT_VERSION = 1
+        try:
+            encrypted_file_path, additional_data = self.file_crypt.encrypt_file(
+                self.file_path, globals.generate_random_nonce(), globals.generate_random_nonce())
+        finally:
+            globals.ENCRYPTION_FORMAT_VERSION = format_version
+        self.assertNotIn('v', additional_data)
+        with open(encrypted_file_path, "rb") as file:  # As older clients encrypted
+            self.assertEqual(file.read(), self.file_crypt.aesgcm.encrypt(
+                bytes.fromhex(additional_data['nonce2']), start_file, bytes(json.dumps(additional_data), 'utf-8')))
+        file_decrypted = self.file_crypt.decrypt_file(encrypted_file_path, additional_data)
+        with open(file_decrypted, "rb") as file:
+            self.assertEqual(start_file, file.read(), "Files differ!")
+
+    def test_damaged_file_leaves_destination_alone(self):
+        """test that a file failing to authenticate does not replace or damage the local file"""
+        pic_path = pl.PurePath.joinpath(globals.TEST_FILE_FOLDER, "pic1.jpg")
+        with open(pic_path, "rb") as file:
+            start_file = file.read()
+        with self.segment_size(1024):
+            encrypted_file_path, additional_data = self.file_crypt.encrypt_file(
+                pic_path, globals.generate_random_nonce(), globals.generate_random_nonce())
+        with open(encrypted_file_path, "r+b") as file:
+            file.seek(len(start_file) // 2)
+            byte = file.read(1)[0]
+            file.seek(len(start_file) // 2)
+            file.write(bytes([byte ^ 1]))
+        self.assertRaises(cryptography.exceptions.InvalidTag,
+                          self.file_crypt.decrypt_file, encrypted_file_path, additional_data)
+        with open(pic_path, "rb") as file:
+            self.assertEqual(start_file, file.read(), "Local file damaged!")
+        self.assertFalse(pl.Path(str(pic_path) + globals.PARTIAL_FILE_SUFFIX).exists())
+
+    def test_compressed_encrypt_decrypt(self):
+        """test that text is compressed before encryption, decrypts to the same file however the ciphertext is
+        chunked, and gives the same ciphertext when encrypted in a batch"""
+        text_path = pl.Path(globals.TEST_FILE_FOLDER, "profanity_wordlist.txt")
+        start_file = text_path.read_bytes()
+        nonces = globals.generate_random_nonce(), globals.generate_random_nonce()
+        with self.segment_size(1000):
+            encrypted_file_path, additional_data = self.file_crypt.encrypt_file(text_path, *nonces)
+            (ciphertext, batch_additional_data), = self.file_crypt.encrypt_many([(text_path,) + nonces])
+        self.assertEqual(additional_data['c'], 'zlib')
+        self.assertLess(encrypted_file_path.stat().st_size, len(start_file) * 0.9)
+        self.assertEqual((ciphertext, batch_additional_data), (encrypted_file_path.read_bytes(), additional_data))
+        chunks = [ciphertext[i:i + 77] for i in range(0, len(ciphertext), 77)]
+        self.assertEqual(b''.join(self.file_crypt.decrypt_stream(chunks, additional_data)), start_file)
+        file_decrypted = self.file_crypt.decrypt_file(encrypted_file_path, additional_data)
+        self.assertEqual(file_decrypted.read_bytes(), start_file, "Files differ!")
+        uncompressed = dict(additional_data)
+        del uncompressed['c']  # The codec is authenticated along with the rest of the additional data
+        self.assertRaises(cryptography.exceptions.InvalidTag,
+                          lambda: b''.join(self.file_crypt.decrypt_stream([ciphertext], uncompressed)))
+
+    def test_parallel_segments_match_serial(self):
+        """test that segments encrypted and decrypted on many threads give the same bytes, in the same order, as on
+        one, also when a segment fails to authenticate"""
+        content = os.urandom(100 * 1024 + 7)
+        additional_data = {'t': 0, 'n': 'x.cio', 'nonce1': '00', 'nonce2': globals.generate_random_nonce().hex(),
+                           'v': 2, 's': 1024}
+        with self.encryption_workers(1):
+            serial = list(self.file_crypt.encrypt_stream(io.BytesIO(content), additional_data))
+        with self.encryption_workers(4):
+            parallel = list(self.file_crypt.encrypt_stream(io.BytesIO(content), additional_data))
+            self.assertEqual(parallel, serial)
+            self.assertEqual(b''.join(self.file_crypt.decrypt_stream(parallel, additional_data)), content)
+            damaged = parallel[:50] + [bytes([parallel[50][0] ^ 1]) + parallel[50][1:]] + parallel[51:]
+            self.assertRaises(cryptography.exceptions.InvalidTag,
+                              lambda: b''.join(self.file_crypt.decrypt_stream(damaged, additional_data)))
+
+    def test_parallel_segments_bounded(self):
+        """test that no more than two segments per thread are taken ahead of the one handed on"""
+        taken = []
+
+        def arguments():
+            for index in range(100):
+                taken.append(index)
+                yield index,
+
+        with self.encryption_workers(3):
+            for index, result in enumerate(filecryptography.map_segments(lambda i: i * 2, arguments())):
+                self.assertEqual(result, index * 2)
+                self.assertLessEqual(len(taken) - index, 2 * 3)
+
+    def test_pool_resized_while_in_use(self):
+        """test that segments still under way finish on their pool when the amount of threads changes, and that the
+        old pool is shut down once they are done"""
+        with self.encryption_workers(3):
+            segments = filecryptography.map_segments(lambda i: i * 2, ((index,) for index in range(100)))
+            self.assertEqual(next(segments), 0)
+            old_pool = filecryptography.get_segment_pool()
+            filecryptography.release_segment_pool(old_pool)
+        with self.encryption_workers(2):
+            self.assertEqual(list(filecryptography.map_segments(lambda i: i + 1, ((1,), (2,)))), [2, 3])
+            self.assertEqual(list(segments), [index * 2 for index in range(1, 100)])
+            new_pool = filecryptography.get_segment_pool()
+            filecryptography.release_segment_pool(new_pool)
+            self.assertIsNot(new_pool, old_pool)
+        self.assertRaises(RuntimeError, old_pool.submit, print)
+
+    def test_encrypt_many_matches_encrypt_file(self):
+        """test that files encrypted in a batch give, in order, the ciphertext encrypting each on its own gives, and
+        that files too big or missing are told apart"""
+        file_paths = [pl.PurePath.joinpath(globals.TEST_FILE_FOLDER, name) for name in ("client.txt", "pic1.jpg")]
+        files = [(pl.Path(file_path), globals.generate_random_nonce(), globals.generate_random_nonce())
+                 for file_path in file_paths * 3]
+        files.append((pl.Path(globals.TEST_FILE_FOLDER, "not_there.txt"),
+                      globals.generate_random_nonce(), globals.generate_random_nonce()))
+        with self.segment_size(1000), self.encryption_workers(3):
+            results = self.file_crypt.encrypt_many(files)
+            for file, (ciphertext, additional_data) in zip(files[:-1], results):
+                encrypted_file_path, expected_additional_data = self.file_crypt.encrypt_file(*file)
+                self.assertEqual(additional_data, expected_additional_data)
+                self.assertEqual(ciphertext, encrypted_file_path.read_bytes())
+        self.assertIsInstance(results[-1], FileNotFoundError)
+        max_size = globals.BATCH_ENCRYPTION_MAX_SIZE
+        globals.BATCH_ENCRYPTION_MAX_SIZE = 1000
+        try:
+            self.assertIsNone(self.file_crypt.encrypt_many(files[1:2])[0])
+        finally:
+            globals.BATCH_ENCRYPTION_MAX_SIZE = max_size
+
+    def test_decrypt_many(self):
+        """test that files decrypted in a batch are all restored, a damaged one failing on its own"""
+        pic_path = pl.Path(globals.TEST_FILE_FOLDER, "pic1.jpg")
+        start_file = pic_path.read_bytes()
+        with self.segment_size(1000), self.encryption_workers(3):
+            (ciphertext, additional_data), = self.file_crypt.encrypt_many(
+                [(pic_path, globals.generate_random_nonce(), globals.generate_random_nonce())])
+            damaged = ciphertext[:100] + bytes([ciphertext[100] ^ 1]) + ciphertext[101:]
+            results = self.file_crypt.decrypt_many([(additional_data['n'], damaged, additional_data),
+                                                    (additional_data['n'], ciphertext, additional_data)])
+        self.assertIsInstance(results[0], cryptography.exceptions.InvalidTag)
+        self.assertEqual(results[1], pic_path)
+        self.assertEqual(pic_path.read_bytes(), start_file, "Files differ!")
+
+    def test_reused_buffers_match_stream_in_memory(self):
+        """test that reading ranges of a file being sent and decrypting a download through reused buffers give the
+        same bytes as the stream, whatever the chunks of the download, and that damaged or cut off ciphertext fails"""
+        content = os.urandom(4000)
+        file_path = pl.Path(globals.TEMPORARY_FOLDER, "buffers.bin")
+        for size in (0, 1000, 3000, 3500):
+            file_path.write_bytes(content[:size])
+            with self.segment_size(1000), self.encryption_workers(3):
+                enc_file = self.file_crypt.open_encrypted(file_path, globals.generate_random_nonce(),
+                                                          globals.generate_random_nonce())
+                additional_data = enc_file.additional_data
+                with open(file_path, 'rb') as file:
+                    ciphertext = b''.join(self.file_crypt.encrypt_stream(file, additional_data))
+                self.assertEqual(enc_file.read_all(), ciphertext)
+                self.assertEqual(enc_file.read(enc_file.alignment, 1500), ciphertext[enc_file.alignment:][:1500])
+                chunks = [ciphertext[start:start + 777] for start in range(0, len(ciphertext), 777)]
+                for reuse_buffers in (False, True):
+                    globals.REUSE_IO_BUFFERS = reuse_buffers
+                    try:
+                        file_path.unlink()
+                        self.file_crypt.decrypt_into_place(additional_data['n'], chunks, additional_data)
+                        self.assertEqual(file_path.read_bytes(), content[:size])
+                        for damaged in ([ciphertext[:-1]], [ciphertext[:-1] + bytes([ciphertext[-1] ^ 1])],
+                                        [ciphertext + b'x' * 20]):
+                            self.assertRaises(cryptography.exceptions.InvalidTag, self.file_crypt.decrypt_into_place,
+                                              additional_data['n'], damaged, additional_data)
+                    finally:
+                        globals.REUSE_IO_BUFFERS = True
+
+    def test_changed_file_not_encrypted_again(self):
+        """test that a file opened for sending is not encrypted again under its nonces once it changed, also when
+        keeping its size"""
+        file_path = pl.Path(globals.TEMPORARY_FOLDER, "changed.bin")
+        file_path.write_bytes(os.urandom(4000))
+        with self.segment_size(1000):
+            enc_file = self.file_crypt.open_encrypted(file_path, globals.generate_random_nonce(),
+                                                      globals.generate_random_nonce())
+            ciphertext = enc_file.read_all()
+            self.assertEqual(enc_file.read(enc_file.alignment, 10), ciphertext[enc_file.alignment:][:10])
+            file_stat = file_path.stat()
+            file_path.write_bytes(os.urandom(4000))
+            os.utime(file_path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 1000))
+            self.assertRaises(filecryptography.FileChangedError, enc_file.read_all)
+            self.assertRaises(filecryptography.FileChangedError, enc_file.read, 0, 10)
+
+    def test_rewrite_keeping_time_not_encrypted_again(self):
+        """test that a file rewritten with the same size and modification time, as within one tick of the clock, is
+        not encrypted again under its nonces, compressed or not"""
+        file_path = pl.Path(globals.TEMPORARY_FOLDER, "rewritten.bin")
+        for content, rewritten in ((os.urandom(4000), os.urandom(4000)), (b'a' * 4000, b'b' * 4000)):
+            file_path.write_bytes(content)
+            with self.segment_size(1000):
+                enc_file = self.file_crypt.open_encrypted(file_path, globals.generate_random_nonce(),
+                                                          globals.generate_random_nonce())
+                self.assertEqual(enc_file.read_all(), enc_file.read_all())
+                file_stat = file_path.stat()
+                file_path.write_bytes(rewritten)
+                os.utime(file_path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+                self.assertRaises(filecryptography.FileChangedError, enc_file.read_all)
+                if enc_file.seekable:
+                    self.assertRaises(filecryptography.FileChangedError, enc_file.read, enc_file.alignment, 10)
+        self.assertIn('c', enc_file.additional_data)
+
+    def test_manifest_has_own_nonce(self):
+        """test that the manifest of a chunked file is encrypted under a nonce of its own, never that of the file, and
+        still decrypts"""
+        file_path = pl.Path(globals.TEMPORARY_FOLDER, "chunked.bin")
+        file_path.write_bytes(os.urandom(4000))
+        enc_file = self.file_crypt.open_encrypted(file_path, globals.generate_random_nonce(),
+                                                  globals.generate_random_nonce())
+        chunked_file = enc_file.chunked()
+        chunked_file.chunk_ids()
+        manifest, additional_data = chunked_file.manifest()
+        self.assertNotEqual(additional_data['nonce2'], enc_file.additional_data['nonce2'])
+        self.assertEqual(additional_data['nonce1'], enc_file.additional_data['nonce1'])
+        self.assertNotEqual(chunked_file.manifest()[1]['nonce2'], additional_data['nonce2'])
+        self.assertEqual(json.loads(b''.join(self.file_crypt.decrypt_stream([manifest], additional_data)))['size'],
+                         4000)
+
+    def test_reused_buffers_match_stream(self):
+        """test that files en/decrypted through reused buffers give the same bytes as through the stream, for files
+        empty, of whole segments and with a segment cut short, and that a damaged one leaves nothing behind"""
+        content = os.urandom(4000)
+        file_path = pl.Path(globals.TEMPORARY_FOLDER, "buffers.bin")
+        for size in (0, 1000, 3000, 3500):
+            file_path.write_bytes(content[:size])
+            nonces = globals.generate_random_nonce(), globals.generate_random_nonce()
+            ciphertexts = []
+            with self.segment_size(1000), self.encryption_workers(3):
+                for reuse_buffers in (False, True):
+                    globals.REUSE_IO_BUFFERS = reuse_buffers
+                    try:
+                        encrypted_file_path, additional_data = self.file_crypt.encrypt_file(file_path, *nonces)
+                        ciphertexts.append(encrypted_file_path.read_bytes())
+                        file_path.unlink()
+                        self.assertEqual(self.file_crypt.decrypt_file(encrypted_file_path, additional_data),
+                                         file_path)
+                        self.assertEqual(file_path.read_bytes(), content[:size])
+                    finally:
+                        globals.REUSE_IO_BUFFERS = True
+            self.assertEqual(ciphertexts[0], ciphertexts[1])
+        with open(encrypted_file_path, "r+b") as file:
+            file.seek(1500)
+            byte = file.read(1)[0]
+            file.seek(1500)
+            file.write(bytes([byte ^ 1]))
+        with self.segment_size(1000), self.encryption_workers(3):
+            self.assertRaises(cryptography.exceptions.InvalidTag,
+                              self.file_crypt.decrypt_file, encrypted_file_path, additional_data)
+        self.assertEqual(file_path.read_bytes(), content[:3500], "Local file damaged!")
+        self.assertFalse(pl.Path(str(file_path) + globals.PARTIAL_FILE_SUFFIX).exists())
+
+    @contextlib.contextmanager
+    def encryption_workers(self, workers: int):
+        """Context in which segments are encrypted and decrypted on the given amount of threads"""
+        previous = globals.ENCRYPTION_WORKERS
+        globals.ENCRYPTION_WORKERS = workers
+        try:
+            yield
+        finally:
+            globals.ENCRYPTION_WORKERS = previous
+
+    @contextlib.contextmanager
+    def segment_size(self, segment_size: int):
+        """Context in which files are encrypted in segments of the given size"""
+        previous = globals.ENCRYPTION_SEGMENT_SIZE
+        globals.ENCRYPTION_SEGMENT_SIZE = segment_size
+        try:
+            yield
+        finally:
+            globals.ENCRYPTION_SEGMENT_SIZE = previous
+
     def recover_enc_old_keys(self, enc_old_keys):
         """Not used..."""
         for ct_nonce_pair in enc_old_keys:
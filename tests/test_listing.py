@@ -0,0 +1,37 @@
+import json
+import os
+import unittest
+
+from network.listing import BadListingError, decode_listing, encode_listing
+
+
+class TestListing(unittest.TestCase):
+    """Class for unittesting the binary listing format of listing.py"""
+
+    def setUp(self):
+        self.listing = {'file_list': [[os.urandom(48).hex() + '.cio', os.urandom(16).hex(), 1546300800.123456]
+                                      for _ in range(10)],
+                        'archived': [os.urandom(48).hex() + '.cio' for _ in range(3)],
+                        'cursor': 42,
+                        'full': False}
+
+    def test_round_trip(self):
+        """Test that a listing decodes to what was encoded"""
+        self.assertEqual(decode_listing(encode_listing(self.listing)), self.listing)
+
+    def test_round_trip_without_cursor(self):
+        """Test that a listing without cursor or archived names decodes without a cursor"""
+        listing = {'file_list': self.listing['file_list']}
+        self.assertEqual(decode_listing(encode_listing(listing)),
+                         {'file_list': listing['file_list'], 'archived': [], 'full': False})
+
+    def test_smaller_than_json(self):
+        """Test that the binary format is at most about half the size of the JSON format"""
+        self.assertLess(len(encode_listing(self.listing)), len(json.dumps(self.listing)) * 0.6)
+
+    def test_truncated_listing_is_rejected(self):
+        """Test that cut off or unknown data raises BadListingError"""
+        encoded = encode_listing(self.listing)
+        self.assertRaises(BadListingError, decode_listing, encoded[:-1])
+        self.assertRaises(BadListingError, decode_listing, encoded + b'\x00')
+        self.assertRaises(BadListingError, decode_listing, b'{"file_list": []}')
@@ -0,0 +1,92 @@
+import os
+import pathlib as pl
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from metadata_db import MetadataDB
+from resources import globals
+from resources.globals import FileInfo
+from security import packing
+
+
+class TestMetadataDB(unittest.TestCase):
+    """Class for unittesting the database of server file lists of metadata_db.py"""
+
+    def setUp(self):
+        self.folder = pl.Path(tempfile.mkdtemp())
+        self.db_path = self.folder / "metadata.db"
+        self.db = MetadataDB(self.db_path)
+        self.aesgcm = AESGCM(globals.generate_random_key())
+        self.fios = [FileInfo(pl.Path("files") / (str(number) + ".txt"), globals.generate_random_nonce(),
+                              os.urandom(8).hex(), 1000.5 + number) for number in range(5)]
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def test_changes_are_kept_between_runs(self):
+        """Test that the files and cursor of a folder are read again as merged, and that a full list replaces them"""
+        self.assertIsNone(self.db.load_folder('server/user', self.aesgcm))
+        self.db.apply_changes('server/user', self.fios[:3], [], True, 7)
+        self.db.apply_changes('server/user', self.fios[3:], [self.fios[0].enc_path], False, 9)
+        self.db.apply_changes('server/other', self.fios[:1], [], True, 1)
+        self.db.close()
+        cursor, entries, packs = MetadataDB(self.db_path).load_folder('server/user', self.aesgcm)
+        self.assertEqual(cursor, 9)
+        self.assertEqual(sorted(entries), sorted([fio.enc_path, fio.nonce.hex(), fio.time_stamp]
+                                                 for fio in self.fios[1:]))
+        self.assertEqual(packs, {})
+        self.db = MetadataDB(self.db_path)
+        self.db.apply_changes('server/user', self.fios[:1], [], True, 10)
+        self.assertEqual([entry[0] for entry in self.db.load_folder('server/user', self.aesgcm)[1]],
+                         [self.fios[0].enc_path])
+
+    def test_full_lists_without_cursor_write_only_changes(self):
+        """Test that a folder listed in full, without cursors, is kept, and that listing it again unchanged writes no
+        file"""
+        self.db.apply_changes('server/user', self.fios, [], True, None)
+        self.assertEqual(len(self.db.load_folder('server/user', self.aesgcm)[1]), 5)
+        changes_before = self.db.connection.total_changes
+        self.db.apply_changes('server/user', self.fios, [], True, None)
+        self.assertEqual(self.db.connection.total_changes - changes_before, 1)  # The cursor only
+        self.db.apply_changes('server/user', self.fios[1:], [], True, None)
+        cursor, entries, _ = self.db.load_folder('server/user', self.aesgcm)
+        self.assertIsNone(cursor)
+        self.assertEqual(sorted(entry[0] for entry in entries), sorted(fio.enc_path for fio in self.fios[1:]))
+
+    def test_packs_are_kept_sealed(self):
+        """Test that a pack is read again with its index and deleted files, that no name is kept in plain text, and
+        that the pack is gone once removed"""
+        pack = packing.Pack(self.fios[0], [["files/a.txt", 30, 40, {'n': 'a'}], ["files/b.txt", 70, 40, {'n': 'b'}]])
+        pack.deleted, pack.deleted_fio = {"files/a.txt"}, self.fios[1]
+        self.db.apply_changes('server/user', [], [], True, 1)
+        self.db.put_packs('server/user', self.aesgcm, [pack])
+        self.db.close()
+        content = b''.join(path.read_bytes() for path in self.folder.iterdir())
+        self.assertNotIn(b'a.txt', content)
+        self.assertNotIn(b'0.txt', content)
+        self.db = MetadataDB(self.db_path)
+        _, entries, packs = self.db.load_folder('server/user', self.aesgcm)
+        self.assertEqual(packs[self.fios[0].enc_path], (pack.index, pack.deleted, self.fios[1].enc_path))
+        self.assertEqual(sorted(entry[0] for entry in entries), sorted([self.fios[0].enc_path, self.fios[1].enc_path]))
+        self.assertEqual(self.db.load_folder('server/user', AESGCM(globals.generate_random_key()))[2], {})
+        self.db.remove_packs('server/user', [self.fios[0].enc_path])
+        self.assertEqual(self.db.load_folder('server/user', self.aesgcm)[2], {})
+
+    def test_damaged_database_is_started_over(self):
+        """Test that a database that is not one, or of another version, is replaced by an empty one"""
+        self.db.close()
+        self.db_path.write_bytes(os.urandom(4096))
+        self.db = MetadataDB(self.db_path)
+        self.assertIsNone(self.db.load_folder('server/user', self.aesgcm))
+        self.db.apply_changes('server/user', self.fios, [], True, 1)
+        self.db.close()
+        connection = sqlite3.connect(str(self.db_path))
+        connection.execute('PRAGMA user_version = 1')
+        connection.close()
+        self.db = MetadataDB(self.db_path)
+        self.assertIsNone(self.db.load_folder('server/user', self.aesgcm))
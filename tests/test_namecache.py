@@ -0,0 +1,85 @@
+import pathlib as pl
+import unittest
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from resources import globals
+from security.filecryptography import FileCryptography
+from security.namecache import NameCache
+
+
+class TestNameCache(unittest.TestCase):
+    """Class for unittesting the cache of decrypted server file names of namecache.py"""
+
+    def setUp(self):
+        self.file_crypt = FileCryptography(globals.generate_random_key())
+        self.cache_path = globals.TEMPORARY_FOLDER / "name_cache_test"
+
+    def tearDown(self):
+        globals.clear_tmp()
+
+    def test_listing_again_only_decrypts_new_names(self):
+        """Test that decrypting a listing twice only decrypts the names not seen the first time"""
+        listing = [self.list_entry(pl.Path("files", "a", str(i))) for i in range(20)]
+        decrypted = []
+        decrypt = self.file_crypt.decrypt_listed_name
+        self.file_crypt.decrypt_listed_name = lambda *args: decrypted.append(args) or decrypt(*args)
+        first = self.file_crypt.decrypt_server_file_list(listing)
+        self.assertEqual(len(decrypted), 20)
+        listing.append(self.list_entry(pl.Path("files", "a", "new")))
+        second = self.file_crypt.decrypt_server_file_list(listing)
+        self.assertEqual(len(decrypted), 21)
+        self.assertEqual(set(second) - set(first), {pl.Path("files", "a", "new")})
+        self.assertEqual(second[pl.Path("files", "a", "3")].enc_path, listing[3][0])
+
+    def test_parallel_listing_same_as_serial(self):
+        """Test that a listing decrypted in chunks on many threads gives the same files as one by one, and still
+        refuses names ascending the folder structure"""
+        listing = [self.list_entry(pl.Path("files", "a", str(i % 50))) for i in range(100)]  # Later entries win
+        settings = globals.LISTING_CHUNK_SIZE, globals.ENCRYPTION_WORKERS
+        try:
+            globals.LISTING_CHUNK_SIZE, globals.ENCRYPTION_WORKERS = 7, 4
+            parallel = FileCryptography(self.file_crypt.key).decrypt_server_file_list(listing)
+            globals.LISTING_CHUNK_SIZE, globals.ENCRYPTION_WORKERS = 1000, 1
+            serial = FileCryptography(self.file_crypt.key).decrypt_server_file_list(listing)
+            self.assertEqual({path: (fio.enc_path, fio.nonce) for path, fio in parallel.items()},
+                             {path: (fio.enc_path, fio.nonce) for path, fio in serial.items()})
+            self.assertEqual(list(parallel), list(serial))
+            globals.LISTING_CHUNK_SIZE, globals.ENCRYPTION_WORKERS = 7, 4
+            listing.insert(60, self.list_entry(pl.Path("files", "..", "escape")))
+            self.assertRaises(PermissionError,
+                              FileCryptography(self.file_crypt.key).decrypt_server_file_list, listing)
+        finally:
+            globals.LISTING_CHUNK_SIZE, globals.ENCRYPTION_WORKERS = settings
+
+    def test_least_recently_used_forgotten(self):
+        """Test that the cache holds at most globals.NAME_CACHE_SIZE names, dropping the least recently used"""
+        size = globals.NAME_CACHE_SIZE
+        globals.NAME_CACHE_SIZE = 3
+        try:
+            cache = NameCache(AESGCM(globals.generate_random_key()))
+            for name in ('a', 'b', 'c'):
+                cache.put(name + '.cio', b'n', pl.Path(name))
+            cache.get('a.cio', b'n')
+            cache.put('d.cio', b'n', pl.Path('d'))
+        finally:
+            globals.NAME_CACHE_SIZE = size
+        self.assertIsNone(cache.get('b.cio', b'n'))
+        self.assertEqual(cache.get('a.cio', b'n'), pl.Path('a'))
+        self.assertEqual(cache.get('d.cio', b'n'), pl.Path('d'))
+
+    def test_persisted_encrypted(self):
+        """Test that a persisted cache is read back under the same key only, without the names in plain text"""
+        key = globals.generate_random_key()
+        cache = NameCache(AESGCM(key), self.cache_path)
+        cache.put('abc.cio', b'nonce', pl.Path("files", "secret_name.txt"))
+        cache.save()
+        self.assertNotIn(b'secret_name', self.cache_path.read_bytes())
+        self.assertEqual(NameCache(AESGCM(key), self.cache_path).get('abc.cio', b'nonce'),
+                         pl.Path("files", "secret_name.txt"))
+        self.assertIsNone(NameCache(AESGCM(globals.generate_random_key()), self.cache_path).get('abc.cio', b'nonce'))
+
+    def list_entry(self, relative_path: pl.Path) -> list:
+        """An entry of a server listing for the given path, as decrypt_server_file_list takes it"""
+        nonce = globals.generate_random_nonce()
+        return [self.file_crypt.encrypt_relative_file_path(relative_path, nonce), nonce.hex(), 1546300800.0]
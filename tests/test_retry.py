@@ -0,0 +1,103 @@
+import time
+import unittest
+
+import requests
+
+from network.retry import CircuitBreaker, CircuitOpenError, DeadlineExceededError, RetryPolicy
+
+
+class FakeResponse:
+    """Stand-in for a requests.Response with only a status code"""
+
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+
+    def close(self):
+        pass
+
+
+class TestRetry(unittest.TestCase):
+    """Class for unittesting the retry.py module"""
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.2)
+        self.policy = RetryPolicy(max_attempts=4, base_delay=0.001, max_delay=0.01, breaker=self.breaker)
+        self.attempts = 0
+
+    def flaky(self, failures: int, error=None):
+        """Create an attempt failing the first failures times, with error if given or otherwise a 503"""
+        def attempt(timeout):
+            self.attempts += 1
+            if self.attempts <= failures:
+                if error:
+                    raise error
+                return FakeResponse(503)
+            return FakeResponse(200)
+        return attempt
+
+    def test_retries_until_success(self):
+        """Test that retryable errors are retried and counted"""
+        response = self.policy.call('op', self.flaky(2, requests.exceptions.ConnectionError()))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.attempts, 3)
+        self.assertEqual(self.policy.get_stats()['operations']['op']['retries'], 2)
+
+    def test_gives_up_after_max_attempts(self):
+        """Test that the last error is raised, or the last response returned, when attempts run out"""
+        self.breaker.failure_threshold = 100
+        self.assertRaises(requests.exceptions.ConnectionError, self.policy.call, 'op',
+                          self.flaky(10, requests.exceptions.ConnectionError()))
+        self.assertEqual(self.attempts, 4)
+        self.attempts = 0
+        self.assertEqual(self.policy.call('op', self.flaky(10)).status_code, 503)
+        self.assertEqual(self.policy.get_stats()['operations']['op']['failures'], 2)
+
+    def test_does_not_retry_client_errors(self):
+        """Test that a non-retryable response is returned right away"""
+        def not_found(timeout):
+            self.attempts += 1
+            return FakeResponse(404)
+        self.assertEqual(self.policy.call('op', not_found).status_code, 404)
+        self.assertEqual(self.attempts, 1)
+
+    def test_deadline(self):
+        """Test that no retry is made if it would pass the deadline"""
+        self.policy.base_delay = 1
+        self.policy.max_delay = 1
+        start = time.monotonic()
+        self.assertRaises(DeadlineExceededError, self.policy.call, 'op',
+                          self.flaky(10, requests.exceptions.Timeout()), 0.1)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(self.attempts, 1)
+
+    def test_backoff_is_capped_exponential_with_jitter(self):
+        """Test that the backoff doubles until the cap and stays within the jitter bounds"""
+        policy = RetryPolicy(base_delay=1, max_delay=8)
+        for retry, delay in enumerate([1, 2, 4, 8, 8]):
+            backoff = policy.backoff(retry)
+            self.assertTrue(delay / 2 <= backoff <= delay)
+
+    def test_circuit_breaker_fails_fast_then_recovers(self):
+        """Test that the circuit opens after repeated failures, and closes after a successful trial call"""
+        self.assertRaises(requests.exceptions.ConnectionError, self.policy.call, 'op',
+                          self.flaky(10, requests.exceptions.ConnectionError()))
+        self.assertEqual(self.breaker.state, 'open')
+        attempts = self.attempts
+        self.assertRaises(CircuitOpenError, self.policy.call, 'op', self.flaky(0))
+        self.assertEqual(self.attempts, attempts, "Open circuit should not make calls.")
+        time.sleep(0.25)
+        self.assertEqual(self.breaker.state, 'half-open')
+        self.attempts = 0
+        self.assertEqual(self.policy.call('op', self.flaky(0)).status_code, 200)
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_circuit_breaker_recovers_after_trial_raising_other_error(self):
+        """Test that a trial call failing with an error other than a network error lets the next trial through"""
+        self.assertRaises(requests.exceptions.ConnectionError, self.policy.call, 'op',
+                          self.flaky(10, requests.exceptions.ConnectionError()))
+        time.sleep(0.25)
+        self.assertEqual(self.breaker.state, 'half-open')
+        self.attempts = 0
+        self.assertRaises(OSError, self.policy.call, 'op', self.flaky(1, OSError("body unreadable")))
+        self.assertEqual(self.policy.call('op', self.flaky(0)).status_code, 200)
+        self.assertEqual(self.breaker.state, 'closed')
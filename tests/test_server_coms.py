@@ -19,6 +19,7 @@ class TestServercoms(unittest.TestCase):
             userID: the user to unregister
         """
         requests.post('https://' + self.serverIp + '/unregister/' + userID, verify=False)
+        ServComs(self.serverIp, userID).set_registered(False)  # Such that the user is registered again when used
 
     def setUp(self):
         self.serverIp = 'wyrnas.myqnapcloud.com:8001' # '127.0.0.1:443'
@@ -61,6 +62,21 @@ class TestServercoms(unittest.TestCase):
             received_content = file.read()
         self.assertEqual(file_content, received_content, "Files differ!")
 
+    def test_streamed_upload_round_trip(self):
+        """Test that a file uploaded as a stream comes back from the server unchanged"""
+        threshold = globals.STREAM_UPLOAD_THRESHOLD
+        globals.STREAM_UPLOAD_THRESHOLD = 0  # Stream even the small test file
+        try:
+            enc_file_path, additional_data_local = self.send_file(self.nonce1, self.nonce2)
+        finally:
+            globals.STREAM_UPLOAD_THRESHOLD = threshold
+        with open(enc_file_path, 'rb') as file:
+            enc_file_content = file.read()
+        tmp_file_location, additional_data_received = self.serverComs.get_file(enc_file_path.name)
+        self.assertEqual(additional_data_local, additional_data_received)
+        with open(tmp_file_location, 'rb') as file:
+            self.assertEqual(enc_file_content, file.read(), "Streamed file changed during upload.")
+
     def test_multiple_users_cannot_access_each_others_files(self):
         """test multiple users cannot access other peoples data"""
         userID1 = 'aaaabbbbccccdddd'  # Create three users
@@ -107,6 +123,18 @@ class TestServercoms(unittest.TestCase):
         self.assertEqual(sc1, sc2)      # Same ip and id
         self.assertNotEqual(sc1, sc3)   # different ip
 
+    def test_servercoms_share_connections(self):
+        """Test that every ServComs for the same server reuses the same pooled connections"""
+        sc1 = ServComs(self.serverIp, "1")
+        sc2 = ServComs(self.serverIp, "2")
+        self.assertIs(sc1.transport, sc2.transport)
+        self.assertIs(self.serverComs.transport, sc1.transport)
+        sc1.get_file_list()
+        sc2.get_file_list()
+        stats = self.serverComs.get_connection_stats()
+        self.assertGreater(stats['reused'], 0, "Expected requests to reuse kept-alive connections.")
+        self.assertLessEqual(stats['connections'], stats['pool_size'])
+
     def send_file(self, name_nonce: bytes, data_nonce: bytes, serverComs: ServComs = None) -> (pl.Path, dict):
         """
         Helper method for sending a file
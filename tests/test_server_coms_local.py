@@ -0,0 +1,493 @@
+import contextlib
+import os
+import pathlib as pl
+import time
+import unittest
+
+import requests
+
+import ServerComs
+from ServerComs import ServComs
+from network.upload_journal import get_upload_journal
+from resources import globals
+from security.filecryptography import FileCryptography
+from tests import setup_test_environment as ste
+from tests.local_server import LocalServer
+
+
+class TestServercomsLocal(unittest.TestCase):
+    """Class for unittesting the ServerComs.py module against a local stand-in server"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.state_files = ste.temporary_state_files()
+        cls.server = LocalServer()
+        cls.serverIp = cls.server.start()
+        cls.legacy_server = LocalServer(binary_downloads=False, stream_uploads=False, bulk_archive=False,
+                                        incremental_listing=False, compression=False, binary_listing=False,
+                                        multipart_uploads=False, chunk_store=False)
+        cls.legacy_serverIp = cls.legacy_server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.legacy_server.stop()
+        cls.state_files.recover()
+
+    def setUp(self):
+        self.userID = 'aaabbbccc'
+        self.serverComs = ServComs(self.serverIp, self.userID)
+        self.legacy_serverComs = ServComs(self.legacy_serverIp, self.userID)
+        self.file_path = pl.PurePath.joinpath(pl.Path(globals.TEST_FILE_FOLDER), "pic1.jpg")
+        self.file_crypt = FileCryptography(globals.generate_random_key())
+
+    def tearDown(self):
+        globals.clear_tmp()
+
+    def test_binary_download_round_trip(self):
+        """Test that a file is downloaded in the binary format when the server offers it"""
+        enc_file_content, additional_data = self.send_file(self.serverComs)
+        tmp_file_location, additional_data_received = self.serverComs.get_file(additional_data['n'])
+        self.assertTrue(self.serverComs.transport.capabilities['binary_download'])
+        self.assertEqual(additional_data, additional_data_received)
+        with open(tmp_file_location, 'rb') as file:
+            self.assertEqual(enc_file_content, file.read(), "File changed during download.")
+
+    def test_legacy_json_download_round_trip(self):
+        """Test that a server only knowing the hex-in-JSON format still works"""
+        enc_file_content, additional_data = self.send_file(self.legacy_serverComs)
+        tmp_file_location, additional_data_received = self.legacy_serverComs.get_file(additional_data['n'])
+        self.assertFalse(self.legacy_serverComs.transport.capabilities['binary_download'])
+        self.assertEqual(additional_data, additional_data_received)
+        with open(tmp_file_location, 'rb') as file:
+            self.assertEqual(enc_file_content, file.read(), "File changed during download.")
+
+    def test_downloaded_file_decrypts(self):
+        """Test that a binary downloaded file decrypts to the original file"""
+        _, additional_data = self.send_file(self.serverComs)
+        tmp_file_location, additional_data_received = self.serverComs.get_file(additional_data['n'])
+        dec_file_path = self.file_crypt.decrypt_file(tmp_file_location, additional_data_received)
+        with open(self.file_path, 'rb') as original, open(dec_file_path, 'rb') as received:
+            self.assertEqual(original.read(), received.read(), "Files differ!")
+
+    def test_download_decrypted_into_place(self):
+        """Test that a download handed to decrypt_into_place as it arrives restores the file without anything left
+        in tmp, in one piece, in ranges and in the JSON format"""
+        for serverComs, ranged in ((self.serverComs, False), (self.serverComs, True), (self.legacy_serverComs, False)):
+            _, additional_data = self.send_file(serverComs)
+            globals.clear_tmp()
+            with self.small_segments() if ranged else contextlib.nullcontext():
+                dec_file_path = serverComs.get_file(
+                    additional_data['n'],
+                    lambda ad, chunks: self.file_crypt.decrypt_into_place(additional_data['n'], chunks, ad))
+            self.assertEqual(os.listdir(globals.TEMPORARY_FOLDER), [], "Ciphertext left in tmp.")
+            with open(self.file_path, 'rb') as original, open(dec_file_path, 'rb') as received:
+                self.assertEqual(original.read(), received.read(), "Files differ!")
+            self.assertEqual(os.stat(dec_file_path).st_mtime, additional_data['t'])
+
+    def test_cut_off_download_leaves_file_alone(self):
+        """Test that a download breaking off while decrypted into place leaves neither a half-written file nor one
+        next to it"""
+        _, additional_data = self.send_file(self.serverComs)
+        dec_file_path = pl.Path(self.file_path)
+        content = dec_file_path.read_bytes()
+        self.server.fail_next(1, 'truncate', 'get_file')
+        with self.assertRaises(Exception):
+            self.serverComs.get_file(
+                additional_data['n'],
+                lambda ad, chunks: self.file_crypt.decrypt_into_place(additional_data['n'], chunks, ad))
+        self.assertEqual(dec_file_path.read_bytes(), content)
+        self.assertFalse(dec_file_path.with_name(dec_file_path.name + globals.PARTIAL_FILE_SUFFIX).exists())
+
+    def test_unknown_file_is_not_found(self):
+        """Test that asking for a file the server does not have raises FileNotFoundError in both formats"""
+        self.assertRaises(FileNotFoundError, self.serverComs.get_file, 'abcdef.cio')
+        self.assertRaises(FileNotFoundError, self.legacy_serverComs.get_file, 'abcdef.cio')
+
+    def test_streamed_upload_falls_back_to_multipart(self):
+        """Test that big files are streamed, and sent as multipart if the server does not support streaming"""
+        threshold = globals.STREAM_UPLOAD_THRESHOLD
+        globals.STREAM_UPLOAD_THRESHOLD = 0
+        try:
+            enc_file_content, additional_data = self.send_file(self.serverComs)
+            legacy_enc_file_content, legacy_additional_data = self.send_file(self.legacy_serverComs)
+        finally:
+            globals.STREAM_UPLOAD_THRESHOLD = threshold
+        self.assertTrue(self.serverComs.transport.capabilities['stream_upload'])
+        self.assertFalse(self.legacy_serverComs.transport.capabilities['stream_upload'])
+        self.assertEqual(self.server.get_stored_file(self.userID, additional_data['n'])[0], enc_file_content)
+        self.assertEqual(self.legacy_server.get_stored_file(self.userID, legacy_additional_data['n'])[0],
+                         legacy_enc_file_content)
+
+    def test_connections_are_reused(self):
+        """Test that ServComs for different users of the same server share kept-alive connections"""
+        other = ServComs(self.serverIp, 'dddeeefff')
+        self.assertIs(other.transport, self.serverComs.transport)
+        other.ensure_registered()
+        self.serverComs.ensure_registered()
+        before = self.serverComs.get_connection_stats()
+        for _ in range(5):
+            other.get_file_list()
+            self.serverComs.get_file_list()
+        after = self.serverComs.get_connection_stats()
+        self.assertEqual(after['requests'] - before['requests'], 10)
+        self.assertGreaterEqual(after['reused'] - before['reused'], 9)
+
+    def test_bulk_deletion_archives_in_batches(self):
+        """Test that deleting many files takes one request per batch, and reports the files the server did not have"""
+        enc_names = [self.send_file(self.serverComs)[1]['n'] for _ in range(5)]
+        batch_size = globals.ARCHIVE_BATCH_SIZE
+        globals.ARCHIVE_BATCH_SIZE = 2
+        try:
+            requests_before = len(self.server.request_log)
+            missing = self.serverComs.register_deletion_of_files(enc_names + ['abcdef.cio'])
+        finally:
+            globals.ARCHIVE_BATCH_SIZE = batch_size
+        self.assertEqual(missing, ['abcdef.cio'])
+        self.assertEqual(len(self.server.request_log) - requests_before, 3)
+        file_list = [entry[0] for entry in self.serverComs.get_file_list()]
+        for enc_name in enc_names:
+            self.assertNotIn(enc_name, file_list)
+
+    def test_bulk_deletion_falls_back_to_single_deletions(self):
+        """Test that a server without the bulk endpoint still gets all files archived"""
+        enc_names = [self.send_file(self.legacy_serverComs)[1]['n'] for _ in range(3)]
+        missing = self.legacy_serverComs.register_deletion_of_files(enc_names + ['abcdef.cio'])
+        self.assertEqual(missing, ['abcdef.cio'])
+        self.assertFalse(self.legacy_serverComs.transport.capabilities['bulk_archive'])
+        file_list = [entry[0] for entry in self.legacy_serverComs.get_file_list()]
+        for enc_name in enc_names:
+            self.assertNotIn(enc_name, file_list)
+
+    def test_file_list_changes_use_cursor(self):
+        """Test that listing changes gives the full list first and then only what changed since"""
+        serverComs = ServComs(self.serverIp, 'listinguser')
+        _, first = self.send_file(serverComs)
+        changed, archived, is_full_list = serverComs.get_file_list_changes()
+        self.assertTrue(is_full_list)
+        self.assertEqual([entry[0] for entry in changed], [first['n']])
+        _, second = self.send_file(serverComs)
+        serverComs.register_deletion_of_file(first['n'])
+        changed, archived, is_full_list = serverComs.get_file_list_changes()
+        self.assertFalse(is_full_list)
+        self.assertEqual([entry[0] for entry in changed], [second['n']])
+        self.assertEqual(archived, [first['n']])
+        changed, archived, is_full_list = serverComs.get_file_list_changes()
+        self.assertEqual((changed, archived, is_full_list), ([], [], False))
+
+    def test_file_list_changes_without_cursor_support(self):
+        """Test that a server without cursors always gives the full list"""
+        _, additional_data = self.send_file(self.legacy_serverComs)
+        for _ in range(2):
+            changed, archived, is_full_list = self.legacy_serverComs.get_file_list_changes()
+            self.assertTrue(is_full_list)
+            self.assertIn(additional_data['n'], [entry[0] for entry in changed])
+
+    def test_listing_is_compressed_and_binary(self):
+        """Test that listings come compressed and in the binary format, and that the bytes on the wire are counted"""
+        serverComs = ServComs(self.serverIp, 'compresseduser')
+        legacy_serverComs = ServComs(self.legacy_serverIp, 'compresseduser')
+        for _ in range(20):
+            self.send_file(serverComs)
+            self.send_file(legacy_serverComs)
+        wire_before = serverComs.get_connection_stats()['wire'].get('list_files', {}).get('wire_bytes', 0)
+        legacy_wire_before = legacy_serverComs.get_connection_stats()['wire'].get('list_files', {}).get('wire_bytes', 0)
+        file_list = serverComs.get_file_list()
+        legacy_file_list = legacy_serverComs.get_file_list()
+        self.assertTrue(serverComs.transport.capabilities['binary_listing'])
+        self.assertNotIn('binary_listing', legacy_serverComs.transport.capabilities)
+        self.assertEqual(sorted(file_list), sorted([name, data['nonce1'], data['t']] for name, (_, data)
+                                                   in self.server.users['compresseduser'].items()))
+        self.assertEqual(len(file_list), len(legacy_file_list))
+        wire_bytes = serverComs.get_connection_stats()['wire']['list_files']['wire_bytes'] - wire_before
+        legacy_wire_bytes = legacy_serverComs.get_connection_stats()['wire']['list_files']['wire_bytes'] \
+            - legacy_wire_before
+        self.assertLess(wire_bytes, legacy_wire_bytes / 2)
+
+    def test_bandwidth_is_limited(self):
+        """Test that limited uploads (streamed and multipart) and downloads take their time and arrive intact"""
+        rate = 64 * 1024  # About half a second for the test file beyond the burst
+        self.serverComs.set_bandwidth_limits(rate, rate)
+        threshold = globals.STREAM_UPLOAD_THRESHOLD
+        chunk_size = globals.BANDWIDTH_CHUNK_SIZE
+        globals.BANDWIDTH_CHUNK_SIZE = 8 * 1024
+        try:
+            for stream_threshold in (0, threshold):
+                globals.STREAM_UPLOAD_THRESHOLD = stream_threshold
+                start = time.monotonic()
+                enc_file_content, additional_data = self.send_file(self.serverComs)
+                upload_time = time.monotonic() - start
+                self.assertEqual(self.server.get_stored_file(self.userID, additional_data['n'])[0], enc_file_content)
+                start = time.monotonic()
+                tmp_file_location, _ = self.serverComs.get_file(additional_data['n'])
+                download_time = time.monotonic() - start
+                with open(tmp_file_location, 'rb') as file:
+                    self.assertEqual(enc_file_content, file.read(), "File changed during download.")
+                burst = rate * globals.BANDWIDTH_BURST_SECONDS
+                self.assertGreaterEqual(upload_time, (len(enc_file_content) - burst) / rate * 0.9)
+                self.assertGreaterEqual(download_time, (len(enc_file_content) - burst) / rate * 0.9)
+        finally:
+            globals.STREAM_UPLOAD_THRESHOLD = threshold
+            globals.BANDWIDTH_CHUNK_SIZE = chunk_size
+            self.serverComs.set_bandwidth_limits(None, None, [])
+        stats = self.serverComs.get_connection_stats()['bandwidth']
+        self.assertGreater(stats['upload_wait'], 0)
+        self.assertGreater(stats['download_wait'], 0)
+
+    def test_multipart_upload_round_trip(self):
+        """Test that big files are sent in parts, and in one piece if the server does not take parts"""
+        with self.small_parts():
+            parts_before = self.count_requests(self.server, 'multipart_part')
+            enc_file_content, additional_data = self.send_file(self.serverComs)
+            legacy_enc_file_content, legacy_additional_data = self.send_file(self.legacy_serverComs)
+        self.assertTrue(self.serverComs.transport.capabilities['multipart_upload'])
+        self.assertFalse(self.legacy_serverComs.transport.capabilities['multipart_upload'])
+        self.assertEqual(self.count_requests(self.server, 'multipart_part') - parts_before,
+                         -(-len(enc_file_content) // (8 * 1024)))
+        self.assertEqual(self.server.get_stored_file(self.userID, additional_data['n'])[0], enc_file_content)
+        self.assertEqual(self.legacy_server.get_stored_file(self.userID, legacy_additional_data['n'])[0],
+                         legacy_enc_file_content)
+        self.assertIsNone(get_upload_journal().get(self.serverComs.upload_key(additional_data)))
+
+    def test_multipart_upload_resumes(self):
+        """Test that an upload cut off by a dropped connection goes on from the last acknowledged part"""
+        enc_file_path, additional_data = self.file_crypt.encrypt_file(
+            pl.Path(self.file_path), globals.generate_random_nonce(), globals.generate_random_nonce())
+        enc_file_content = enc_file_path.read_bytes()
+        part_count = -(-len(enc_file_content) // (8 * 1024))
+        with self.small_parts():
+            globals.MULTIPART_PARALLEL_PARTS = 1  # Such that exactly the first four parts make it
+            self.server.fail_next(1, None, 'multipart_part', after=4)
+            self.serverComs.transport.retry_policy.max_attempts = 1
+            try:
+                self.assertRaises(requests.exceptions.ConnectionError,
+                                  self.serverComs.send_file, enc_file_path, additional_data)
+            finally:
+                self.serverComs.transport.retry_policy.max_attempts = globals.RETRY_MAX_ATTEMPTS
+            self.assertIsNone(self.server.get_stored_file(self.userID, additional_data['n']))
+            entry = get_upload_journal().get(self.serverComs.upload_key(additional_data))
+            self.assertEqual(sorted(entry['parts']), ['0', '1', '2', '3'])
+            globals.MULTIPART_PARALLEL_PARTS = 4
+            parts_before = self.count_requests(self.server, 'multipart_part')
+            self.serverComs.send_file(enc_file_path, additional_data)
+        self.assertEqual(self.count_requests(self.server, 'multipart_part') - parts_before, part_count - 4)
+        self.assertEqual(self.server.get_stored_file(self.userID, additional_data['n'])[0], enc_file_content)
+        self.assertIsNone(get_upload_journal().get(self.serverComs.upload_key(additional_data)))
+
+    def test_multipart_upload_restarts_when_server_forgot_it(self):
+        """Test that a journaled upload the server no longer knows is started over"""
+        enc_file_path, additional_data = self.file_crypt.encrypt_file(
+            pl.Path(self.file_path), globals.generate_random_nonce(), globals.generate_random_nonce())
+        with self.small_parts():
+            self.server.fail_next(1, 503, 'multipart_complete')
+            self.serverComs.transport.retry_policy.max_attempts = 1
+            try:
+                self.assertRaises(requests.exceptions.HTTPError,
+                                  self.serverComs.send_file, enc_file_path, additional_data)
+            finally:
+                self.serverComs.transport.retry_policy.max_attempts = globals.RETRY_MAX_ATTEMPTS
+            with self.server.lock:
+                self.server.uploads.clear()
+            self.serverComs.send_file(enc_file_path, additional_data)
+        self.assertEqual(self.server.get_stored_file(self.userID, additional_data['n'])[0],
+                         enc_file_path.read_bytes())
+
+    def test_ranged_download_in_parallel_segments(self):
+        """Test that big files are fetched in ranges, each counted with its throughput"""
+        enc_file_content, additional_data = self.send_file(self.serverComs)
+        segment_count = -(-len(enc_file_content) // (8 * 1024))
+        with self.small_segments():
+            requests_before = self.count_requests(self.server, 'get_file')
+            stats_before = self.serverComs.get_connection_stats()['segments'].get('download', {'segments': 0})
+            tmp_file_location, additional_data_received = self.serverComs.get_file(additional_data['n'])
+        self.assertTrue(self.serverComs.transport.capabilities['ranged_download'])
+        self.assertEqual(self.count_requests(self.server, 'get_file') - requests_before, segment_count)
+        self.assertEqual(additional_data, additional_data_received)
+        with open(tmp_file_location, 'rb') as file:
+            self.assertEqual(enc_file_content, file.read(), "File changed during download.")
+        stats = self.serverComs.get_connection_stats()['segments']['download']
+        self.assertEqual(stats['segments'] - stats_before['segments'], segment_count)
+        self.assertGreater(stats['throughput_min'], 0)
+        self.assertFalse(pl.Path(str(tmp_file_location) + '.segments').exists())
+
+    def test_ranged_download_resumes(self):
+        """Test that getting a file again after an interrupted download only fetches the missing ranges"""
+        enc_file_content, additional_data = self.send_file(self.serverComs)
+        segment_count = -(-len(enc_file_content) // (8 * 1024))
+        with self.small_segments():
+            globals.DOWNLOAD_PARALLEL_SEGMENTS = 1  # Such that exactly the first three segments make it
+            self.server.fail_next(1, None, 'get_file', after=3)
+            self.serverComs.transport.retry_policy.max_attempts = 1
+            try:
+                self.assertRaises(requests.exceptions.ConnectionError, self.serverComs.get_file, additional_data['n'])
+            finally:
+                self.serverComs.transport.retry_policy.max_attempts = globals.RETRY_MAX_ATTEMPTS
+            globals.DOWNLOAD_PARALLEL_SEGMENTS = 4
+            requests_before = self.count_requests(self.server, 'get_file')
+            tmp_file_location, _ = self.serverComs.get_file(additional_data['n'])
+        # The first range is always asked for, to learn the size of the file
+        self.assertEqual(self.count_requests(self.server, 'get_file') - requests_before, 1 + segment_count - 3)
+        with open(tmp_file_location, 'rb') as file:
+            self.assertEqual(enc_file_content, file.read(), "File changed during download.")
+
+    def test_cut_off_range_goes_on(self):
+        """Test that a range cut off halfway is asked for again from where it broke off"""
+        enc_file_content, additional_data = self.send_file(self.serverComs)
+        segment_count = -(-len(enc_file_content) // (8 * 1024))
+        with self.small_segments():
+            self.server.fail_next(1, 'truncate', 'get_file', after=1)
+            requests_before = self.count_requests(self.server, 'get_file')
+            tmp_file_location, _ = self.serverComs.get_file(additional_data['n'])
+        self.assertEqual(self.count_requests(self.server, 'get_file') - requests_before, segment_count + 1)
+        with open(tmp_file_location, 'rb') as file:
+            self.assertEqual(enc_file_content, file.read(), "File changed during download.")
+
+    def test_encrypted_while_sent(self):
+        """Test that a file encrypted while sent arrives as the same ciphertext encrypting it to disk gives, sent in
+        one piece, streamed or in parts"""
+        settings = (globals.STREAM_UPLOAD_THRESHOLD, globals.ENCRYPTION_SEGMENT_SIZE)
+        globals.ENCRYPTION_SEGMENT_SIZE = 4 * 1024
+        try:
+            for stream_threshold, multipart_threshold in ((2 ** 40, 2 ** 40), (0, 2 ** 40), (0, 0)):
+                globals.STREAM_UPLOAD_THRESHOLD = stream_threshold
+                with self.small_parts():
+                    globals.MULTIPART_UPLOAD_THRESHOLD = multipart_threshold
+                    name_nonce, data_nonce = globals.generate_random_nonce(), globals.generate_random_nonce()
+                    enc_file = self.file_crypt.open_encrypted(pl.Path(self.file_path), name_nonce, data_nonce)
+                    self.serverComs.send_encrypted_file(enc_file)
+                    self.assertEqual(os.listdir(globals.TEMPORARY_FOLDER), [], "Ciphertext written to tmp.")
+                    enc_file_path, additional_data = self.file_crypt.encrypt_file(
+                        pl.Path(self.file_path), name_nonce, data_nonce)
+                self.assertEqual(enc_file.additional_data, additional_data)
+                self.assertEqual(enc_file.size, enc_file_path.stat().st_size)
+                self.assertEqual(self.server.get_stored_file(self.userID, additional_data['n'])[0],
+                                 enc_file_path.read_bytes())
+                enc_file_path.unlink()
+        finally:
+            globals.STREAM_UPLOAD_THRESHOLD, globals.ENCRYPTION_SEGMENT_SIZE = settings
+
+    def test_compressed_file_is_streamed(self):
+        """Test that a compressed file, whose ranges can not be encrypted on their own, is streamed instead of sent
+        in parts"""
+        text_path = pl.Path(globals.TEST_FILE_FOLDER, "profanity_wordlist.txt")
+        with self.small_parts():
+            globals.MULTIPART_UPLOAD_THRESHOLD = 0
+            name_nonce, data_nonce = globals.generate_random_nonce(), globals.generate_random_nonce()
+            enc_file = self.file_crypt.open_encrypted(text_path, name_nonce, data_nonce)
+            parts_before = self.count_requests(self.server, 'multipart_part')
+            self.serverComs.send_encrypted_file(enc_file)
+        self.assertEqual(enc_file.additional_data['c'], 'zlib')
+        self.assertEqual(self.count_requests(self.server, 'multipart_part'), parts_before)
+        enc_file_path, _ = self.file_crypt.encrypt_file(text_path, name_nonce, data_nonce)
+        self.assertEqual(self.server.get_stored_file(self.userID, enc_file.additional_data['n'])[0],
+                         enc_file_path.read_bytes())
+
+    def test_chunked_upload_falls_back_to_whole_file(self):
+        """Test that a file sent as chunks to a server keeping no chunks is sent whole instead, without being split,
+        and that a server keeping chunks gets the manifest as the file"""
+        settings = globals.CHUNKED_UPLOADS, globals.CHUNKED_UPLOAD_THRESHOLD
+        globals.CHUNKED_UPLOADS, globals.CHUNKED_UPLOAD_THRESHOLD = True, 0
+        try:
+            for serverComs, server in ((self.legacy_serverComs, self.legacy_server), (self.serverComs, self.server)):
+                name_nonce, data_nonce = globals.generate_random_nonce(), globals.generate_random_nonce()
+                enc_file = self.file_crypt.open_encrypted(pl.Path(self.file_path), name_nonce, data_nonce)
+                if not server.chunk_store:
+                    enc_file.chunked = lambda: self.fail("Split for a server keeping no chunks")
+                serverComs.send_encrypted_file(enc_file)
+                content, additional_data = server.get_stored_file(self.userID, enc_file.additional_data['n'])
+                self.assertEqual(additional_data.get('m', 0), int(server.chunk_store))
+                self.assertEqual(serverComs.transport.capabilities['chunk_store'], server.chunk_store)
+        finally:
+            globals.CHUNKED_UPLOADS, globals.CHUNKED_UPLOAD_THRESHOLD = settings
+        dec_file_path = self.serverComs.get_file(
+            additional_data['n'],
+            lambda ad, chunks: self.file_crypt.decrypt_chunked_into_place(additional_data['n'], chunks, ad,
+                                                                          self.serverComs.get_chunks))
+        with open(self.file_path, 'rb') as original, open(dec_file_path, 'rb') as received:
+            self.assertEqual(original.read(), received.read(), "Files differ!")
+
+    def test_requests_are_retried(self):
+        """Test that failing requests and dropped connections are retried, and counted"""
+        self.serverComs.transport.retry_policy.base_delay = 0.01
+        _, additional_data = self.send_file(self.serverComs)
+        before = self.serverComs.get_connection_stats()['operations']['list_files']['retries']
+        self.server.fail_next(1, 503)
+        self.server.fail_next(1, None)
+        file_list = self.serverComs.get_file_list()
+        self.assertIn(additional_data['n'], [entry[0] for entry in file_list])
+        stats = self.serverComs.get_connection_stats()
+        self.assertEqual(stats['operations']['list_files']['retries'] - before, 2)
+        self.assertEqual(stats['circuit'], 'closed')
+
+    def test_registration_is_lazy_and_memoized(self):
+        """Test that creating ServComs does not register, and that a user is registered only once"""
+        userID = os.urandom(8).hex()
+        registrations = self.server.registrations
+        serverComs = ServComs(self.serverIp, userID)
+        self.assertEqual(self.server.registrations, registrations, "Should not register before the first request.")
+        serverComs.get_file_list()
+        ServComs(self.serverIp, userID).get_file_list()
+        self.assertEqual(self.server.registrations, registrations + 1)
+        with open(globals.REGISTERED_USERS, "rt") as file:
+            self.assertIn(serverComs.__hash__(), file.read(), "Registration should be remembered on disk.")
+
+    def test_registration_is_remembered_across_runs(self):
+        """Test that a registration saved on disk by an earlier run is used"""
+        userID = os.urandom(8).hex()
+        ServComs(self.serverIp, userID).get_file_list()
+        registrations = self.server.registrations
+        ServerComs._registered_users = None  # Forget what is in memory, as a new run would
+        ServComs(self.serverIp, userID).get_file_list()
+        self.assertEqual(self.server.registrations, registrations)
+
+    def test_unknown_user_is_registered_again(self):
+        """Test that a user the server has forgotten is registered again, and the request succeeds"""
+        userID = os.urandom(8).hex()
+        serverComs = ServComs(self.serverIp, userID)
+        serverComs.get_file_list()
+        with self.server.lock:
+            self.server.users.pop(userID)
+        _, additional_data = self.send_file(serverComs)
+        self.assertIn(additional_data['n'], [entry[0] for entry in serverComs.get_file_list()])
+
+    @contextlib.contextmanager
+    def small_parts(self):
+        """Context in which the test file is sent as a multipart upload of 8 KiB parts"""
+        settings = (globals.MULTIPART_UPLOAD_THRESHOLD, globals.MULTIPART_PART_SIZE, globals.MULTIPART_PARALLEL_PARTS)
+        globals.MULTIPART_UPLOAD_THRESHOLD, globals.MULTIPART_PART_SIZE = 0, 8 * 1024
+        try:
+            yield
+        finally:
+            globals.MULTIPART_UPLOAD_THRESHOLD, globals.MULTIPART_PART_SIZE, globals.MULTIPART_PARALLEL_PARTS = settings
+
+    @contextlib.contextmanager
+    def small_segments(self):
+        """Context in which the test file is downloaded in ranges of 8 KiB"""
+        settings = (globals.DOWNLOAD_SEGMENT_SIZE, globals.DOWNLOAD_PARALLEL_SEGMENTS)
+        globals.DOWNLOAD_SEGMENT_SIZE = 8 * 1024
+        try:
+            yield
+        finally:
+            globals.DOWNLOAD_SEGMENT_SIZE, globals.DOWNLOAD_PARALLEL_SEGMENTS = settings
+
+    def count_requests(self, server: LocalServer, endpoint: str) -> int:
+        """The amount of requests the server got to the endpoint"""
+        return len([path for _, path in server.request_log if path.split('/')[1] == endpoint])
+
+    def send_file(self, serverComs: ServComs) -> (bytes, dict):
+        """
+        Helper method for encrypting and sending the test file
+
+        Args:
+            serverComs: the servercoms to send the file with
+
+        Returns:
+            bytes: the encrypted content of the file
+            dict: the additional data of the file
+        """
+        enc_file_path, additional_data = self.file_crypt.encrypt_file(
+            pl.Path(self.file_path), globals.generate_random_nonce(), globals.generate_random_nonce())
+        serverComs.send_file(enc_file_path, additional_data)
+        with open(enc_file_path, 'rb') as file:
+            enc_file_content = file.read()
+        return enc_file_content, additional_data